@@ -3,27 +3,49 @@
 
 from flask import Flask, render_template
 from flask_wtf.csrf import CSRFProtect
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_migrate import Migrate
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from config import app_config
+from . import (assets, audit, commands, instrument, jobs, metrics,
+               passwords, templating, throttle)
+from .cache import Cache, LRUCache
+from .database import SQLAlchemy
 
+cache = Cache()
 cp = CSRFProtect()
 db = SQLAlchemy()
 lm = LoginManager()
 
 
-def create_app(config_name):
+def create_app(config_name, settings=None):
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_object(app_config[config_name])
     app.config.from_pyfile('config.py')
+    if settings:
+        app.config.update(settings)
+    if app.config['PROXY_FIX_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app,
+                                x_for=app.config['PROXY_FIX_X_FOR'])
+    templating.init_app(app)
 
+    cache.init_app(app)
     cp.init_app(app)
     db.init_app(app)
     lm.init_app(app)
     lm.login_message = "You must sign up to access this page."
     lm.login_view = "auth.signin"
+    app.extensions['user_cache'] = LRUCache(app.config['USER_CACHE_SIZE'],
+                                            app.config['USER_CACHE_TTL'])
+    passwords.init_app(app)
+    throttle.init_app(app)
+    assets.init_app(app)
+    instrument.init_app(app)
+    metrics.init_app(app)
+    audit.init_app(app)
+    jobs.init_app(app)
+    commands.init_app(app)
 
     migrate = Migrate(app, db)
     from app import models
@@ -34,6 +56,9 @@ def create_app(config_name):
     app.register_blueprint(auth_blueprint)
     from .home import home as home_blueprint
     app.register_blueprint(home_blueprint)
+    from .api import api as api_blueprint
+    app.register_blueprint(api_blueprint, url_prefix='/api/v1')
+    cp.exempt(api_blueprint)
 
     @app.errorhandler(403)
     def forbidden(error):
@@ -65,4 +90,15 @@ def create_app(config_name):
         return render_template('errors/500.html',
                                title='500 Internal server error'), 500
 
+    @app.errorhandler(passwords.PoolBusy)
+    def service_unavailable(error):
+        """
+        Custom error 503 Service unavailable when the hashing pool is full.
+        :param error:
+        :return:
+        """
+        headers = {'Retry-After': str(app.config['PASSWORD_POOL_RETRY_AFTER'])}
+        return render_template('errors/503.html',
+                               title='503 Service unavailable'), 503, headers
+
     return app
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+# app/admin/bulk.py
+
+import csv
+import io
+import json
+
+from .. import db
+from ..models import Group, Role, User
+from ..pagination import iter_chunks
+from ..passwords import hash_passwords
+
+
+FIELDS = ('email', 'name', 'first_name', 'last_name', 'group', 'role',
+          'is_admin', 'is_valid', 'is_blocked')
+FLAGS = ('is_admin', 'is_valid', 'is_blocked')
+FILTERS = ('group', 'role') + FLAGS
+ACTIONS = {'assign': None,
+           'block': {'is_blocked': True},
+           'unblock': {'is_blocked': False},
+           'validate': {'is_valid': True},
+           'invalidate': {'is_valid': False},
+           'delete': None}
+
+
+class BulkError(ValueError):
+    """
+    Raised when an imported file can not be loaded.
+    """
+
+
+def _text(value):
+    """
+    Decode the utf-8 values read by the csv module.
+    :param value:
+    :return:
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def _flag(value):
+    """
+    Read a boolean written as a JSON boolean, as 0 or 1, or as text.
+    :param value:
+    :return:
+    """
+    if value is None or isinstance(value, bool):
+        return bool(value)
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if not isinstance(value, (bytes, type(u''))):
+        raise BulkError('invalid flag "%s".' % value)
+    return value.strip().lower() in ('1', 'true', 'yes', 'y', 'on')
+
+
+def read_rows(stream, format):
+    """
+    Read the users of a CSV file with a header line or of a JSON list
+    of objects.
+    :param stream:
+    :param format:
+    :return:
+    """
+    if format == 'csv':
+        rows = [dict((_text(key), _text(value)) for key, value in row.items())
+                for row in csv.DictReader(stream)]
+    elif format == 'json':
+        try:
+            rows = json.load(stream)
+        except ValueError:
+            raise BulkError('invalid JSON.')
+        if not isinstance(rows, list):
+            raise BulkError('the JSON document must be a list of users.')
+    else:
+        raise BulkError('unknown format "%s".' % format)
+    for line, row in enumerate(rows, 1):
+        if not isinstance(row, dict) or not row.get('email') or \
+                not row.get('name'):
+            raise BulkError('user %d has no email or name.' % line)
+    return rows
+
+
+def _ids(model, names, label):
+    """
+    Map names to ids with a single query.
+    :param model:
+    :param names:
+    :param label:
+    :return:
+    """
+    names = set(name for name in names if name)
+    if not names:
+        return {}
+    ids = dict(db.session.query(model.name, model.id)
+               .filter(model.name.in_(names)))
+    unknown = names.difference(ids)
+    if unknown:
+        raise BulkError('unknown %s "%s".' % (label, sorted(unknown)[0]))
+    return ids
+
+
+def import_users(rows, batch_size):
+    """
+    Insert users in batches of executemany INSERTs, in the transaction
+    of the session. Returns the number of inserted users.
+    :param rows:
+    :param batch_size:
+    :return:
+    """
+    groups = _ids(Group, (row.get('group') for row in rows), 'group')
+    roles = _ids(Role, (row.get('role') for row in rows), 'role')
+    insert = User.__table__.insert()
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        passwords = [row['password'] for row in batch if row.get('password')]
+        hashes = iter(hash_passwords(passwords))
+        mappings = []
+        for row in batch:
+            mapping = dict((field, row.get(field) or None)
+                           for field in ('email', 'name', 'first_name',
+                                         'last_name'))
+            mapping['password_hash'] = (next(hashes) if row.get('password')
+                                        else None)
+            mapping['group_id'] = groups.get(row.get('group'))
+            mapping['role_id'] = roles.get(row.get('role'))
+            for flag in FLAGS:
+                mapping[flag] = _flag(row.get(flag))
+            mappings.append(mapping)
+        db.session.execute(insert, mappings)
+    return len(rows)
+
+
+def export_query():
+    """
+    Select the exported columns without loading User objects.
+    :return:
+    """
+    return db.session.query(User.id, User.email, User.name, User.first_name,
+                            User.last_name, Group.name.label('group'),
+                            Role.name.label('role'), User.is_admin,
+                            User.is_valid, User.is_blocked) \
+        .outerjoin(Group, User.group_id == Group.id) \
+        .outerjoin(Role, User.role_id == Role.id)
+
+
+def export_csv(chunk_size):
+    """
+    Yield the users as CSV, one chunk of rows at a time.
+    :param chunk_size:
+    :return:
+    """
+    buffer = io.BytesIO()
+    writer = csv.writer(buffer)
+    writer.writerow(('id',) + FIELDS)
+    for rows in iter_chunks(export_query(), User.id, chunk_size):
+        for row in rows:
+            writer.writerow([value.encode('utf-8')
+                             if isinstance(value, type(u'')) else value
+                             for value in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def export_json(chunk_size):
+    """
+    Yield the users as a JSON list, one chunk of rows at a time.
+    :param chunk_size:
+    :return:
+    """
+    separator = '['
+    for rows in iter_chunks(export_query(), User.id, chunk_size):
+        yield separator + ','.join(json.dumps(row._asdict()) for row in rows)
+        separator = ','
+    yield '[]' if separator == '[' else ']'
+
+
+def filter_users(query, filters):
+    """
+    Filter an users query by group, role and flags.
+    :param query:
+    :param filters:
+    :return:
+    """
+    for name, value in filters.items():
+        if name in ('group', 'role'):
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise BulkError('invalid %s "%s".' % (name, value))
+        if name == 'group':
+            query = query.filter(User.group_id == value)
+        elif name == 'role':
+            query = query.filter(User.role_id == value)
+        elif name in FLAGS:
+            query = query.filter(getattr(User, name) == _flag(value))
+        else:
+            raise BulkError('unknown filter "%s".' % name)
+    return query
+
+
+def batch_query(ids, filters):
+    """
+    Select users by ids and/or by group, role and flags.
+    :param ids:
+    :param filters:
+    :return:
+    """
+    if not ids and not filters:
+        raise BulkError('no users selected.')
+    query = User.query
+    if ids:
+        query = query.filter(User.id.in_(ids))
+    return filter_users(query, filters)
+
+
+def apply_batch(action, ids, filters, group_id=None, role_id=None):
+    """
+    Apply an action to the selected users with a single UPDATE or DELETE
+    in the transaction of the session. Admins can not be assigned or
+    deleted, as with the single user views. Returns the number of
+    affected users.
+    :param action:
+    :param ids:
+    :param filters:
+    :param group_id:
+    :param role_id:
+    :return:
+    """
+    if action not in ACTIONS:
+        raise BulkError('unknown action "%s".' % action)
+    query = batch_query(ids, filters)
+    if action in ('assign', 'delete'):
+        query = query.filter(db.or_(User.is_admin.is_(None),
+                                    User.is_admin == False))
+    if action == 'delete':
+        return query.delete(synchronize_session=False)
+    values = ACTIONS[action]
+    if action == 'assign':
+        if group_id is None or role_id is None:
+            raise BulkError('a group and a role are required.')
+        if Group.query.get(group_id) is None or \
+                Role.query.get(role_id) is None:
+            raise BulkError('unknown group or role.')
+        values = {'group_id': group_id, 'role_id': role_id}
+    return query.update(values, synchronize_session=False)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# app/admin/choices.py
+
+from flask import current_app
+
+from .. import cache, db
+from ..models import Group, Role
+from ..replicas import primary
+
+
+class ChoiceIndex(object):
+    """
+    Cached (id, label) choices of a table, versioned by the generation
+    of its cache namespace, with an id to label dict for O(1) lookups.
+    """
+    def __init__(self, model, namespace):
+        self.model = model
+        self.namespace = namespace
+
+    def _load(self):
+        """
+        Return the (generation, choices, labels) of the process,
+        reloaded from the shared cache or the database when the
+        generation changed.
+        :return:
+        """
+        generation = cache.generation(self.namespace)
+        indexes = current_app.extensions.setdefault('choice_indexes', {})
+        index = indexes.get(self.namespace)
+        if index is not None and index[0] == generation:
+            return index
+        choices = cache.get(self.namespace, 'choices')
+        if choices is None:
+            with primary():
+                choices = [tuple(row) for row in
+                           db.session.query(self.model.id, self.model.name)
+                           .order_by(self.model.name)]
+            cache.set(self.namespace, 'choices', choices)
+        index = (generation, choices, dict(choices))
+        indexes[self.namespace] = index
+        return index
+
+    def choices(self):
+        return self._load()[1]
+
+    def label(self, id):
+        return self._load()[2].get(id)
+
+    def __contains__(self, id):
+        return id in self._load()[2]
+
+    def invalidate(self):
+        """
+        Drop the choices after the table has been written.
+        :return:
+        """
+        cache.bump(self.namespace)
+
+
+group_choices = ChoiceIndex(Group, 'groups')
+role_choices = ChoiceIndex(Role, 'roles')
@@ -2,11 +2,41 @@
 # app/admin/forms.py
 
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, BooleanField
+from flask_wtf.file import FileAllowed, FileField, FileRequired
+from wtforms import StringField, SubmitField, BooleanField, SelectField
 from wtforms.validators import DataRequired, Email
-from wtforms.ext.sqlalchemy.fields import QuerySelectField
 
-from ..models import Group, Role
+from .choices import group_choices, role_choices
+
+
+class IndexedSelectField(SelectField):
+    """
+    Select field of the ids of a cached choice index.
+    """
+    def __init__(self, label=None, validators=None, index=None, **kwargs):
+        super(IndexedSelectField, self).__init__(label, validators,
+                                                 coerce=int, **kwargs)
+        self.index = index
+
+    def iter_choices(self):
+        for id, label in self.index.choices():
+            yield (id, label, id == self.data)
+
+    def process_data(self, value):
+        self.data = getattr(value, 'id', value)
+
+    def process_formdata(self, valuelist):
+        if valuelist:
+            try:
+                self.data = int(valuelist[0])
+            except ValueError:
+                self.data = None
+            if self.data not in self.index:
+                self.data = None
+
+    def pre_validate(self, form):
+        if self.data not in self.index:
+            raise ValueError(self.gettext('Not a valid choice'))
 
 
 class UserForm(FlaskForm):
@@ -18,10 +48,8 @@ class UserForm(FlaskForm):
     name = StringField('Name', validators=[DataRequired()])
     first_name = StringField('First Name', validators=[DataRequired()])
     last_name = StringField('Last Name', validators=[DataRequired()])
-    group = QuerySelectField(query_factory=lambda: Group.query.all(),
-                             get_label='name')
-    role = QuerySelectField(query_factory=lambda: Role.query.all(),
-                            get_label='name')
+    group = IndexedSelectField(index=group_choices)
+    role = IndexedSelectField(index=role_choices)
     is_admin = BooleanField('Is Admin')
     is_valid = BooleanField('Is Valid')
     is_blocked = BooleanField('Is Blocked')
@@ -53,3 +81,12 @@ class ToolForm(FlaskForm):
     name = StringField('Name', validators=[DataRequired()])
     description = StringField('Description', validators=[DataRequired()])
     submit = SubmitField('Submit')
+
+
+class ImportForm(FlaskForm):
+    """
+    Form admin to import users from a CSV or JSON file.
+    """
+    file = FileField('File', validators=[FileRequired(),
+                                         FileAllowed(['csv', 'json'])])
+    submit = SubmitField('Import')
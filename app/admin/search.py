@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# app/admin/search.py
+
+from flask import current_app
+
+from .. import db
+from ..models import User
+from .bulk import filter_users
+
+
+FTS_SCHEMA = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+    "name, first_name, last_name, email, "
+    "content='users', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users "
+    "BEGIN "
+    "INSERT INTO users_fts (rowid, name, first_name, last_name, email) "
+    "VALUES (new.id, new.name, new.first_name, new.last_name, new.email); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users "
+    "BEGIN "
+    "INSERT INTO users_fts (users_fts, rowid, name, first_name, last_name, "
+    "email) VALUES ('delete', old.id, old.name, old.first_name, "
+    "old.last_name, old.email); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_update "
+    "AFTER UPDATE OF email, name, first_name, last_name ON users "
+    "BEGIN "
+    "INSERT INTO users_fts (users_fts, rowid, name, first_name, last_name, "
+    "email) VALUES ('delete', old.id, old.name, old.first_name, "
+    "old.last_name, old.email); "
+    "INSERT INTO users_fts (rowid, name, first_name, last_name, email) "
+    "VALUES (new.id, new.name, new.first_name, new.last_name, new.email); "
+    "END",
+    "INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+FTS_DROP = ('DROP TRIGGER IF EXISTS users_fts_update',
+            'DROP TRIGGER IF EXISTS users_fts_delete',
+            'DROP TRIGGER IF EXISTS users_fts_insert',
+            'DROP TABLE IF EXISTS users_fts')
+
+
+def install_fts(bind):
+    """
+    Create the SQLite full text index of the users and its triggers.
+    :param bind:
+    :return:
+    """
+    for statement in FTS_SCHEMA:
+        bind.execute(db.text(statement))
+
+
+def uninstall_fts(bind):
+    """
+    Drop the SQLite full text index of the users and its triggers.
+    :param bind:
+    :return:
+    """
+    for statement in FTS_DROP:
+        bind.execute(db.text(statement))
+
+
+def _prefix(column, prefix):
+    """
+    Match a prefix with a range, which can use the column index
+    on every database, unlike LIKE.
+    :param column:
+    :param prefix:
+    :return:
+    """
+    return db.and_(column >= prefix, column < prefix + u'\uffff')
+
+
+def _match(q):
+    """
+    Build a FTS5 query matching every word of q as a prefix.
+    :param q:
+    :return:
+    """
+    return ' '.join('"%s"*' % word.replace('"', '""') for word in q.split())
+
+
+def search_users(query, q, filters):
+    """
+    Filter an users query by a name or email prefix, or by the words
+    of the full text index when USERS_FTS is set, and by the group,
+    role and flags filters.
+    :param query:
+    :param q:
+    :param filters:
+    :return:
+    """
+    q = (q or '').strip()
+    if q and current_app.config['USERS_FTS']:
+        matches = db.text('SELECT rowid FROM users_fts '
+                          'WHERE users_fts MATCH :match') \
+            .bindparams(match=_match(q)) \
+            .columns(db.column('rowid', db.Integer))
+        query = query.filter(User.id.in_(matches))
+    elif q:
+        query = query.filter(db.or_(_prefix(User.name, q),
+                                    _prefix(User.email, q)))
+    return filter_users(query, filters)
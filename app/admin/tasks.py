@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# app/admin/tasks.py
+
+import binascii
+import json
+import os
+
+from flask import current_app
+
+from . import bulk
+from .choices import group_choices, role_choices
+from .. import db
+from ..fragments import invalidate_fragments
+from ..jobs import task
+from ..models import User, load_user
+from ..pagination import iter_chunks
+
+
+def export_path(id, format):
+    """
+    Return the file written by an export job.
+    :param id:
+    :param format:
+    :return:
+    """
+    return os.path.join(current_app.instance_path, 'exports',
+                        'users-%d.%s' % (id, format))
+
+
+def save_upload(rows):
+    """
+    Write the rows of an import to a file of the instance folder only
+    readable by the application, which the import job deletes, so the
+    passwords of the rows are not kept in the job queue.
+    :param rows:
+    :return:
+    """
+    directory = os.path.join(current_app.instance_path, 'imports')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, 'users-%s.json' %
+                        binascii.hexlify(os.urandom(8)))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(rows, f)
+    return path
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@task('import_users')
+def import_users(job, path):
+    """
+    Import the users of an upload file one batch at a time, in one
+    transaction. The file is deleted once imported, or after the last
+    attempt.
+    :param job:
+    :param path:
+    :return:
+    """
+    batch_size = current_app.config['BULK_BATCH_SIZE']
+    try:
+        with open(path) as f:
+            rows = json.load(f)
+        for start in range(0, len(rows), batch_size):
+            bulk.import_users(rows[start:start + batch_size], batch_size)
+            job.progress(start + batch_size, len(rows) + 1,
+                         'Imported %d of %d users.' %
+                         (min(start + batch_size, len(rows)), len(rows)))
+        db.session.commit()
+    except:
+        db.session.rollback()
+        if job.last_attempt:
+            _remove(path)
+        raise
+    _remove(path)
+    invalidate_fragments('groups', 'roles')
+    return {'count': len(rows)}
+
+
+@task('export_users')
+def export_users(job, format='csv'):
+    """
+    Write the users to a file of the instance folder.
+    :param job:
+    :param format:
+    :return:
+    """
+    path = export_path(job.id, format)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
+    chunks = bulk.export_csv if format == 'csv' else bulk.export_json
+    total = User.query.count()
+    with open(path + '.tmp', 'wb') as f:
+        for i, chunk in enumerate(chunks(chunk_size)):
+            f.write(chunk)
+            job.progress(min((i + 1) * chunk_size, total), total + 1,
+                         'Exported %d of %d users.' %
+                         (min((i + 1) * chunk_size, total), total))
+    os.rename(path + '.tmp', path)
+    return {'count': total, 'format': format}
+
+
+@task('warm_caches')
+def warm_caches(job):
+    """
+    Load the group and role choices and the snapshots of the users
+    into the caches.
+    :param job:
+    :return:
+    """
+    group_choices.choices()
+    role_choices.choices()
+    total = User.query.count()
+    done = 0
+    for rows in iter_chunks(db.session.query(User.id), User.id,
+                            current_app.config['EXPORT_CHUNK_SIZE']):
+        for id, in rows:
+            load_user(id)
+        done += len(rows)
+        job.progress(done, total + 1, 'Loaded %d of %d users.' % (done, total))
+    return {'count': done}
@@ -1,13 +1,25 @@
 # -*- coding: utf-8 -*-
 # app/admin/views.py
 
-from flask import abort, flash, redirect, render_template, url_for
+import time
+
+from flask import (Response, abort, current_app, flash, jsonify, redirect,
+                   render_template, request, send_file, stream_with_context,
+                   url_for)
 from flask_login import current_user, login_required as signed_session
 
-from . import admin
-from forms import GroupForm, RoleForm, ToolForm, UserForm
+from . import admin, bulk, search, tasks
+from .choices import group_choices, role_choices
+from forms import GroupForm, ImportForm, RoleForm, ToolForm, UserForm
 from .. import db
-from ..models import Group, Role, Tool, User
+from ..audit import audit
+from ..conditional import conditional
+from ..fragments import invalidate_fragments
+from ..jobs import DONE, FAILED, enqueue
+from ..pagination import LazyPage, paginate, render_page
+from ..replicas import use_replica
+from ..models import (Group, Role, Tool, User, count_users, invalidate_user,
+                      invalidate_users)
 
 
 def check_admin():
@@ -19,18 +31,28 @@ def check_admin():
         abort(403)
 
 
+def users_query():
+    """
+    Query users with their group and role joined in the same SELECT.
+    :return:
+    """
+    return User.query.options(db.joinedload(User.group),
+                              db.joinedload(User.role))
+
+
 @admin.route('/groups', methods=['GET', 'POST'])
 @signed_session
+@use_replica
+@conditional(Group, 'groups', authorize=check_admin)
 def groups():
     """
-    List all groups.
+    List the groups one page at a time.
     :return:
     """
-    check_admin()
-    groups = Group.query.all()
-    return render_template('admin/groups/groups.html',
-                           title='Groups',
-                           groups=groups)
+    page = LazyPage(Group.query, Group.id)
+    return render_page('admin/groups/groups.html', page,
+                       title='Groups',
+                       count_users=count_users)
 
 
 @admin.route('/groups/add', methods=['GET', 'POST'])
@@ -48,6 +70,9 @@ def add_group():
         try:
             db.session.add(group)
             db.session.commit()
+            group_choices.invalidate()
+            invalidate_fragments('groups')
+            audit('add', 'group', group.id, name=group.name)
             flash('Successfully added a new group: "%s".' % str(group.name))
         except:
             db.session.rollback()
@@ -76,6 +101,9 @@ def edit_group(id):
         try:
             db.session.add(group)
             db.session.commit()
+            group_choices.invalidate()
+            invalidate_fragments('groups')
+            audit('edit', 'group', group.id, name=group.name)
             flash('You have successfully edited the group: "%s".' % str(group.name))
         except:
             db.session.rollback()
@@ -103,6 +131,10 @@ def delete_group(id):
     try:
         db.session.delete(group)
         db.session.commit()
+        group_choices.invalidate()
+        invalidate_fragments('groups')
+        audit('delete', 'group', group.id, name=group.name)
+        invalidate_users()
         flash('You have successfully deleted the group: "%s".' % str(group.name))
     except:
         db.session.rollback()
@@ -112,16 +144,17 @@ def delete_group(id):
 
 @admin.route('/roles')
 @signed_session
+@use_replica
+@conditional(Role, 'roles', authorize=check_admin)
 def roles():
     """
-    List all roles.
+    List the roles one page at a time.
     :return:
     """
-    check_admin()
-    roles = Role.query.all()
-    return render_template('admin/roles/roles.html',
-                           title='Roles',
-                           roles=roles)
+    page = LazyPage(Role.query, Role.id)
+    return render_page('admin/roles/roles.html', page,
+                       title='Roles',
+                       count_users=count_users)
 
 
 @admin.route('roles/add', methods=['GET', 'POST'])
@@ -139,6 +172,9 @@ def add_role():
         try:
             db.session.add(role)
             db.session.commit()
+            role_choices.invalidate()
+            invalidate_fragments('roles')
+            audit('add', 'role', role.id, name=role.name)
             flash('Successfully added a new role: "%s".' % str(role.name))
         except:
             db.session.rollback()
@@ -166,6 +202,9 @@ def edit_role(id):
         try:
             db.session.add(role)
             db.session.commit()
+            role_choices.invalidate()
+            invalidate_fragments('roles')
+            audit('edit', 'role', role.id, name=role.name)
             flash('Successfully edited the role: "%s".' % str(role.name))
         except:
             db.session.rollback()
@@ -191,6 +230,10 @@ def delete_role(id):
     try:
         db.session.delete(role)
         db.session.commit()
+        role_choices.invalidate()
+        invalidate_fragments('roles')
+        audit('delete', 'role', role.id, name=role.name)
+        invalidate_users()
         flash('Successfully deleted the role: "%s".' % str(role.name))
     except:
         db.session.rollback()
@@ -200,16 +243,16 @@ def delete_role(id):
 
 @admin.route('/tools', methods=['GET', 'POST'])
 @signed_session
+@use_replica
+@conditional(Tool, 'tools', authorize=check_admin)
 def tools():
     """
-    List all tools.
+    List the tools one page at a time.
     :return:
     """
-    check_admin()
-    tools = Tool.query.all()
-    return render_template('admin/tools/tools.html',
-                           title='Tools',
-                           tools=tools)
+    page = LazyPage(Tool.query, Tool.id)
+    return render_page('admin/tools/tools.html', page,
+                       title='Tools')
 
 
 @admin.route('/tools/add', methods=['GET', 'POST'])
@@ -227,6 +270,8 @@ def add_tool():
         try:
             db.session.add(tool)
             db.session.commit()
+            invalidate_fragments('tools')
+            audit('add', 'tool', tool.id, name=tool.name)
             flash('Successfully added a new tool: "%s".' % str(tool.name))
         except:
             db.session.rollback()
@@ -255,6 +300,8 @@ def edit_tool(id):
         try:
             db.session.add(tool)
             db.session.commit()
+            invalidate_fragments('tools')
+            audit('edit', 'tool', tool.id, name=tool.name)
             flash('Successfully edited the tool: "%s".' % str(tool.name))
         except:
             db.session.rollback()
@@ -281,6 +328,8 @@ def delete_tool(id):
     try:
         db.session.delete(tool)
         db.session.commit()
+        invalidate_fragments('tools')
+        audit('delete', 'tool', tool.id, name=tool.name)
         flash('Successfully deleted the tool: "%s".' %
               str(tool.name))
     except:
@@ -292,16 +341,43 @@ def delete_tool(id):
 
 @admin.route('/users')
 @signed_session
+@use_replica
 def users():
     """
-    List all users.
+    List the users one page at a time.
     :return:
     """
     check_admin()
-    users = User.query.all()
-    return render_template('admin/users/users.html',
-                           title='Users',
-                           users=users)
+    page = paginate(users_query(), User.id)
+    return render_page('admin/users/users.html', page,
+                       title='Users',
+                       users=page.items,
+                       endpoint='admin.users',
+                       args={})
+
+
+@admin.route('/users/search')
+@signed_session
+def search_users():
+    """
+    Search the users by name or email and filter them by group,
+    role and flags, one page at a time.
+    :return:
+    """
+    check_admin()
+    filters = dict((name, request.args[name]) for name in bulk.FILTERS
+                   if request.args.get(name))
+    q = request.args.get('q', '')
+    try:
+        query = search.search_users(users_query(), q, filters)
+    except ValueError:
+        abort(400)
+    page = paginate(query, User.id)
+    return render_page('admin/users/users.html', page,
+                       title='Search Users',
+                       users=page.items,
+                       endpoint='admin.search_users',
+                       args=dict(filters, q=q))
 
 
 @admin.route('/users/edit/user-<int:id>', methods=['GET', 'POST'])
@@ -313,19 +389,22 @@ def edit_user(id):
     :return:
     """
     check_admin()
-    user = User.query.get_or_404(id)
+    user = users_query().get_or_404(id)
     form = UserForm(obj=user)
     if form.validate_on_submit():
-        user.email = form.email.data
-        user.name = form.name.data
-        user.first_name = form.first_name.data
-        user.last_name = form.last_name.data
-        user.is_admin = form.is_admin.data
-        user.is_valid = form.is_valid.data
-        user.is_blocked = form.is_blocked.data
+        changes = {}
+        for field in ('email', 'name', 'first_name', 'last_name',
+                      'is_admin', 'is_valid', 'is_blocked'):
+            value = getattr(form, field).data
+            if getattr(user, field) != value:
+                changes[field] = [getattr(user, field), value]
+                setattr(user, field, value)
         try:
             db.session.add(user)
             db.session.commit()
+            invalidate_user(user.id)
+            invalidate_fragments('groups', 'roles')
+            audit('edit', 'user', user.id, name=user.name, changes=changes)
             flash('Successfully edited the user: "%s".' % str(user.name))
         except:
             db.session.rollback()
@@ -353,25 +432,29 @@ def assign_user(id):
     :return:
     """
     check_admin()                                                           
-    user = User.query.get_or_404(id)
+    user = users_query().get_or_404(id)
     if user.is_admin:
         abort(403)
     form = UserForm(obj=user)
     # if form.validate_on_submit():
-    user.group = form.group.data
-    user.role = form.role.data
+    user.group_id = form.group.data
+    user.role_id = form.role.data
     try:
         db.session.add(user)
         db.session.commit()
+        invalidate_user(user.id)
+        invalidate_fragments('groups', 'roles')
+        audit('assign', 'user', user.id, group_id=user.group_id,
+              role_id=user.role_id)
         flash('Successfully assigned "%s" to "%s" as "%s".' % (str(user.name),
-                                                               str(user.group.name),
-                                                               str(user.role.name)))
+                                                               str(group_choices.label(user.group_id)),
+                                                               str(role_choices.label(user.role_id))))
     except:
         db.session.rollback()
         flash('Failed to assign group and role to: "%s".' % str(user.name))
     # return redirect(url_for('admin.users'))
-    form.group.data = user.group
-    form.role.data = user.role
+    form.group.data = user.group_id
+    form.role.data = user.role_id
     return render_template('admin/users/assign_user.html',
                            title='Assign User',
                            user=user,
@@ -393,8 +476,183 @@ def delete_user(id):
     try:
         db.session.delete(user)
         db.session.commit()
+        invalidate_user(id)
+        invalidate_fragments('groups', 'roles')
+        audit('delete', 'user', id, name=user.name)
         flash('Successfully deleted the user: "%s".' % str(user.name))
     except:
         db.session.rollback()
         flash('Failed to delete the user: "%s".' % str(user.name))
     return redirect(url_for('admin.users'))
+
+
+@admin.route('/users/import', methods=['GET', 'POST'])
+@signed_session
+def import_users():
+    """
+    Import users from a CSV or JSON file.
+    :return:
+    """
+    check_admin()
+    form = ImportForm()
+    if form.validate_on_submit():
+        upload = form.file.data
+        format = upload.filename.rsplit('.', 1)[-1].lower()
+        try:
+            rows = bulk.read_rows(upload.stream, format)
+            if current_app.config['JOBS_IMPORTS']:
+                id = enqueue('import_users', priority=10,
+                             path=tasks.save_upload(rows))
+                audit('import', 'user', job_id=id, count=len(rows))
+                flash('Queued the import of %d users.' % len(rows))
+                return redirect(url_for('admin.jobs'))
+            count = bulk.import_users(rows,
+                                      current_app.config['BULK_BATCH_SIZE'])
+            db.session.commit()
+            invalidate_fragments('groups', 'roles')
+            audit('import', 'user', count=count)
+            flash('Successfully imported %d users.' % count)
+        except bulk.BulkError as error:
+            db.session.rollback()
+            flash('Failed to import the users: %s' % error)
+        except:
+            db.session.rollback()
+            flash('Failed to import the users.')
+        return redirect(url_for('admin.users'))
+    return render_template('admin/users/import_users.html',
+                           title='Import Users',
+                           form=form)
+
+
+@admin.route('/users/export.<any(csv, json):format>')
+@signed_session
+def export_users(format):
+    """
+    Export all users as a streamed CSV or JSON file.
+    :param format:
+    :return:
+    """
+    check_admin()
+    chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
+    if format == 'csv':
+        rows, mimetype = bulk.export_csv(chunk_size), 'text/csv'
+    else:
+        rows, mimetype = bulk.export_json(chunk_size), 'application/json'
+    return Response(stream_with_context(rows),
+                    mimetype=mimetype,
+                    headers={'Content-Disposition':
+                             'attachment; filename=users.%s' % format})
+
+
+@admin.route('/users/batch', methods=['POST'])
+@signed_session
+def batch_users():
+    """
+    Assign, block, unblock, validate, invalidate or delete many users
+    at once, selected by ids or by a filter. Answers with the number of
+    affected users in JSON to JSON requests.
+    :return:
+    """
+    check_admin()
+    if request.is_json:
+        data = request.get_json()
+        ids = data.get('ids') or []
+        filters = data.get('filter') or {}
+        group_id = data.get('group_id')
+        role_id = data.get('role_id')
+    else:
+        data = request.form
+        ids = data.getlist('ids', type=int)
+        filters = dict((name, data[name]) for name in bulk.FILTERS
+                       if data.get(name))
+        group_id = data.get('group_id', type=int)
+        role_id = data.get('role_id', type=int)
+    action = data.get('action')
+    try:
+        count = bulk.apply_batch(action, ids, filters, group_id, role_id)
+        db.session.commit()
+        invalidate_users()
+        invalidate_fragments('groups', 'roles')
+        audit(action, 'user', count=count, ids=ids, filter=filters)
+    except bulk.BulkError as error:
+        db.session.rollback()
+        if request.is_json:
+            return jsonify(error=str(error)), 400
+        flash('Failed to %s the users: %s' % (action, error))
+        return redirect(url_for('admin.users'))
+    except:
+        db.session.rollback()
+        if request.is_json:
+            return jsonify(error='failed to %s the users.' % action), 500
+        flash('Failed to %s the users.' % action)
+        return redirect(url_for('admin.users'))
+    if request.is_json:
+        return jsonify(action=action, count=count)
+    flash('Successfully applied "%s" to %d users.' % (action, count))
+    return redirect(url_for('admin.users'))
+
+
+@admin.route('/jobs', methods=['GET', 'POST'])
+@signed_session
+def jobs():
+    """
+    List the last jobs, and queue an export or a cache warm.
+    :return:
+    """
+    check_admin()
+    store = current_app.extensions['jobs']
+    if request.method == 'POST':
+        name = request.form.get('name')
+        if name == 'export_users':
+            format = request.form.get('format', 'csv')
+            if format not in ('csv', 'json'):
+                abort(400)
+            id = enqueue(name, format=format)
+        elif name == 'warm_caches':
+            id = enqueue(name, key='warm_caches:%d' %
+                         (int(time.time()) // 60))
+        else:
+            abort(400)
+        flash('Queued the job %d.' % id)
+        return redirect(url_for('admin.jobs'))
+    recent = store.recent(current_app.config['PAGE_SIZE'])
+    return render_template('admin/jobs/jobs.html',
+                           title='Jobs',
+                           jobs=recent,
+                           counts=store.counts(),
+                           running=any(job['status'] not in (DONE, FAILED)
+                                       for job in recent))
+
+
+@admin.route('/jobs/job-<int:id>')
+@signed_session
+def job(id):
+    """
+    Answer the status and progress of a job in JSON, to be polled.
+    :param id:
+    :return:
+    """
+    check_admin()
+    row = current_app.extensions['jobs'].get(id)
+    if row is None:
+        abort(404)
+    return jsonify(dict((name, row[name]) for name in
+                        ('id', 'name', 'status', 'priority', 'attempts',
+                         'progress', 'message', 'result', 'error')))
+
+
+@admin.route('/jobs/job-<int:id>/download')
+@signed_session
+def download_job(id):
+    """
+    Send the file written by a finished export job.
+    :param id:
+    :return:
+    """
+    check_admin()
+    row = current_app.extensions['jobs'].get(id)
+    if row is None or row['name'] != 'export_users' or row['status'] != DONE:
+        abort(404)
+    format = row['result']['format']
+    return send_file(tasks.export_path(id, format), as_attachment=True,
+                     attachment_filename='users.%s' % format)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# app/api/resources.py
+
+from sqlalchemy.exc import IntegrityError
+
+from .. import db
+from ..admin.choices import group_choices, role_choices
+from ..fragments import invalidate_fragments
+from ..models import Group, Role, Tool, User, invalidate_users
+from ..passwords import hash_passwords
+
+
+class ApiError(ValueError):
+    """
+    Raised when an API request can not be answered.
+    """
+    def __init__(self, message, status=400):
+        super(ApiError, self).__init__(message)
+        self.status = status
+
+
+def is_id(value):
+    """
+    Tell if a JSON value is an id, an integer which is not a boolean.
+    :param value:
+    :return:
+    """
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+
+def _kind(column):
+    """
+    Return the JSON type of a writable field: the text fields, and the
+    password which is not a column, take strings, the flags booleans
+    and the foreign keys ids or null.
+    :param column:
+    :return:
+    """
+    if column is None or isinstance(column.type, db.String):
+        return 'a string'
+    if isinstance(column.type, db.Boolean):
+        return 'a boolean'
+    return 'an id or null'
+
+
+KINDS = {'a string': lambda value: isinstance(value, basestring),
+         'a boolean': lambda value: isinstance(value, bool),
+         'an id or null': lambda value: value is None or is_id(value)}
+
+
+class Resource(object):
+    """
+    A model exposed by the API: its readable fields, the fields that
+    can be written, the fields required to create a row, and what to
+    invalidate after a write.
+    """
+    def __init__(self, model, fields, writable, required, invalidate):
+        self.model = model
+        self.fields = fields
+        self.writable = writable
+        self.required = required
+        self.invalidate = invalidate
+        self.kinds = dict((field, _kind(model.__table__.c.get(field)))
+                          for field in writable)
+
+    def columns(self, fields=None):
+        """
+        Return the columns of the requested fields, always with the id
+        which is the pagination key.
+        :param fields:
+        :return:
+        """
+        if fields is None:
+            fields = self.fields
+        unknown = set(fields).difference(self.fields)
+        if unknown:
+            raise ApiError('unknown field "%s".' % sorted(unknown)[0])
+        if 'id' not in fields:
+            fields = ('id',) + tuple(fields)
+        return [getattr(self.model, field) for field in fields]
+
+    def query(self, fields=None):
+        """
+        Select the columns of the requested fields, without loading
+        model objects.
+        :param fields:
+        :return:
+        """
+        return db.session.query(*self.columns(fields))
+
+    def _values(self, item, create):
+        if not isinstance(item, dict):
+            raise ApiError('items must be objects.')
+        values = dict((field, value) for field, value in item.items()
+                      if field != 'id')
+        unknown = set(values).difference(self.writable)
+        if unknown:
+            raise ApiError('field "%s" can not be written.' %
+                           sorted(unknown)[0])
+        for field in sorted(values):
+            if not KINDS[self.kinds[field]](values[field]):
+                raise ApiError('field "%s" must be %s.' %
+                               (field, self.kinds[field]))
+        if create:
+            missing = [field for field in self.required if not values.get(field)]
+            if missing:
+                raise ApiError('field "%s" is required.' % missing[0])
+        return values
+
+    def _hash_passwords(self, mappings):
+        with_password = [values for values in mappings if 'password' in values]
+        hashes = hash_passwords([values.pop('password')
+                                 for values in with_password])
+        for values, password_hash in zip(with_password, hashes):
+            values['password_hash'] = password_hash
+
+    def _existing(self, ids):
+        model = self.model
+        found = set(id for id, in db.session.query(model.id)
+                    .filter(model.id.in_(ids)))
+        missing = set(ids).difference(found)
+        if missing:
+            raise ApiError('%s %d not found.' % (model.__tablename__[:-1],
+                                                 sorted(missing)[0]), 404)
+
+    def batch(self, create=(), update=(), delete=()):
+        """
+        Create, update and delete rows with bulk statements in one
+        transaction. Returns the ids of the created rows and the number
+        of updated and deleted rows.
+        :param create:
+        :param update:
+        :param delete:
+        :return:
+        """
+        model = self.model
+        created = [self._values(item, True) for item in create]
+        updated = []
+        for item in update:
+            values = self._values(item, False)
+            if not is_id(item.get('id')):
+                raise ApiError('updated items need an id.')
+            values['id'] = item['id']
+            updated.append(values)
+        if not all(is_id(id) for id in delete):
+            raise ApiError('deleted ids must be integers.')
+        self._hash_passwords(created)
+        self._hash_passwords(updated)
+        try:
+            self._existing([values['id'] for values in updated] +
+                           list(delete))
+            if delete:
+                self.before_delete(delete)
+                db.session.query(model).filter(model.id.in_(delete)) \
+                    .delete(synchronize_session=False)
+            if updated:
+                db.session.bulk_update_mappings(model, updated)
+            if created:
+                db.session.bulk_insert_mappings(model, created,
+                                                return_defaults=True)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            raise ApiError('the batch conflicts with existing rows.', 409)
+        except:
+            db.session.rollback()
+            raise
+        if created or updated or delete:
+            self.invalidate()
+        return {'created': [values['id'] for values in created],
+                'updated': len(updated),
+                'deleted': len(delete)}
+
+    def before_delete(self, ids):
+        """
+        Check or prepare the deletion of rows.
+        :param ids:
+        :return:
+        """
+
+
+class UserResource(Resource):
+    def before_delete(self, ids):
+        if db.session.query(User.id).filter(User.id.in_(ids),
+                                            User.is_admin == True).first():
+            raise ApiError('admins can not be deleted.', 403)
+
+
+class MembershipResource(Resource):
+    """
+    Groups and roles: their users are unassigned before they are deleted.
+    """
+    def __init__(self, model, foreign_key, *args):
+        super(MembershipResource, self).__init__(model, *args)
+        self.foreign_key = foreign_key
+
+    def before_delete(self, ids):
+        db.session.query(User).filter(self.foreign_key.in_(ids)) \
+            .update({self.foreign_key.key: None}, synchronize_session=False)
+
+
+def _users_changed():
+    invalidate_users()
+    invalidate_fragments('groups', 'roles')
+
+
+def _groups_changed():
+    group_choices.invalidate()
+    invalidate_fragments('groups')
+    invalidate_users()
+
+
+def _roles_changed():
+    role_choices.invalidate()
+    invalidate_fragments('roles')
+    invalidate_users()
+
+
+def _tools_changed():
+    invalidate_fragments('tools')
+
+
+USER_FIELDS = ('id', 'email', 'name', 'first_name', 'last_name', 'group_id',
+               'role_id', 'is_admin', 'is_valid', 'is_blocked')
+NAMED_FIELDS = ('id', 'name', 'description')
+
+RESOURCES = {
+    'users': UserResource(User, USER_FIELDS,
+                          USER_FIELDS[1:] + ('password',),
+                          ('email', 'name', 'password'),
+                          _users_changed),
+    'groups': MembershipResource(Group, User.group_id, NAMED_FIELDS,
+                                 NAMED_FIELDS[1:], ('name',), _groups_changed),
+    'roles': MembershipResource(Role, User.role_id, NAMED_FIELDS,
+                                NAMED_FIELDS[1:], ('name',), _roles_changed),
+    'tools': Resource(Tool, NAMED_FIELDS, NAMED_FIELDS[1:], ('name',),
+                      _tools_changed),
+}
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# app/api/tokens.py
+
+import binascii
+import os
+
+from flask import current_app
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from .. import cache, db, lm
+from ..models import User, UserSnapshot
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'],
+                                  salt='api-token')
+
+
+def user_generation(user_id):
+    """
+    Return the generations of the users and of an user in the shared
+    cache, which change whenever the user is edited, read at once.
+    :param user_id:
+    :return:
+    """
+    return list(cache.generations('users', 'user:%d' % user_id))
+
+
+def _tokens(user_id):
+    return 'tokens:%d' % user_id
+
+
+def issue_token(user):
+    """
+    Sign a token carrying the session fields of an user, the
+    generations they were read at and the revocation counter of the
+    user. The token is remembered by the shared cache, which lets it
+    be verified without the database until the user is edited.
+    :param user:
+    :return:
+    """
+    token_id = binascii.hexlify(os.urandom(8))
+    cache.set(_tokens(user.id), token_id, user.token_generation,
+              current_app.config['API_TOKEN_TTL'])
+    return _serializer().dumps({'id': user.id,
+                                'tid': token_id,
+                                'name': user.name,
+                                'admin': bool(user.is_admin),
+                                'valid': bool(user.is_valid),
+                                'group': user.group_id,
+                                'role': user.role_id,
+                                'gen': user_generation(user.id),
+                                'rev': user.token_generation})
+
+
+def revoke_tokens(user_id):
+    """
+    Revoke all the tokens issued to an user: its revocation counter
+    is incremented in the database and the tokens are forgotten by
+    the cache.
+    :param user_id:
+    :return:
+    """
+    User.query.filter_by(id=user_id).update(
+        {User.token_generation: User.token_generation + 1},
+        synchronize_session=False)
+    db.session.commit()
+    cache.bump(_tokens(user_id))
+
+
+def verify_token(token):
+    """
+    Return the user of a token, or None when it is invalid, expired
+    or revoked. The user is built from the token while the cache
+    still remembers it and the user has not been edited since it was
+    issued. Otherwise the user is read from the database, so a lost
+    cache never revives a revoked token or a blocked user.
+    :param token:
+    :return:
+    """
+    try:
+        claims = _serializer().loads(
+            token, max_age=current_app.config['API_TOKEN_TTL'])
+        user_id = int(claims['id'])
+        revision = claims['rev']
+    except (BadSignature, KeyError, TypeError, ValueError):
+        return None
+    if claims.get('gen') == user_generation(user_id) and \
+            cache.get(_tokens(user_id), claims.get('tid')) == revision:
+        return UserSnapshot(user_id, claims['name'], claims['admin'],
+                            claims['valid'], False, claims['group'],
+                            claims['role'])
+    user = User.query.get(user_id)
+    if user is None or user.is_blocked or user.token_generation != revision:
+        return None
+    return UserSnapshot.from_user(user)
+
+
+@lm.request_loader
+def load_token_user(request):
+    """
+    Sign in the API requests carrying an ``Authorization: Bearer``
+    token, without a session.
+    :param request:
+    :return:
+    """
+    if request.blueprint != 'api':
+        return None
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    return verify_token(token.strip())
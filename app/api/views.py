@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# app/api/views.py
+
+from flask import abort, current_app, jsonify, request, session
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException, InternalServerError
+
+from . import api
+from .resources import RESOURCES, ApiError
+from .tokens import issue_token, revoke_tokens
+from .. import cp, passwords
+from ..audit import audit
+from ..metrics import inc
+from ..models import User
+from ..pagination import paginate
+from ..replicas import use_replica
+
+
+@api.errorhandler(ApiError)
+def api_error(error):
+    return jsonify(error=str(error)), error.status
+
+
+@api.errorhandler(HTTPException)
+@api.errorhandler(403)
+@api.errorhandler(404)
+@api.errorhandler(500)
+def http_error(error):
+    """
+    Answer JSON errors, the status codes with an HTML page of the
+    application are registered too as they are looked up first.
+    :param error:
+    :return:
+    """
+    if not isinstance(error, HTTPException):
+        error = InternalServerError()
+    return jsonify(error=error.description), error.code
+
+
+@api.errorhandler(passwords.PoolBusy)
+def service_unavailable(error):
+    headers = {'Retry-After':
+               str(current_app.config['PASSWORD_POOL_RETRY_AFTER'])}
+    return jsonify(error='the server is busy.'), 503, headers
+
+
+@api.before_request
+def check_admin():
+    """
+    Answer the API to signed in admins only, with JSON errors
+    instead of the redirects of the HTML views. The blueprint is exempt
+    from CSRF for the token clients, the requests signed in by a
+    session cookie are still checked.
+    :return:
+    """
+    if request.endpoint == 'api.issue':
+        return
+    if not current_user.is_authenticated:
+        abort(401)
+    if '_user_id' in session and current_app.config['WTF_CSRF_ENABLED']:
+        cp.protect()
+    if not current_user.is_valid and not current_user.is_admin:
+        abort(403)
+
+
+@api.route('/tokens', methods=['POST'])
+def issue():
+    """
+    Exchange the ``{"email": ..., "password": ...}`` of an user for
+    a bearer token, with the limits of the sign in form.
+    :return:
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or \
+            not isinstance(data.get('email'), basestring) or \
+            not isinstance(data.get('password'), basestring) or \
+            not data['email'] or not data['password']:
+        raise ApiError('an email and a password are required.')
+    email = data['email']
+    throttle = current_app.extensions['login_throttle']
+    if throttle.is_limited(email, request.remote_addr):
+        inc('login_attempts_total', result='throttled')
+        headers = {'Retry-After': str(throttle.window)}
+        return jsonify(error='too many failed attempts.'), 429, headers
+    user = User.query.filter_by(email=email).first()
+    if user is None or not user.verify_password(data['password']):
+        throttle.failed(email, request.remote_addr)
+        inc('login_attempts_total', result='failure')
+        raise ApiError('invalid email or password.', 401)
+    if user.is_blocked:
+        throttle.failed(email, request.remote_addr)
+        inc('login_attempts_total', result='blocked')
+        raise ApiError('this account is blocked.', 403)
+    throttle.succeeded(email)
+    inc('login_attempts_total', result='success')
+    return jsonify(token=issue_token(user),
+                   expires_in=current_app.config['API_TOKEN_TTL'])
+
+
+@api.route('/tokens/revoke', methods=['POST'])
+def revoke():
+    """
+    Revoke all the tokens of the signed in user.
+    :return:
+    """
+    revoke_tokens(current_user.id)
+    return jsonify(revoked=True)
+
+
+def get_resource(name):
+    """
+    Return the resource of a model or answer 404.
+    :param name:
+    :return:
+    """
+    resource = RESOURCES.get(name)
+    if resource is None:
+        abort(404)
+    return resource
+
+
+def requested_fields():
+    """
+    Read the sparse fieldset of ``?fields=id,name``.
+    :return:
+    """
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return tuple(field.strip() for field in fields.split(',') if field.strip())
+
+
+@api.route('/<name>')
+@use_replica
+def index(name):
+    """
+    List the rows of a model one keyset page at a time, selecting
+    only the columns of the requested fields.
+    :param name:
+    :return:
+    """
+    resource = get_resource(name)
+    fields = requested_fields()
+    page = paginate(resource.query(fields), resource.model.id, stream=False)
+    if fields is not None and 'id' not in fields:
+        items = [dict(zip(fields, row[1:])) for row in page.items]
+    else:
+        items = [row._asdict() for row in page.items]
+    return jsonify(data=items,
+                   next_cursor=page.next_cursor,
+                   prev_cursor=page.prev_cursor)
+
+
+@api.route('/<name>/<int:id>')
+@use_replica
+def show(name, id):
+    """
+    Return one row of a model.
+    :param name:
+    :param id:
+    :return:
+    """
+    resource = get_resource(name)
+    fields = requested_fields()
+    row = resource.query(fields).filter(resource.model.id == id).first()
+    if row is None:
+        abort(404)
+    item = row._asdict()
+    if fields is not None and 'id' not in fields:
+        del item['id']
+    return jsonify(data=item)
+
+
+@api.route('/<name>/batch', methods=['POST'])
+def batch(name):
+    """
+    Create, update and delete rows of a model in one transaction from
+    ``{"create": [{...}], "update": [{"id": 1, ...}], "delete": [2]}``.
+    :param name:
+    :return:
+    """
+    resource = get_resource(name)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ApiError('the body must be a JSON object.')
+    operations = dict((key, data.get(key) or [])
+                      for key in ('create', 'update', 'delete'))
+    if not all(isinstance(items, list) for items in operations.values()):
+        raise ApiError('create, update and delete must be lists.')
+    if sum(len(items) for items in operations.values()) > \
+            current_app.config['API_BATCH_MAX']:
+        raise ApiError('a batch can hold up to %d operations.' %
+                       current_app.config['API_BATCH_MAX'], 413)
+    result = resource.batch(**operations)
+    audit('batch', name[:-1], created=result['created'],
+          updated=[item['id'] for item in operations['update']],
+          deleted=operations['delete'])
+    return jsonify(result)
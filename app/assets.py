@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# app/assets.py
+
+import gzip
+import hashlib
+import io
+import mimetypes
+import os
+
+from flask import abort, current_app, request, send_from_directory
+from werkzeug.security import safe_join
+
+from .cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.ico')
+
+
+def static_hash(app, filename):
+    """
+    Return the short content hash of a static file, kept in a bounded
+    cache of the process with the modification time of the file, or None
+    if it is missing or outside of the static folder.
+    :param app:
+    :param filename:
+    :return:
+    """
+    path = safe_join(app.static_folder, filename)
+    if path is None:
+        return None
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    hashes = app.extensions['static_hashes']
+    cached = hashes.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:12]
+    hashes.set(filename, (mtime, digest))
+    return digest
+
+
+def fingerprint(endpoint, values):
+    """
+    Add the content hash of static files to their URLs.
+    :param endpoint:
+    :param values:
+    :return:
+    """
+    if endpoint == 'static' and 'v' not in values and \
+            current_app.config['STATIC_FINGERPRINT']:
+        digest = static_hash(current_app, values.get('filename', ''))
+        if digest is not None:
+            values['v'] = digest
+
+
+def send_static(filename):
+    """
+    Send a static file, or its precompressed variant accepted by the
+    client. Fingerprinted URLs never change, so they are cached for
+    STATIC_MAX_AGE seconds without revalidation.
+    :param filename:
+    :return:
+    """
+    app = current_app._get_current_object()
+    path = safe_join(app.static_folder, filename)
+    if path is None:
+        abort(404)
+    version = request.args.get('v')
+    immutable = version is not None and \
+        version == static_hash(app, filename)
+    if immutable:
+        cache_timeout = app.config['STATIC_MAX_AGE']
+    else:
+        cache_timeout = app.get_send_file_max_age(filename)
+    for encoding, suffix in ENCODINGS:
+        if encoding in request.accept_encodings and \
+                os.path.isfile(path + suffix):
+            mimetype = mimetypes.guess_type(filename)[0] or \
+                'application/octet-stream'
+            response = send_from_directory(app.static_folder,
+                                           filename + suffix,
+                                           cache_timeout=cache_timeout,
+                                           mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(app.static_folder, filename,
+                                       cache_timeout=cache_timeout)
+    response.vary.add('Accept-Encoding')
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+
+def gzip_bytes(data, level):
+    """
+    Compress bytes with gzip, without a timestamp so that the output
+    only depends on the input.
+    :param data:
+    :param level:
+    :return:
+    """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=level,
+                       mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def compress_static(app):
+    """
+    Write the gzip, and brotli when installed, variants of the
+    compressible static files next to them. Returns the written files.
+    :param app:
+    :return:
+    """
+    written = []
+    for root, dirs, files in os.walk(app.static_folder):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            variants = [('.gz', gzip_bytes(data, 9))]
+            if brotli is not None:
+                variants.append(('.br', brotli.compress(data)))
+            for suffix, compressed in variants:
+                if len(compressed) >= len(data):
+                    continue
+                with open(path + suffix, 'wb') as f:
+                    f.write(compressed)
+                written.append(path + suffix)
+    return written
+
+
+def compress_response(response):
+    """
+    Compress HTML responses with gzip when the client accepts it
+    and they are larger than COMPRESS_MIN_SIZE.
+    :param response:
+    :return:
+    """
+    config = current_app.config
+    if not config['COMPRESS_HTML'] or response.status_code != 200 or \
+            response.mimetype != 'text/html' or response.is_streamed or \
+            response.direct_passthrough or \
+            'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.accept_encodings:
+        return response
+    data = response.get_data()
+    if len(data) < config['COMPRESS_MIN_SIZE']:
+        return response
+    response.set_data(gzip_bytes(data, config['COMPRESS_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    """
+    Fingerprint the static URLs, serve the precompressed static files
+    and compress the HTML responses.
+    :param app:
+    :return:
+    """
+    app.extensions['static_hashes'] = LRUCache(
+        app.config['STATIC_HASH_CACHE_SIZE'], app.config['STATIC_MAX_AGE'])
+    app.url_defaults(fingerprint)
+    if app.has_static_folder:
+        app.view_functions['static'] = send_static
+    app.after_request(compress_response)
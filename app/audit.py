@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# app/audit.py
+
+import atexit
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from flask import current_app
+from flask_login import current_user
+
+
+class _Flush(object):
+    """
+    Marker asking the writer to write what it holds and to signal it.
+    """
+    def __init__(self, stop=False):
+        self.stop = stop
+        self.done = threading.Event()
+
+
+class AuditWriter(object):
+    """
+    Background thread writing the audit events of the process.
+
+    The request threads only put the events on a bounded queue, the
+    writer inserts them with one executemany INSERT per batch of
+    ``batch_size`` events or every ``interval`` seconds, on its own
+    connection. Events are dropped and counted when the queue is full
+    instead of slowing the requests down. The written, dropped and
+    failed events are counted by the writer and by the
+    ``audit_events_*_total`` counters of the metrics.
+    """
+    def __init__(self, app, queue_size=10000, batch_size=100, interval=1.0):
+        self.app = app
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _start(self):
+        """
+        Start the writer thread, again after a fork
+        since threads do not survive it.
+        :return:
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._work,
+                                            name='audit-writer')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _count(self, name, value):
+        """
+        Add to a count of events and to its metrics counter.
+        :param name:
+        :param value:
+        :return:
+        """
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+        metrics = self.app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.registry.inc('audit_events_%s_total' % name, (), value)
+
+    def _work(self):
+        events = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else \
+                max(0, deadline - time.time())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if isinstance(item, _Flush):
+                self._write(events)
+                events, deadline = [], None
+                item.done.set()
+                if item.stop:
+                    return
+                continue
+            if item is not None:
+                events.append(item)
+                if deadline is None:
+                    deadline = time.time() + self.interval
+            if len(events) >= self.batch_size or \
+                    (deadline is not None and time.time() >= deadline):
+                self._write(events)
+                events, deadline = [], None
+
+    def _write(self, events):
+        """
+        Insert a batch of events.
+        :param events:
+        :return:
+        """
+        if not events:
+            return
+        from .models import AuditEvent
+        db = self.app.extensions['sqlalchemy'].db
+        try:
+            with db.get_engine(self.app).begin() as connection:
+                connection.execute(AuditEvent.__table__.insert(), events)
+            self._count('written', len(events))
+        except Exception:
+            self._count('failed', len(events))
+            self.app.logger.exception('Failed to write %d audit events.',
+                                      len(events))
+
+    def record(self, event):
+        """
+        Queue an event without waiting.
+        :param event:
+        :return:
+        """
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._count('dropped', 1)
+
+    def flush(self, timeout=10.0, stop=False):
+        """
+        Wait until the queued events are written, and stop the writer
+        when asked to. Returns False if the writer did not answer.
+        :param timeout:
+        :param stop:
+        :return:
+        """
+        if self._thread is None or self._pid != os.getpid() or \
+                not self._thread.is_alive():
+            return True
+        marker = _Flush(stop)
+        try:
+            self._queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.done.wait(timeout)
+
+    def close(self):
+        """
+        Write the remaining events and stop the writer at shutdown.
+        :return:
+        """
+        self.flush(stop=True)
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+
+def audit(action, target, target_id=None, **details):
+    """
+    Record an admin write of the current user, after its commit.
+    :param action:
+    :param target:
+    :param target_id:
+    :param details:
+    :return:
+    """
+    writer = current_app.extensions.get('audit')
+    if writer is None:
+        return
+    writer.record({'created_at': datetime.utcnow(),
+                   'user_id': current_user.id
+                   if current_user.is_authenticated else None,
+                   'action': action,
+                   'target': target,
+                   'target_id': target_id,
+                   'details': json.dumps(details, sort_keys=True)
+                   if details else None})
+
+
+def _audit_gauges(registry):
+    """
+    Set the queue depth gauge of the audit writer of the application.
+    :param registry:
+    :return:
+    """
+    registry.set('audit_queue_depth', (),
+                 current_app.extensions['audit'].depth)
+
+
+def init_app(app):
+    """
+    Start recording the admin writes when AUDIT is set, the events
+    left in the queue are written when the process exits.
+    :param app:
+    :return:
+    """
+    if not app.config['AUDIT']:
+        return
+    writer = AuditWriter(app,
+                         app.config['AUDIT_QUEUE_SIZE'],
+                         app.config['AUDIT_BATCH_SIZE'],
+                         app.config['AUDIT_FLUSH_INTERVAL'])
+    app.extensions['audit'] = writer
+    atexit.register(writer.close)
+    metrics = app.extensions.get('metrics')
+    if metrics is not None:
+        metrics.collectors.append(_audit_gauges)
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 # app/auth/views.py
 
-from flask import flash, redirect, render_template, url_for
+from flask import current_app, flash, redirect, render_template, request, url_for
 from flask_login import login_required as signed_session
 from flask_login import login_user as signin_user
 from flask_login import logout_user as signout_user
@@ -9,6 +9,7 @@ from flask_login import logout_user as signout_user
 from . import auth
 from forms import SignInForm, SignUpForm
 from .. import db
+from ..metrics import inc
 from ..models import User
 
 
@@ -47,15 +48,38 @@ def signin():
     """
     form = SignInForm()
     if form.validate_on_submit():
+        throttle = current_app.extensions['login_throttle']
+        if throttle.is_limited(form.email.data, request.remote_addr):
+            flash('Too many failed sign in attempts, please try again later.')
+            inc('login_attempts_total', result='throttled')
+            headers = {'Retry-After': str(throttle.window)}
+            return render_template('auth/signin.html',
+                                   title='Sign In',
+                                   form=form), 429, headers
         user = User.query.filter_by(email=form.email.data).first()
-        if user is not None and user.verify_password(form.password.data):
+        if user is None or not user.verify_password(form.password.data):
+            throttle.failed(form.email.data, request.remote_addr)
+            inc('login_attempts_total', result='failure')
+            flash('Invalid email or password.')
+        elif user.is_blocked:
+            throttle.failed(form.email.data, request.remote_addr)
+            inc('login_attempts_total', result='blocked')
+            flash('This account is blocked.')
+        else:
+            throttle.succeeded(form.email.data)
+            inc('login_attempts_total', result='success')
+            if user.needs_rehash():
+                user.password = form.password.data
+                try:
+                    db.session.add(user)
+                    db.session.commit()
+                except:
+                    db.session.rollback()
             signin_user(user)
             if user.is_admin:
                 return redirect(url_for('home.admin'))
             else:
                 return redirect(url_for('home.start'))
-        else:
-            flash('Invalid email or password.')
     return render_template('auth/signin.html',
                            title='Sign In',
                            form=form)
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+# app/cache.py
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from flask import current_app
+
+
+class LRUCache(object):
+    """
+    Thread safe, per-process, least recently used cache
+    whose entries expire after ``ttl`` seconds.
+    """
+    def __init__(self, maxsize=1024, ttl=60, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the value of a key and mark it as recently used.
+        :param key:
+        :param default:
+        :return:
+        """
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires <= self._timer():
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store the value of a key, evicting the least recently used
+        keys when the cache is full.
+        :param key:
+        :param value:
+        :param ttl:
+        :return:
+        """
+        if self.maxsize <= 0:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (self._timer() + ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        Remove a key from the cache.
+        :param key:
+        :return:
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all keys from the cache.
+        :return:
+        """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        Return the cache counters.
+        :return:
+        """
+        return {'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MemoryBackend(object):
+    """
+    Cache backend local to the process.
+    """
+    def __init__(self, maxsize=10000, ttl=300):
+        self._entries = LRUCache(maxsize, ttl)
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._entries.set(key, value, ttl)
+
+    def delete(self, key):
+        self._entries.delete(key)
+
+    def generation(self, name):
+        return self._generations.get(name, 0)
+
+    def generations(self, names):
+        return [self._generations.get(name, 0) for name in names]
+
+    def bump(self, name):
+        with self._lock:
+            value = self._generations.get(name, 0) + 1
+            self._generations[name] = value
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        with self._lock:
+            self._generations.clear()
+
+
+class SQLiteFile(object):
+    """
+    SQLite database file shared by the processes of an host,
+    with one autocommit connection per thread.
+    """
+    SCHEMA = ()
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        connection = self._connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+
+    def _connect(self):
+        """
+        Return the connection of the current thread, a new one is opened
+        after a fork since SQLite connections must not cross processes.
+        :return:
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                         isolation_level=None)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+
+class SQLiteBackend(SQLiteFile):
+    """
+    Cache backend shared by all the processes of an host
+    through a SQLite database file.
+    """
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS cache_entries '
+              '(key TEXT PRIMARY KEY, value BLOB, expires REAL)',
+              'CREATE TABLE IF NOT EXISTS cache_generations '
+              '(name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, ttl=300, timeout=5.0):
+        super(SQLiteBackend, self).__init__(path, timeout)
+        self.ttl = ttl
+        self._writes = 0
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT value, expires FROM cache_entries WHERE key = ?',
+            (key,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return pickle.loads(bytes(row[0]))
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        value = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        connection = self._connect()
+        connection.execute('INSERT OR REPLACE INTO cache_entries '
+                           '(key, value, expires) VALUES (?, ?, ?)',
+                           (key, value, time.time() + ttl))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            connection.execute('DELETE FROM cache_entries WHERE expires <= ?',
+                               (time.time(),))
+
+    def delete(self, key):
+        self._connect().execute('DELETE FROM cache_entries WHERE key = ?',
+                                (key,))
+
+    def generation(self, name):
+        row = self._connect().execute(
+            'SELECT value FROM cache_generations WHERE name = ?',
+            (name,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def generations(self, names):
+        rows = dict(self._connect().execute(
+            'SELECT name, value FROM cache_generations WHERE name IN (%s)' %
+            ', '.join('?' * len(names)), names))
+        return [rows.get(name, 0) for name in names]
+
+    def bump(self, name):
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('INSERT OR IGNORE INTO cache_generations '
+                               '(name, value) VALUES (?, 0)', (name,))
+            connection.execute('UPDATE cache_generations SET value = value + 1 '
+                               'WHERE name = ?', (name,))
+            value = connection.execute(
+                'SELECT value FROM cache_generations WHERE name = ?',
+                (name,)).fetchone()[0]
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        return value
+
+    def clear(self):
+        connection = self._connect()
+        connection.execute('DELETE FROM cache_entries')
+        connection.execute('DELETE FROM cache_generations')
+
+
+def instance_file(app, path, default):
+    """
+    Return a configured file path, or a default file in the instance folder.
+    :param app:
+    :param path:
+    :param default:
+    :return:
+    """
+    if path is not None:
+        return path
+    if not os.path.isdir(app.instance_path):
+        os.makedirs(app.instance_path)
+    return os.path.join(app.instance_path, default)
+
+
+class Cache(object):
+    """
+    Application cache whose entries are grouped in namespaces.
+
+    Every namespace has a generation counter stored in the backend and
+    the generation is part of the keys of its entries, so bumping the
+    generation of a namespace after a write invalidates its entries in
+    every worker sharing the backend.
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Create the backend configured by CACHE_BACKEND.
+        :param app:
+        :return:
+        """
+        backend = app.config['CACHE_BACKEND']
+        ttl = app.config['CACHE_DEFAULT_TTL']
+        if backend == 'memory':
+            app.extensions['cache'] = MemoryBackend(app.config['CACHE_SIZE'],
+                                                    ttl)
+        elif backend == 'sqlite':
+            path = instance_file(app, app.config['CACHE_PATH'],
+                                 'cache.sqlite')
+            app.extensions['cache'] = SQLiteBackend(path, ttl)
+        else:
+            raise ValueError('Unknown cache backend: "%s".' % backend)
+
+    @property
+    def backend(self):
+        return current_app.extensions['cache']
+
+    def generation(self, namespace):
+        """
+        Return the current generation of a namespace.
+        :param namespace:
+        :return:
+        """
+        return self.backend.generation(namespace)
+
+    def generations(self, *namespaces):
+        """
+        Return the current generations of namespaces, in one read of
+        the backend.
+        :param namespaces:
+        :return:
+        """
+        return tuple(self.backend.generations(namespaces))
+
+    def bump(self, namespace):
+        """
+        Invalidate all the entries of a namespace.
+        :param namespace:
+        :return:
+        """
+        return self.backend.bump(namespace)
+
+    def _key(self, namespace, key):
+        return '%s:%d:%s' % (namespace, self.generation(namespace), key)
+
+    def get(self, namespace, key):
+        """
+        Return the value of a key of a namespace or None.
+        :param namespace:
+        :param key:
+        :return:
+        """
+        return self.backend.get(self._key(namespace, key))
+
+    def set(self, namespace, key, value, ttl=None):
+        """
+        Store the value of a key of a namespace.
+        :param namespace:
+        :param key:
+        :param value:
+        :param ttl:
+        :return:
+        """
+        self.backend.set(self._key(namespace, key), value, ttl)
+
+    def delete(self, namespace, key):
+        """
+        Remove a key of a namespace.
+        :param namespace:
+        :param key:
+        :return:
+        """
+        self.backend.delete(self._key(namespace, key))
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# app/commands.py
+
+import json
+import multiprocessing
+
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+
+from .assets import compress_static
+from .jobs import Worker
+from .templating import compile_templates
+
+jobs_cli = AppGroup('jobs', help='Manage the background jobs.')
+replicas_cli = AppGroup('replicas', help='Manage the read replicas.')
+search_cli = AppGroup('search', help='Manage the users full text index.')
+static_cli = AppGroup('static', help='Manage the static files.')
+templates_cli = AppGroup('templates', help='Manage the templates.')
+
+
+@templates_cli.command('compile')
+@with_appcontext
+def compile_command():
+    """
+    Compile the templates into the bytecode cache.
+    """
+    if current_app.jinja_env.bytecode_cache is None:
+        raise click.ClickException('TEMPLATE_CACHE is disabled.')
+    names = compile_templates(current_app)
+    click.echo('Compiled %d templates.' % len(names))
+
+
+@search_cli.command('install')
+@with_appcontext
+def install_search_command():
+    """
+    Create the SQLite full text index of the users.
+    """
+    from . import db
+    from .admin.search import install_fts
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('The full text index needs SQLite.')
+    install_fts(db.engine)
+    click.echo('Installed the full text index.')
+
+
+@search_cli.command('uninstall')
+@with_appcontext
+def uninstall_search_command():
+    """
+    Drop the SQLite full text index of the users.
+    """
+    from . import db
+    from .admin.search import uninstall_fts
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('The full text index needs SQLite.')
+    uninstall_fts(db.engine)
+    click.echo('Uninstalled the full text index.')
+
+
+@static_cli.command('compress')
+@with_appcontext
+def compress_command():
+    """
+    Write the precompressed variants of the static files.
+    """
+    written = compress_static(current_app)
+    click.echo('Compressed %d files.' % len(written))
+
+
+@replicas_cli.command('sync')
+@with_appcontext
+def sync_command():
+    """
+    Copy the primary SQLite database to the SQLite replicas.
+    """
+    from .replicas import sync_replica
+    for bind in current_app.config['DATABASE_READ_BINDS']:
+        try:
+            count = sync_replica(bind)
+        except ValueError as error:
+            raise click.ClickException(str(error))
+        click.echo('Synced %d tables to "%s".' % (count, bind))
+
+
+@jobs_cli.command('worker')
+@click.option('--processes', default=1, help='Worker processes to start.')
+@click.option('--once', is_flag=True,
+              help='Exit once the queue is empty.')
+@with_appcontext
+def worker_command(processes, once):
+    """
+    Run the queued jobs.
+    """
+    app = current_app._get_current_object()
+    store = app.extensions['jobs']
+    poll = app.config['JOBS_POLL']
+    if processes == 1:
+        Worker(app, store, poll).run(once)
+        return
+    app.extensions['sqlalchemy'].db.engine.dispose()
+    workers = [multiprocessing.Process(target=Worker(app, store, poll).run,
+                                       args=(once,))
+               for _ in range(processes)]
+    for process in workers:
+        process.start()
+    try:
+        for process in workers:
+            process.join()
+    except KeyboardInterrupt:
+        for process in workers:
+            process.terminate()
+            process.join()
+
+
+@jobs_cli.command('enqueue')
+@click.argument('name')
+@click.option('--args', default='{}', help='Arguments of the task in JSON.')
+@click.option('--priority', default=0, help='Higher runs first.')
+@click.option('--key', default=None, help='Idempotency key.')
+@with_appcontext
+def enqueue_command(name, args, priority, key):
+    """
+    Queue a job.
+    """
+    try:
+        id = current_app.extensions['jobs'].enqueue(name, json.loads(args),
+                                                    priority, key)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    click.echo('Queued the job %d.' % id)
+
+
+def init_app(app):
+    """
+    Register the commands of the application.
+    :param app:
+    :return:
+    """
+    app.cli.add_command(jobs_cli)
+    app.cli.add_command(replicas_cli)
+    app.cli.add_command(search_cli)
+    app.cli.add_command(static_cli)
+    app.cli.add_command(templates_cli)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# app/conditional.py
+
+import hashlib
+import os
+import time
+from datetime import datetime
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+
+from . import cache, db
+from .fragments import fragment_namespace
+from .replicas import on_replica, primary
+
+
+def templates_version(app):
+    """
+    Return a token of the templates of the application, computed once
+    from their modification times, so a deploy changes the ETags.
+    :param app:
+    :return:
+    """
+    version = app.extensions.get('templates_version')
+    if version is None:
+        mtimes = []
+        for root, dirs, files in os.walk(os.path.join(app.root_path,
+                                                      app.template_folder)):
+            mtimes.extend(os.path.getmtime(os.path.join(root, name))
+                          for name in files)
+        version = '%d' % max(mtimes or [0])
+        app.extensions['templates_version'] = version
+    return version
+
+
+def table_version(model, name):
+    """
+    Return the version of a table: the generation of its fragments,
+    bumped by the admin write views, and its row count and max id,
+    read from the primary with a single aggregate query.
+    :param model:
+    :param name:
+    :return:
+    """
+    with primary():
+        count, max_id = db.session.query(db.func.count(model.id),
+                                         db.func.max(model.id)).one()
+    return '%d-%d-%d' % (cache.generation(fragment_namespace(name)),
+                         count, max_id or 0)
+
+
+def _last_modified(etag, fill=True):
+    """
+    Return the time an ETag was first answered, rounded to the second,
+    or None for an ETag never answered when fill is not set.
+    :param etag:
+    :param fill:
+    :return:
+    """
+    modified = cache.get('etags', etag)
+    if modified is None:
+        if not fill:
+            return None
+        modified = int(time.time())
+        cache.set('etags', etag, modified,
+                  current_app.config['CONDITIONAL_GET_TTL'])
+    return datetime.utcfromtimestamp(modified)
+
+
+def conditional(model=None, name=None, authorize=None):
+    """
+    Answer GET requests of a view with 304 Not Modified, without running
+    it, while the page the client has is still current.
+
+    The ETag is made of the version of the table of the view, of the
+    signed in user and of its cache generation, of the templates and of
+    the URL. Pages with pending flashed messages are never cached, nor
+    are the pages rendered from a replica, which may lag behind the
+    version of the table. ``authorize`` is called before anything else,
+    so the clients which may not see the page are refused before they
+    are told it is current.
+    :param model:
+    :param name:
+    :param authorize:
+    :return:
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if authorize is not None:
+                authorize()
+            if not current_app.config['CONDITIONAL_GET'] or \
+                    request.method not in ('GET', 'HEAD') or \
+                    session.get('_flashes'):
+                return view(*args, **kwargs)
+            parts = [templates_version(current_app), request.full_path]
+            if current_user.is_authenticated:
+                id = int(current_user.get_id())
+                parts.append('%d-%d-%d' % (id, cache.generation('users'),
+                                           cache.generation('user:%d' % id)))
+            if model is not None:
+                parts.append(table_version(model, name))
+            etag = hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+            replica = on_replica()
+            modified = _last_modified(etag, fill=not replica)
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = (modified is not None and
+                                request.if_modified_since is not None and
+                                modified <= request.if_modified_since)
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if replica:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# app/database.py
+
+import threading
+import time
+
+import sqlalchemy
+from flask import current_app, g, has_request_context, session
+from flask_sqlalchemy import SignallingSession, get_state
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+# Called with the seconds waited by every pool checkout.
+checkout_listeners = []
+
+POOL_OPTIONS = (('pool_size', 'DATABASE_POOL_SIZE'),
+                ('max_overflow', 'DATABASE_MAX_OVERFLOW'),
+                ('pool_timeout', 'DATABASE_POOL_TIMEOUT'),
+                ('pool_recycle', 'DATABASE_POOL_RECYCLE'),
+                ('pool_pre_ping', 'DATABASE_POOL_PRE_PING'))
+QUEUE_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+class TimedPool(object):
+    """
+    Pool mixin timing the wait for a connection.
+    """
+    def __init__(self, *args, **kwargs):
+        super(TimedPool, self).__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.checkout_wait = 0.0
+        self.checkout_wait_max = 0.0
+        self._stats_lock = threading.Lock()
+
+    def connect(self):
+        start = time.time()
+        try:
+            return super(TimedPool, self).connect()
+        finally:
+            duration = time.time() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.checkout_wait += duration
+                self.checkout_wait_max = max(self.checkout_wait_max,
+                                             duration)
+            for listener in checkout_listeners:
+                listener(duration)
+
+
+def timed_pool_class(pool_class):
+    """
+    Return the timed subclass of a pool class.
+    :param pool_class:
+    :return:
+    """
+    return type('Timed%s' % pool_class.__name__, (TimedPool, pool_class),
+                {'__module__': pool_class.__module__})
+
+
+def sqlite_pragmas(app):
+    """
+    Return the PRAGMA statements configured for the SQLite connections.
+    :param app:
+    :return:
+    """
+    pragmas = []
+    if app.config['SQLITE_JOURNAL_MODE']:
+        pragmas.append('PRAGMA journal_mode=%s' %
+                       app.config['SQLITE_JOURNAL_MODE'])
+    if app.config['SQLITE_SYNCHRONOUS']:
+        pragmas.append('PRAGMA synchronous=%s' %
+                       app.config['SQLITE_SYNCHRONOUS'])
+    if app.config['SQLITE_BUSY_TIMEOUT'] is not None:
+        pragmas.append('PRAGMA busy_timeout=%d' %
+                       app.config['SQLITE_BUSY_TIMEOUT'])
+    if app.config['SQLITE_MMAP_SIZE'] is not None:
+        pragmas.append('PRAGMA mmap_size=%d' % app.config['SQLITE_MMAP_SIZE'])
+    return pragmas
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session sending the reads of the requests routed to a replica
+    to its bind, and everything else to the primary database.
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if not has_request_context():
+            return super(RoutingSession, self).get_bind(mapper, clause)
+        if self._flushing or isinstance(clause, UpdateBase):
+            g.db_wrote = True
+        else:
+            bind = g.get('db_read_bind')
+            if bind is not None and (mapper is None or
+                                     'bind_key' not in
+                                     mapper.persist_selectable.info):
+                db = get_state(self.app).db
+                return db.get_engine(self.app, bind=bind)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _stick_to_primary(db_session):
+    """
+    Send the reads of the user session to the primary database for
+    DATABASE_REPLICA_STICKY seconds after it has written, so that it
+    reads its own writes whatever the replication lag.
+    :param db_session:
+    :return:
+    """
+    if has_request_context() and g.pop('db_wrote', False) and \
+            current_app.config['DATABASE_READ_BINDS']:
+        session['_primary_until'] = \
+            time.time() + current_app.config['DATABASE_REPLICA_STICKY']
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """
+    Flask-SQLAlchemy configured by the DATABASE_* and SQLITE_* settings,
+    whose engines time their pool checkouts and whose sessions route
+    reads to replicas.
+    """
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_pool_defaults(self, app, options):
+        options = super(SQLAlchemy, self).apply_pool_defaults(app, options)
+        for option, key in POOL_OPTIONS:
+            if app.config[key] is not None:
+                options[option] = app.config[key]
+        return options
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        if sa_url.drivername.startswith('sqlite'):
+            if sa_url.database not in (None, '', ':memory:') and \
+                    options.get('pool_size'):
+                options['poolclass'] = QueuePool
+                options.setdefault('connect_args', {})
+                options['connect_args']['check_same_thread'] = False
+            options['pragmas'] = sqlite_pragmas(app)
+        sa_url, options = super(SQLAlchemy, self).apply_driver_hacks(
+            app, sa_url, options)
+        timeout = app.config['DATABASE_STATEMENT_TIMEOUT']
+        if timeout is not None:
+            connect_args = options.setdefault('connect_args', {})
+            if sa_url.drivername.startswith('postgresql'):
+                connect_args['options'] = '-c statement_timeout=%d' % timeout
+            elif sa_url.drivername.startswith('mysql'):
+                connect_args['init_command'] = \
+                    'SET SESSION max_execution_time=%d' % timeout
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        engine_opts = dict(engine_opts)
+        pragmas = engine_opts.pop('pragmas', ())
+        pool_class = engine_opts.get('poolclass')
+        if pool_class is None:
+            pool_class = sa_url.get_dialect().get_pool_class(sa_url)
+        if not issubclass(pool_class, QueuePool):
+            for option in QUEUE_OPTIONS:
+                engine_opts.pop(option, None)
+        engine_opts['poolclass'] = timed_pool_class(pool_class)
+        engine = sqlalchemy.create_engine(sa_url, **engine_opts)
+        if pragmas:
+            @event.listens_for(engine, 'connect')
+            def set_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for pragma in pragmas:
+                    cursor.execute(pragma)
+                cursor.close()
+        return engine
+
+    def pool_stats(self, bind=None):
+        """
+        Return the statistics of the connection pool of an engine.
+        :param bind:
+        :return:
+        """
+        pool = self.get_engine(bind=bind).pool
+        stats = {'pool': type(pool).__name__,
+                 'checkouts': getattr(pool, 'checkouts', 0),
+                 'checkout_wait': getattr(pool, 'checkout_wait', 0.0),
+                 'checkout_wait_max': getattr(pool, 'checkout_wait_max', 0.0)}
+        if isinstance(pool, QueuePool):
+            stats.update(size=pool.size(),
+                         checked_in=pool.checkedin(),
+                         checked_out=pool.checkedout(),
+                         overflow=pool.overflow())
+        return stats
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# app/fragments.py
+
+import hashlib
+
+from flask import current_app, has_request_context, request
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from . import cache
+from .replicas import on_replica
+
+
+def fragment_namespace(name):
+    """
+    Return the cache namespace of the fragments of a name.
+    :param name:
+    :return:
+    """
+    return 'fragment:%s' % name
+
+
+def invalidate_fragments(*names):
+    """
+    Drop the cached fragments of names after the data they show
+    has been written.
+    :param names:
+    :return:
+    """
+    for name in names:
+        cache.bump(fragment_namespace(name))
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Cache the output of a template block in the application cache::
+
+        {% cache 'nav', current_user.is_admin, request.endpoint %}
+            ...
+        {% endcache %}
+
+    The first argument is the name of the fragment, whose namespace is
+    bumped by invalidate_fragments, the others are the values the output
+    depends on. The checksum of the template source and the line of the
+    block are part of the key, so a deployed template never shows
+    the fragments of its previous version. The fragments rendered from
+    a replica are not stored.
+    """
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        version = '%s:%d' % (self._checksum(parser.name), lineno)
+        call = self.call_method('_render', [nodes.Const(version),
+                                            nodes.List(args)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _checksum(self, name):
+        """
+        Return a checksum of the source of a template.
+        :param name:
+        :return:
+        """
+        if name is None or self.environment.loader is None:
+            return ''
+        source = self.environment.loader.get_source(self.environment,
+                                                    name)[0]
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()[:12]
+
+    def _render(self, version, args, caller):
+        if not current_app.config['FRAGMENT_CACHE']:
+            return caller()
+        name, keys = args[0], args[1:]
+        if has_request_context():
+            keys.append(request.script_root)
+        key = '%s:%s' % (version,
+                         hashlib.sha1(repr(keys).encode('utf-8')).hexdigest())
+        namespace = fragment_namespace(name)
+        value = cache.get(namespace, key)
+        if value is None:
+            value = caller()
+            if not on_replica():
+                cache.set(namespace, key, value,
+                          current_app.config['FRAGMENT_CACHE_TTL'])
+        return Markup(value)
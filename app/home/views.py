@@ -5,9 +5,11 @@ from flask import abort, render_template
 from flask_login import current_user, login_required as signed_session
 
 from . import home
+from ..conditional import conditional
 
 
 @home.route('/')
+@conditional()
 def welcome():
     """
     Render the homepage template on the / route
@@ -18,6 +20,7 @@ def welcome():
 
 @home.route('/home')
 @signed_session
+@conditional()
 def start():
     """
     Render the frontend template on the /home route.
@@ -26,9 +29,17 @@ def start():
     return render_template('home/home.html', title='Home')
 
 
+def check_admin():
+    """
+    Prevent non-admins from accessing the page.
+    :return:
+    """
+    if not current_user.is_admin:
+        abort(403)
+
+
 @home.route('/admin/home')
 @signed_session
+@conditional(authorize=check_admin)
 def admin():
-    if not current_user.is_admin:
-        abort(403)
     return render_template('home/admin.html', title='Admin')
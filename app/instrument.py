@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# app/instrument.py
+
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RequestTiming(object):
+    """
+    Wall, SQL and template times of the current request.
+    """
+    def __init__(self, keep_statements=0):
+        self.start = time.time()
+        self.sql_time = 0.0
+        self.sql_count = 0
+        self.template_time = 0.0
+        self.statements = []
+        self.keep_statements = keep_statements
+
+    def add_statement(self, statement, duration):
+        self.sql_time += duration
+        self.sql_count += 1
+        if len(self.statements) < self.keep_statements:
+            self.statements.append((duration, statement))
+
+    @property
+    def wall_time(self):
+        return time.time() - self.start
+
+
+class RequestStats(object):
+    """
+    Totals of the request timings of the process, per endpoint.
+    """
+    FIELDS = ('count', 'wall_time', 'max_wall_time', 'sql_time', 'sql_count',
+              'template_time')
+
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, timing, wall_time):
+        """
+        Add the timing of a request to the totals of its endpoint.
+        :param endpoint:
+        :param timing:
+        :param wall_time:
+        :return:
+        """
+        with self._lock:
+            totals = self._endpoints.get(endpoint)
+            if totals is None:
+                totals = self._endpoints[endpoint] = dict.fromkeys(
+                    self.FIELDS, 0)
+            totals['count'] += 1
+            totals['wall_time'] += wall_time
+            totals['max_wall_time'] = max(totals['max_wall_time'], wall_time)
+            totals['sql_time'] += timing.sql_time
+            totals['sql_count'] += timing.sql_count
+            totals['template_time'] += timing.template_time
+
+    def stats(self):
+        """
+        Return a copy of the totals per endpoint.
+        :return:
+        """
+        with self._lock:
+            return dict((endpoint, dict(totals))
+                        for endpoint, totals in self._endpoints.items())
+
+
+def current_timing():
+    """
+    Return the timing of the current request, or None.
+    :return:
+    """
+    if not has_request_context():
+        return None
+    return g.get('timing')
+
+
+class TimedTemplate(Template):
+    """
+    Template adding its render time to the timing of the request.
+    """
+    def render(self, *args, **kwargs):
+        timing = current_timing()
+        if timing is None:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        start = time.time()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            timing.template_time += time.time() - start
+
+    def generate(self, *args, **kwargs):
+        timing = current_timing()
+        events = super(TimedTemplate, self).generate(*args, **kwargs)
+        if timing is None:
+            for chunk in events:
+                yield chunk
+            return
+        while True:
+            start = time.time()
+            try:
+                chunk = next(events)
+            except StopIteration:
+                return
+            finally:
+                timing.template_time += time.time() - start
+            yield chunk
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = conn.info['query_start'].pop()
+    timing = current_timing()
+    if timing is not None:
+        timing.add_statement(statement, time.time() - start)
+
+
+def _start_request():
+    g.timing = RequestTiming(current_app.config['SLOW_REQUEST_STATEMENTS'])
+
+
+def _server_timing(response):
+    """
+    Add the timings of the request to a Server-Timing header.
+    :param response:
+    :return:
+    """
+    timing = current_timing()
+    if timing is not None and current_app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = (
+            'app;dur=%.1f, sql;dur=%.1f;desc="%d statements", '
+            'template;dur=%.1f' % (timing.wall_time * 1000,
+                                   timing.sql_time * 1000,
+                                   timing.sql_count,
+                                   timing.template_time * 1000))
+    return response
+
+
+def _end_request(error=None):
+    """
+    Record the timing of the request once its response has been sent,
+    and log it with its statements when it is slow.
+    :param error:
+    :return:
+    """
+    timing = g.pop('timing', None)
+    if timing is None:
+        return
+    app = current_app._get_current_object()
+    wall_time = timing.wall_time
+    endpoint = request.endpoint or 'none'
+    app.extensions['request_stats'].record(endpoint, timing, wall_time)
+    threshold = app.config['SLOW_REQUEST_THRESHOLD']
+    if threshold is not None and wall_time >= threshold:
+        lines = ['Slow request %s %s (%s): %.1f ms, %d statements in %.1f ms, '
+                 'templates in %.1f ms' % (request.method, request.path,
+                                           endpoint, wall_time * 1000,
+                                           timing.sql_count,
+                                           timing.sql_time * 1000,
+                                           timing.template_time * 1000)]
+        lines.extend('  %.1f ms: %s' % (duration * 1000, statement)
+                     for duration, statement in timing.statements)
+        app.logger.warning('\n'.join(lines))
+
+
+def init_app(app):
+    """
+    Time the requests, their SQL statements and their templates
+    when INSTRUMENTATION is set.
+    :param app:
+    :return:
+    """
+    app.extensions['request_stats'] = RequestStats()
+    if not app.config['INSTRUMENTATION']:
+        return
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(_start_request)
+    app.after_request(_server_timing)
+    app.teardown_request(_end_request)
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# app/jobs.py
+
+import json
+import os
+import signal
+import socket
+import time
+
+from flask import current_app
+
+from .cache import SQLiteFile, instance_file
+
+TASKS = {}
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+COLUMNS = ('id', 'name', 'args', 'key', 'priority', 'status', 'attempts',
+           'max_attempts', 'run_at', 'locked_until', 'worker', 'progress',
+           'message', 'result', 'error', 'created_at', 'updated_at')
+
+
+def task(name):
+    """
+    Register a function as the task run by the jobs of a name.
+    The function is called in an application context with the job
+    and the arguments it was enqueued with.
+    :param name:
+    :return:
+    """
+    def decorator(func):
+        TASKS[name] = func
+        return func
+    return decorator
+
+
+class Job(object):
+    """
+    A job claimed by a worker.
+    """
+    def __init__(self, store, worker, row):
+        self.store = store
+        self.worker = worker
+        self.id = row['id']
+        self.name = row['name']
+        self.args = json.loads(row['args'] or '{}')
+        self.attempts = row['attempts']
+        self.max_attempts = row['max_attempts']
+
+    @property
+    def last_attempt(self):
+        return self.attempts >= self.max_attempts
+
+    def progress(self, done, total=None, message=None):
+        """
+        Report the progress of the job, as a fraction or as done out
+        of total, which also extends its lease.
+        :param done:
+        :param total:
+        :param message:
+        :return:
+        """
+        fraction = float(done) / total if total else float(done)
+        self.store.progress(self.id, self.worker, min(fraction, 1.0), message)
+
+
+class JobStore(SQLiteFile):
+    """
+    Persistent queue of jobs in a SQLite database file shared by the
+    processes of an host.
+
+    Workers claim the queued job of highest priority in an immediate
+    transaction, and hold it for ``lease`` seconds which are extended
+    when they report progress. The jobs of a worker which died are
+    claimed again once their lease has expired, unless it was their last
+    attempt: they are failed then. Failed jobs are retried after
+    ``backoff * 2 ** (attempts - 1)`` seconds until ``max_attempts``.
+    The arguments of a job are cleared once it is done or failed.
+    """
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS jobs '
+              '(id INTEGER PRIMARY KEY, name TEXT NOT NULL, args TEXT, '
+              'key TEXT UNIQUE, priority INTEGER NOT NULL DEFAULT 0, '
+              'status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+              'max_attempts INTEGER NOT NULL, run_at REAL NOT NULL, '
+              'locked_until REAL, worker TEXT, '
+              'progress REAL NOT NULL DEFAULT 0, message TEXT, result TEXT, '
+              'error TEXT, created_at REAL NOT NULL, '
+              'updated_at REAL NOT NULL)',
+              'CREATE INDEX IF NOT EXISTS ix_jobs_status_priority '
+              'ON jobs (status, priority, id)')
+
+    def __init__(self, path, max_attempts=3, backoff=10.0, lease=300.0,
+                 timeout=5.0, timer=time.time):
+        super(JobStore, self).__init__(path, timeout)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self._timer = timer
+
+    def _row(self, row):
+        if row is None:
+            return None
+        row = dict(zip(COLUMNS, row))
+        for name in ('args', 'result'):
+            row[name] = json.loads(row[name]) if row[name] else None
+        return row
+
+    def enqueue(self, name, args=None, priority=0, key=None,
+                max_attempts=None, delay=0):
+        """
+        Queue a job and return its id. A job with the idempotency key
+        of an existing job is not queued again, the id of the existing
+        job is returned instead.
+        :param name:
+        :param args:
+        :param priority:
+        :param key:
+        :param max_attempts:
+        :param delay:
+        :return:
+        """
+        if name not in TASKS:
+            raise ValueError('Unknown task: "%s".' % name)
+        now = self._timer()
+        connection = self._connect()
+        cursor = connection.execute(
+            'INSERT OR IGNORE INTO jobs (name, args, key, priority, status, '
+            'max_attempts, run_at, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (name, json.dumps(args or {}), key, priority, QUEUED,
+             max_attempts or self.max_attempts, now + delay, now, now))
+        if cursor.rowcount:
+            return cursor.lastrowid
+        return connection.execute('SELECT id FROM jobs WHERE key = ?',
+                                  (key,)).fetchone()[0]
+
+    def claim(self, worker):
+        """
+        Take the next job to run, or return None.
+        :param worker:
+        :return:
+        """
+        now = self._timer()
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'UPDATE jobs SET status = ?, args = NULL, error = ?, '
+                'locked_until = NULL, updated_at = ? WHERE status = ? '
+                'AND locked_until <= ? AND attempts >= max_attempts',
+                (FAILED, 'The lease expired on the last attempt.', now,
+                 RUNNING, now))
+            row = connection.execute(
+                'SELECT %s FROM jobs WHERE (status = ? AND run_at <= ?) '
+                'OR (status = ? AND locked_until <= ?) '
+                'ORDER BY priority DESC, id LIMIT 1' % ', '.join(COLUMNS),
+                (QUEUED, now, RUNNING, now)).fetchone()
+            if row is not None:
+                connection.execute(
+                    'UPDATE jobs SET status = ?, attempts = attempts + 1, '
+                    'locked_until = ?, worker = ?, updated_at = ? '
+                    'WHERE id = ?',
+                    (RUNNING, now + self.lease, worker, now, row[0]))
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        row = dict(zip(COLUMNS, row))
+        row['attempts'] += 1
+        return row
+
+    def progress(self, id, worker, progress, message=None):
+        now = self._timer()
+        self._connect().execute(
+            'UPDATE jobs SET progress = ?, message = ?, locked_until = ?, '
+            'updated_at = ? WHERE id = ? AND worker = ?',
+            (progress, message, now + self.lease, now, id, worker))
+
+    def complete(self, id, worker, result=None):
+        self._connect().execute(
+            'UPDATE jobs SET status = ?, args = NULL, progress = 1, '
+            'result = ?, error = NULL, locked_until = NULL, updated_at = ? '
+            'WHERE id = ? AND worker = ?',
+            (DONE, json.dumps(result) if result is not None else None,
+             self._timer(), id, worker))
+
+    def fail(self, id, worker, error):
+        """
+        Queue a failed job again after a backoff, or mark it failed
+        after its last attempt.
+        :param id:
+        :param worker:
+        :param error:
+        :return:
+        """
+        now = self._timer()
+        connection = self._connect()
+        attempts, max_attempts = connection.execute(
+            'SELECT attempts, max_attempts FROM jobs WHERE id = ?',
+            (id,)).fetchone()
+        if attempts >= max_attempts:
+            status, run_at = FAILED, now
+        else:
+            status = QUEUED
+            run_at = now + self.backoff * 2 ** (attempts - 1)
+        connection.execute(
+            'UPDATE jobs SET status = ?, run_at = ?, error = ?, '
+            'args = CASE WHEN ? THEN NULL ELSE args END, '
+            'locked_until = NULL, updated_at = ? WHERE id = ? AND worker = ?',
+            (status, run_at, error, status == FAILED, now, id, worker))
+
+    def get(self, id):
+        return self._row(self._connect().execute(
+            'SELECT %s FROM jobs WHERE id = ?' % ', '.join(COLUMNS),
+            (id,)).fetchone())
+
+    def recent(self, limit=50):
+        """
+        Return the last queued jobs, newest first.
+        :param limit:
+        :return:
+        """
+        return [self._row(row) for row in self._connect().execute(
+            'SELECT %s FROM jobs ORDER BY id DESC LIMIT ?' % ', '.join(COLUMNS),
+            (limit,))]
+
+    def counts(self):
+        return dict(self._connect().execute(
+            'SELECT status, COUNT(*) FROM jobs GROUP BY status'))
+
+
+class Worker(object):
+    """
+    Run the jobs of a store, one at a time, in application contexts.
+    """
+    def __init__(self, app, store, poll=1.0):
+        self.app = app
+        self.store = store
+        self.poll = poll
+        self.name = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.stopped = False
+
+    def run_once(self):
+        """
+        Claim and run one job. Returns False when there was none.
+        :return:
+        """
+        row = self.store.claim(self.name)
+        if row is None:
+            return False
+        job = Job(self.store, self.name, row)
+        with self.app.app_context():
+            try:
+                func = TASKS.get(job.name)
+                if func is None:
+                    raise ValueError('Unknown task: "%s".' % job.name)
+                result = func(job, **job.args)
+            except Exception as error:
+                self.app.logger.exception('Job %d (%s) failed.',
+                                          job.id, job.name)
+                self.store.fail(job.id, self.name,
+                                '%s: %s' % (type(error).__name__, error))
+            else:
+                self.store.complete(job.id, self.name, result)
+            finally:
+                self.app.extensions['sqlalchemy'].db.session.remove()
+        return True
+
+    def run(self, once=False):
+        """
+        Run jobs until stopped, or until the queue is empty when once
+        is set. SIGTERM stops the worker after its current job.
+        :param once:
+        :return:
+        """
+        self.name = '%s:%d' % (socket.gethostname(), os.getpid())
+
+        def stop(signum, frame):
+            self.stopped = True
+        signal.signal(signal.SIGTERM, stop)
+        while not self.stopped:
+            if not self.run_once():
+                if once:
+                    return
+                time.sleep(self.poll)
+
+
+def enqueue(name, priority=0, key=None, **args):
+    """
+    Queue a job of the current application and return its id.
+    :param name:
+    :param priority:
+    :param key:
+    :param args:
+    :return:
+    """
+    return current_app.extensions['jobs'].enqueue(name, args, priority, key)
+
+
+def init_app(app):
+    """
+    Open the job queue of the application, in JOBS_PATH
+    or in the instance folder.
+    :param app:
+    :return:
+    """
+    app.extensions['jobs'] = JobStore(
+        instance_file(app, app.config['JOBS_PATH'], 'jobs.sqlite'),
+        app.config['JOBS_MAX_ATTEMPTS'],
+        app.config['JOBS_BACKOFF'],
+        app.config['JOBS_LEASE'])
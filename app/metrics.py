@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+# app/metrics.py
+
+import atexit
+import binascii
+import errno
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import abort, current_app, g, has_app_context, request
+
+from .cache import instance_file
+from .database import checkout_listeners
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+HELP = {
+    'http_requests_total': 'Requests by endpoint, blueprint, method '
+                           'and status.',
+    'http_request_errors_total': 'Requests answered with a server error.',
+    'http_request_duration_seconds': 'Request durations.',
+    'db_pool_checkout_seconds': 'Time waited for a database connection.',
+    'login_attempts_total': 'Sign in attempts by result.',
+    'db_pool_size': 'Connections kept by the pools.',
+    'db_pool_checked_out': 'Connections in use.',
+    'db_pool_overflow': 'Connections opened over the pool size.',
+    'audit_queue_depth': 'Audit events waiting for the writer.',
+    'audit_events_written_total': 'Audit events written.',
+    'audit_events_dropped_total': 'Audit events dropped on a full queue.',
+    'audit_events_failed_total': 'Audit events lost on a failed write.',
+}
+
+
+class Registry(object):
+    """
+    Counters, gauges and histograms of the process.
+
+    Updates only hold the lock to add to a number. Snapshots are plain
+    data which are merged across processes by summing them.
+    """
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Add to a counter.
+        :param name:
+        :param labels:
+        :param value:
+        :return:
+        """
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        """
+        Set a gauge.
+        :param name:
+        :param labels:
+        :param value:
+        :return:
+        """
+        with self._lock:
+            self._gauges[(name, tuple(labels))] = value
+
+    def observe(self, name, labels, value):
+        """
+        Add a value to an histogram.
+        :param name:
+        :param labels:
+        :param value:
+        :return:
+        """
+        key = (name, tuple(labels))
+        index = len(BUCKETS)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 3)
+            histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def snapshot(self):
+        """
+        Return the counters, gauges and histograms as JSON serializable
+        data.
+        :return:
+        """
+        with self._lock:
+            return {'counters': [[name, labels, value] for (name, labels), value
+                                 in self._counters.items()],
+                    'gauges': [[name, labels, value] for (name, labels), value
+                               in self._gauges.items()],
+                    'histograms': [[name, labels, list(values)]
+                                   for (name, labels), values
+                                   in self._histograms.items()]}
+
+
+def merge(snapshots):
+    """
+    Sum the snapshots of several processes.
+    :param snapshots:
+    :return:
+    """
+    counters = {}
+    gauges = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for samples, kind in ((counters, 'counters'), (gauges, 'gauges')):
+            for name, labels, value in snapshot.get(kind, ()):
+                key = (name, tuple(tuple(label) for label in labels))
+                samples[key] = samples.get(key, 0) + value
+        for name, labels, values in snapshot.get('histograms', ()):
+            key = (name, tuple(tuple(label) for label in labels))
+            total = histograms.get(key)
+            if total is None:
+                histograms[key] = list(values)
+            else:
+                histograms[key] = [a + b for a, b in zip(total, values)]
+    return counters, gauges, histograms
+
+
+def _labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, ('%s' % value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(counters, gauges, histograms):
+    """
+    Format counters, gauges and histograms in the Prometheus text format.
+    :param counters:
+    :param gauges:
+    :param histograms:
+    :return:
+    """
+    lines = []
+    for kind, samples in (('counter', counters), ('gauge', gauges),
+                          ('histogram', histograms)):
+        for name in sorted(set(name for name, labels in samples)):
+            if name in HELP:
+                lines.append('# HELP %s %s' % (name, HELP[name]))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for key in sorted(key for key in samples if key[0] == name):
+                labels, values = key[1], samples[key]
+                if kind != 'histogram':
+                    lines.append('%s%s %s' % (name, _labels(labels),
+                                              _number(values)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), values):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name, _labels(labels, (('le', bound),)), cumulative))
+                lines.append('%s_sum%s %s' % (name, _labels(labels),
+                                              _number(values[-2])))
+                lines.append('%s_count%s %d' % (name, _labels(labels),
+                                                values[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+def _alive(pid):
+    """
+    Tell if a process is running.
+    :param pid:
+    :return:
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def _load(name):
+    try:
+        with open(name) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _dump(snapshot, name):
+    fd, temp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(name))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f)
+        os.rename(temp, name)
+    except Exception:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+
+class Metrics(object):
+    """
+    Metrics of the process, written every METRICS_FLUSH_INTERVAL
+    seconds to a file per process in a shared directory when the
+    backend is 'files', so that any worker can answer for all.
+
+    The file of a process which exited, or died, is retired: its
+    counters and histograms are added to the aggregate file of the
+    directory and its gauges are dropped. The files are named after the
+    pid and a random token, so a process reusing the pid of a dead one
+    retires its file instead of overwriting it.
+    """
+    AGGREGATE = 'aggregate.json'
+
+    def __init__(self, path=None, flush_interval=1.0):
+        self.registry = Registry()
+        self.collectors = []
+        self.path = path
+        self.flush_interval = flush_interval
+        self._flushed = 0
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self._name = None
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+    @contextmanager
+    def _lock(self):
+        """
+        Hold the lock of the directory, which serializes the retirement
+        of the files with their reading.
+        :return:
+        """
+        with open(os.path.join(self.path, 'metrics.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _file(self):
+        """
+        Return the file of the process, a forked process starts
+        with empty metrics and its own file.
+        :return:
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            if self._pid is not None:
+                self.registry = Registry()
+            self._pid = pid
+            self._name = os.path.join(self.path, 'metrics-%d-%s.json' % (
+                pid, binascii.hexlify(os.urandom(4))))
+        return self._name
+
+    def flush(self, force=False, update=True):
+        """
+        Write the snapshot of the process to its file. A periodic
+        flush is skipped while another thread is flushing.
+        :param force:
+        :param update:
+        :return:
+        """
+        if self.path is None:
+            return
+        if not self._flush_lock.acquire(force):
+            return
+        try:
+            now = time.time()
+            if not force and now - self._flushed < self.flush_interval:
+                return
+            self._flushed = now
+            if update:
+                self.update()
+            _dump(self.registry.snapshot(), self._file())
+        finally:
+            self._flush_lock.release()
+
+    def _retire(self, path):
+        """
+        Add the counters and histograms of a file to the aggregate file
+        and remove it. Must be called with the lock held.
+        :param path:
+        :return:
+        """
+        snapshot = _load(path)
+        if snapshot is not None:
+            aggregate = os.path.join(self.path, self.AGGREGATE)
+            counters, gauges, histograms = merge(
+                [_load(aggregate) or {},
+                 {'counters': snapshot.get('counters', ()),
+                  'histograms': snapshot.get('histograms', ())}])
+            _dump({'counters': [[name, labels, value] for (name, labels), value
+                                in counters.items()],
+                   'histograms': [[name, labels, values]
+                                  for (name, labels), values
+                                  in histograms.items()]}, aggregate)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def close(self):
+        """
+        Retire the file of the process when it exits.
+        :return:
+        """
+        if self.path is None or not os.path.isdir(self.path) or \
+                self._pid != os.getpid():
+            return
+        self.flush(force=True, update=False)
+        with self._lock():
+            self._retire(self._name)
+
+    def update(self):
+        """
+        Let the collectors set their gauges.
+        :return:
+        """
+        for collector in self.collectors:
+            collector(self.registry)
+
+    def collect(self):
+        """
+        Return the merged counters, gauges and histograms of all processes,
+        the files of the processes which are gone are retired first.
+        :return:
+        """
+        if self.path is None:
+            self.update()
+            return merge([self.registry.snapshot()])
+        self.flush(force=True)
+        snapshots = []
+        with self._lock():
+            for name in os.listdir(self.path):
+                if not name.startswith('metrics-') or \
+                        not name.endswith('.json'):
+                    continue
+                path = os.path.join(self.path, name)
+                try:
+                    pid = int(name[len('metrics-'):-len('.json')]
+                              .split('-')[0])
+                except ValueError:
+                    continue
+                if path != self._name and \
+                        (pid == self._pid or not _alive(pid)):
+                    self._retire(path)
+                    continue
+                snapshot = _load(path)
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+            aggregate = _load(os.path.join(self.path, self.AGGREGATE))
+            if aggregate is not None:
+                snapshots.append(aggregate)
+        return merge(snapshots)
+
+
+def inc(name, **labels):
+    """
+    Add one to a counter of the current application.
+    :param name:
+    :param labels:
+    :return:
+    """
+    metrics = current_app.extensions.get('metrics')
+    if metrics is not None:
+        metrics.registry.inc(name, sorted(labels.items()))
+
+
+def _observe_checkout(duration):
+    if has_app_context():
+        metrics = current_app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.registry.observe('db_pool_checkout_seconds', (), duration)
+
+
+def _pool_gauges(registry):
+    """
+    Set the gauges of the connection pool of the application.
+    :param registry:
+    :return:
+    """
+    stats = current_app.extensions['sqlalchemy'].db.pool_stats()
+    for name in ('size', 'checked_out', 'overflow'):
+        if name in stats:
+            registry.set('db_pool_%s' % name, (), stats[name])
+
+
+def _start_request():
+    g.metrics_start = time.time()
+
+
+def _status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def _end_request(error=None):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return
+    metrics = current_app.extensions['metrics']
+    status = 500 if error is not None else g.pop('metrics_status', 500)
+    labels = (('endpoint', request.endpoint or 'none'),
+              ('blueprint', request.blueprint or ''))
+    registry = metrics.registry
+    registry.inc('http_requests_total',
+                 labels + (('method', request.method),
+                           ('status', str(status))))
+    if status >= 500:
+        registry.inc('http_request_errors_total', labels)
+    registry.observe('http_request_duration_seconds', labels,
+                     time.time() - start)
+    metrics.flush()
+
+
+def metrics_view():
+    """
+    Answer the metrics of all the workers in the Prometheus text format.
+    :return:
+    """
+    allowed = current_app.config['METRICS_ALLOWED_ADDRESSES']
+    if allowed is not None and request.remote_addr not in allowed:
+        abort(403)
+    samples = current_app.extensions['metrics'].collect()
+    return current_app.response_class(
+        render(*samples),
+        mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    """
+    Count the requests and serve /metrics when METRICS is set,
+    with the backend configured by METRICS_BACKEND.
+    :param app:
+    :return:
+    """
+    if not app.config['METRICS']:
+        return
+    backend = app.config['METRICS_BACKEND']
+    if backend == 'memory':
+        path = None
+    elif backend == 'files':
+        path = instance_file(app, app.config['METRICS_PATH'], 'metrics')
+    else:
+        raise ValueError('Unknown metrics backend: "%s".' % backend)
+    metrics = Metrics(path, app.config['METRICS_FLUSH_INTERVAL'])
+    metrics.collectors.append(_pool_gauges)
+    if path is not None:
+        atexit.register(metrics.close)
+    app.extensions['metrics'] = metrics
+    if _observe_checkout not in checkout_listeners:
+        checkout_listeners.append(_observe_checkout)
+    app.before_request(_start_request)
+    app.after_request(_status)
+    app.teardown_request(_end_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
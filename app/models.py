@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 # app/models.py
 
+from flask import current_app
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 
-from app import db, lm
+from app import cache, db, lm
+from .passwords import check_password, hash_password, needs_rehash
+from .replicas import primary
 
 
 class User(UserMixin, db.Model):
@@ -24,6 +26,12 @@ class User(UserMixin, db.Model):
     is_admin = db.Column(db.Boolean, default=False)
     is_valid = db.Column(db.Boolean, default=False)
     is_blocked = db.Column(db.Boolean, default=False)
+    token_generation = db.Column(db.Integer, nullable=False, default=0,
+                                 server_default='0')
+    __table_args__ = (db.Index('ix_users_group_id_id', 'group_id', 'id'),
+                      db.Index('ix_users_role_id_id', 'role_id', 'id'),
+                      db.Index('ix_users_flags_id', 'is_admin', 'is_valid',
+                               'is_blocked', 'id'))
 
     @property
     def password(self):
@@ -40,7 +48,7 @@ class User(UserMixin, db.Model):
         :param password:
         :return:
         """
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def verify_password(self, password):
         """
@@ -48,15 +56,110 @@ class User(UserMixin, db.Model):
         :param password:
         :return:
         """
-        return check_password_hash(self.password_hash, password)
+        return check_password(self.password_hash, password)
+
+    def needs_rehash(self):
+        """
+        Check if the password was hashed with outdated parameters.
+        :return:
+        """
+        return needs_rehash(self.password_hash)
 
     def __repr__(self):
         return '<User: %s>' % self.username
 
 
+class UserSnapshot(UserMixin):
+    """
+    Lightweight copy of an User kept by the session user loader cache.
+    """
+    def __init__(self, id, name, is_admin, is_valid, is_blocked,
+                 group_id, role_id):
+        self.id = id
+        self.name = name
+        self.is_admin = is_admin
+        self.is_valid = is_valid
+        self.is_blocked = is_blocked
+        self.group_id = group_id
+        self.role_id = role_id
+
+    @classmethod
+    def from_user(cls, user):
+        """
+        Copy the session fields of an User.
+        :param user:
+        :return:
+        """
+        return cls(user.id, user.name, user.is_admin, user.is_valid,
+                   user.is_blocked, user.group_id, user.role_id)
+
+    def __repr__(self):
+        return '<UserSnapshot: %s>' % self.name
+
+
 @lm.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    """
+    Load the session user from the user caches or the database.
+
+    The process local cache keeps the snapshot with the generations
+    of all users and of the user namespace of the shared cache, so an
+    edit made in any worker is seen by all of them on their next request.
+    :param user_id:
+    :return:
+    """
+    user_id = int(user_id)
+    namespace = 'user:%d' % user_id
+    generation = cache.generations('users', namespace)
+    local = current_app.extensions['user_cache']
+    entry = local.get(user_id)
+    if entry is not None and entry[0] == generation:
+        return entry[1]
+    key = 'snapshot:%d' % generation[0]
+    snapshot = cache.get(namespace, key)
+    if snapshot is None:
+        with primary():
+            user = User.query.get(user_id)
+        if user is None:
+            return None
+        snapshot = UserSnapshot.from_user(user)
+        cache.set(namespace, key, snapshot)
+    local.set(user_id, (generation, snapshot))
+    return snapshot
+
+
+def invalidate_user(user_id):
+    """
+    Drop an user from the user caches after it has been edited.
+    :param user_id:
+    :return:
+    """
+    current_app.extensions['user_cache'].delete(user_id)
+    cache.bump('user:%d' % user_id)
+
+
+def invalidate_users():
+    """
+    Drop all users from the user caches after a batch edit.
+    :return:
+    """
+    current_app.extensions['user_cache'].clear()
+    cache.bump('users')
+
+
+def count_users(foreign_key, rows):
+    """
+    Count the users of groups or roles in one grouped query.
+    :param foreign_key: 'group_id' or 'role_id'
+    :param rows:
+    :return: the counts by id
+    """
+    ids = [row.id for row in rows]
+    if not ids:
+        return {}
+    column = getattr(User, foreign_key)
+    return dict(db.session.query(column, db.func.count(User.id))
+                .filter(column.in_(ids)).group_by(column))
 
 
 class Group(db.Model):
@@ -101,3 +204,23 @@ class Tool(db.Model):
 
     def __repr__(self):
         return '<Tool: %s>' % self.name
+
+
+class AuditEvent(db.Model):
+    """
+    Create an Audit events table, written in batches by the audit writer.
+    """
+    __tablename__ = 'audit_events'
+
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, index=True)
+    user_id = db.Column(db.Integer, index=True)
+    action = db.Column(db.String(20))
+    target = db.Column(db.String(20))
+    target_id = db.Column(db.Integer)
+    details = db.Column(db.Text)
+    __table_args__ = (db.Index('ix_audit_events_target', 'target',
+                               'target_id'),)
+
+    def __repr__(self):
+        return '<AuditEvent: %s %s>' % (self.action, self.target)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# app/pagination.py
+
+from flask import (Response, current_app, render_template, request,
+                   stream_with_context)
+
+
+class KeysetPage(object):
+    """
+    One page of a keyset (cursor) paginated query.
+
+    Rows are selected with ``WHERE key > after`` or ``WHERE key < before``
+    and ``LIMIT size + 1`` so the database never has to skip over the
+    rows of the previous pages, whatever the size of the table.
+    The extra row is only used to know if there is a following page.
+    """
+    def __init__(self, query, column, size, after=None, before=None,
+                 stream=False):
+        self.size = size
+        self.stream = stream and before is None
+        self.after = after
+        self.before = before
+        self.next_cursor = None
+        self.prev_cursor = None
+        self._column = column
+        if before is not None:
+            query = query.filter(column < before).order_by(column.desc())
+            rows = query.limit(size + 1).all()
+            if len(rows) > size:
+                rows = rows[:size]
+                self.prev_cursor = self._key(rows[-1])
+            rows.reverse()
+            if rows:
+                self.next_cursor = self._key(rows[-1])
+            self.items = rows
+        else:
+            if after is not None:
+                query = query.filter(column > after)
+            query = query.order_by(column).limit(size + 1)
+            if stream:
+                self.items = self._stream(query)
+            else:
+                self.items = self._page(query.all())
+
+    def _key(self, row):
+        """
+        Return the cursor value of a row.
+        :param row:
+        :return:
+        """
+        return getattr(row, self._column.key)
+
+    def _page(self, rows):
+        """
+        Trim the look-ahead row and set the cursors.
+        :param rows:
+        :return:
+        """
+        if len(rows) > self.size:
+            rows = rows[:self.size]
+            self.next_cursor = self._key(rows[-1])
+        if rows and self.after is not None:
+            self.prev_cursor = self._key(rows[0])
+        return rows
+
+    def _stream(self, query):
+        """
+        Yield the rows as they are fetched from the cursor,
+        the cursors are known once the rows have been consumed.
+        :param query:
+        :return:
+        """
+        count = 0
+        last = None
+        for row in query.yield_per(min(self.size + 1, 100)):
+            if count == self.size:
+                self.next_cursor = self._key(last)
+                break
+            if count == 0 and self.after is not None:
+                self.prev_cursor = self._key(row)
+            count += 1
+            last = row
+            yield row
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def iter_chunks(query, column, size):
+    """
+    Yield the rows of a query in lists of ``size`` rows, each chunk
+    is selected after the key of the last row of the previous one.
+    :param query:
+    :param column:
+    :param size:
+    :return:
+    """
+    last = None
+    while True:
+        chunk = query
+        if last is not None:
+            chunk = chunk.filter(column > last)
+        rows = chunk.order_by(column).limit(size).all()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < size:
+            return
+        last = getattr(rows[-1], column.key)
+
+
+def paginate(query, column, stream=None):
+    """
+    Paginate a query on a unique column with the cursors found in the
+    query string (``?after=<id>`` or ``?before=<id>``, ``?size=<n>``
+    and ``?stream=1``).
+    :param query:
+    :param column:
+    :param stream:
+    :return:
+    """
+    config = current_app.config
+    size = request.args.get('size', type=int) or config['PAGE_SIZE']
+    size = max(1, min(size, config['PAGE_SIZE_MAX']))
+    if stream is None:
+        stream = request.args.get('stream', type=int,
+                                  default=int(config['STREAM_LISTS'])) == 1
+    return KeysetPage(query, column, size,
+                      after=request.args.get('after', type=int),
+                      before=request.args.get('before', type=int),
+                      stream=stream)
+
+
+class LazyPage(object):
+    """
+    A page which is only paginated when it is first used, so a list
+    whose rendering is cached in a fragment is not queried when the
+    fragment is found. Lazy pages are never streamed.
+    """
+    stream = False
+
+    def __init__(self, query, column):
+        self._query = query
+        self._column = column
+        self._page = None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._page is None:
+            self._page = paginate(self._query, self._column, stream=False)
+        return getattr(self._page, name)
+
+
+def render_page(template_name, page, **context):
+    """
+    Render a template listing a page, streaming the rendered template
+    through the response when the page rows are streamed.
+    :param template_name:
+    :param page:
+    :param context:
+    :return:
+    """
+    context['page'] = page
+    if not page.stream:
+        return render_template(template_name, **context)
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(app.config['STREAM_BUFFER'])
+    return Response(stream_with_context(stream))
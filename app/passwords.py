@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# app/passwords.py
+
+import os
+import threading
+from collections import deque
+from functools import partial
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class PoolBusy(Exception):
+    """
+    Raised when the hashing pool can not take more work.
+    """
+
+
+class _Task(object):
+    """
+    A call waiting for a worker of the hashing pool.
+    """
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def run(self):
+        if self.cancelled:
+            return
+        try:
+            self.result = self.func(*self.args)
+        except Exception as error:
+            self.error = error
+        self.done.set()
+
+
+class HashingPool(object):
+    """
+    Bounded pool of threads hashing and checking passwords.
+
+    pbkdf2 releases the GIL, so the workers hash in parallel while the
+    number of requests hashing at once stays bounded. When the queue
+    is full new calls are rejected instead of waiting.
+    """
+    def __init__(self, workers=2, queue_size=32, timeout=10.0):
+        self.workers = workers
+        self.timeout = timeout
+        self.rejected = 0
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _start(self):
+        """
+        Start the worker threads, again after a fork
+        since threads do not survive it.
+        :return:
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work,
+                                          name='hashing-pool')
+                thread.daemon = True
+                thread.start()
+            self._pid = os.getpid()
+
+    def _work(self):
+        while True:
+            self._queue.get().run()
+
+    def call(self, func, *args):
+        """
+        Run a function in the pool and return its result.
+        :param func:
+        :param args:
+        :return:
+        """
+        if self._pid != os.getpid():
+            self._start()
+        task = _Task(func, args)
+        try:
+            self._queue.put_nowait(task)
+        except queue.Full:
+            self.rejected += 1
+            raise PoolBusy()
+        if not task.done.wait(self.timeout):
+            task.cancelled = True
+            self.rejected += 1
+            raise PoolBusy()
+        if task.error is not None:
+            raise task.error
+        return task.result
+
+    def map(self, func, items):
+        """
+        Run a function over items in the pool and return the results.
+        At most ``workers`` items of a batch are queued at once, the next
+        one when the oldest is done, so a batch shares the workers with
+        the sign in calls and never fills the queue they are put in.
+        :param func:
+        :param items:
+        :return:
+        """
+        if self._pid != os.getpid():
+            self._start()
+        pending = deque()
+        results = []
+        try:
+            for item in items:
+                if len(pending) >= self.workers:
+                    results.append(self._result(pending.popleft()))
+                task = _Task(func, (item,))
+                self._queue.put(task, timeout=self.timeout)
+                pending.append(task)
+            while pending:
+                results.append(self._result(pending.popleft()))
+            return results
+        except (PoolBusy, queue.Full):
+            self.rejected += 1
+            raise PoolBusy()
+        finally:
+            for task in pending:
+                task.cancelled = True
+
+    def _result(self, task):
+        """
+        Wait for a task and return its result.
+        :param task:
+        :return:
+        """
+        if not task.done.wait(self.timeout):
+            raise PoolBusy()
+        if task.error is not None:
+            raise task.error
+        return task.result
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+
+def init_app(app):
+    """
+    Create the hashing pool when PASSWORD_POOL_WORKERS is set,
+    passwords are hashed in the request thread otherwise.
+    :param app:
+    :return:
+    """
+    if app.config['PASSWORD_POOL_WORKERS']:
+        app.extensions['hashing_pool'] = HashingPool(
+            app.config['PASSWORD_POOL_WORKERS'],
+            app.config['PASSWORD_POOL_QUEUE'],
+            app.config['PASSWORD_POOL_TIMEOUT'])
+
+
+def _call(func, *args):
+    """
+    Run a function in the hashing pool if there is one.
+    :param func:
+    :param args:
+    :return:
+    """
+    pool = current_app.extensions.get('hashing_pool')
+    if pool is None:
+        return func(*args)
+    return pool.call(func, *args)
+
+
+def password_method():
+    """
+    Return the werkzeug hash method of the configured hashing
+    parameters, e.g. "pbkdf2:sha256:150000".
+    :return:
+    """
+    config = current_app.config
+    method = config['PASSWORD_HASH_METHOD']
+    if method.startswith('pbkdf2:'):
+        method = '%s:%d' % (method, config['PASSWORD_HASH_ITERATIONS'])
+    return method
+
+
+def hash_password(password):
+    """
+    Hash a password with the configured parameters.
+    :param password:
+    :return:
+    """
+    return _call(generate_password_hash, password, password_method(),
+                 current_app.config['PASSWORD_SALT_LENGTH'])
+
+
+def hash_passwords(passwords):
+    """
+    Hash many passwords at once, for the bulk imports, in the hashing
+    pool if there is one. Without a pool, when PASSWORD_POOL_WORKERS is
+    0 as in all but the production configuration, they are hashed one
+    after the other in the calling thread.
+    :param passwords:
+    :return:
+    """
+    hash_one = partial(generate_password_hash,
+                       method=password_method(),
+                       salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
+    pool = current_app.extensions.get('hashing_pool')
+    if pool is None:
+        return [hash_one(password) for password in passwords]
+    return pool.map(hash_one, passwords)
+
+
+def check_password(password_hash, password):
+    """
+    Check a password against its hash, whatever its parameters.
+    Hashes are ascii, they are read as unicode from the database.
+    :param password_hash:
+    :param password:
+    :return:
+    """
+    return _call(check_password_hash, str(password_hash), password)
+
+
+def needs_rehash(password_hash):
+    """
+    Tell if an hash was made with other parameters than the configured ones.
+    :param password_hash:
+    :return:
+    """
+    if password_hash is None or '$' not in password_hash:
+        return True
+    method, salt, _ = password_hash.split('$', 2)
+    return (method != password_method() or
+            len(salt) != current_app.config['PASSWORD_SALT_LENGTH'])
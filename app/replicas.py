@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# app/replicas.py
+
+import random
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request, session
+
+from . import db
+
+
+def choose_replica():
+    """
+    Return the bind of a random replica of DATABASE_READ_BINDS,
+    or None when the user session has to read from the primary.
+    :return:
+    """
+    binds = current_app.config['DATABASE_READ_BINDS']
+    if not binds or session.get('_primary_until', 0) > time.time():
+        return None
+    return random.choice(binds)
+
+
+def use_replica(view):
+    """
+    Route the reads of the GET requests of a view, and of their streamed
+    response, to a replica. The other methods read from the primary.
+    :param view:
+    :return:
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method in ('GET', 'HEAD'):
+            g.db_read_bind = choose_replica()
+        else:
+            g.db_read_bind = None
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def on_replica():
+    """
+    Tell if the reads of the request go to a replica, whose rows may lag
+    behind the cache generations: what is read from it must not be cached.
+    :return:
+    """
+    return has_request_context() and g.get('db_read_bind') is not None
+
+
+@contextmanager
+def primary():
+    """
+    Route the reads of a block to the primary database, for the data
+    which is cached under the current generations.
+    :return:
+    """
+    if not has_request_context():
+        yield
+        return
+    previous = g.get('db_read_bind')
+    g.db_read_bind = None
+    try:
+        yield
+    finally:
+        g.db_read_bind = previous
+
+
+def sync_replica(bind):
+    """
+    Copy the tables of the primary SQLite database to a replica SQLite
+    database, in one transaction, standing in for the replication of
+    a database server in development and tests.
+    :param bind:
+    :return:
+    """
+    replica = db.get_engine(bind=bind)
+    if replica.url.get_backend_name() != 'sqlite' or \
+            db.engine.url.get_backend_name() != 'sqlite':
+        raise ValueError('Only SQLite replicas can be synced.')
+    tables = [table for table in db.metadata.sorted_tables
+              if 'bind_key' not in table.info]
+    db.metadata.create_all(replica, tables=tables)
+    replica.dispose()
+    with db.engine.connect() as connection:
+        connection.execute(db.text('ATTACH DATABASE :path AS replica'),
+                           path=replica.url.database)
+        try:
+            with connection.begin():
+                for table in reversed(tables):
+                    connection.execute('DELETE FROM replica.%s' % table.name)
+                for table in tables:
+                    columns = ', '.join(column.name for column in table.c)
+                    connection.execute('INSERT INTO replica.%s (%s) SELECT %s '
+                                       'FROM main.%s' % (table.name, columns,
+                                                         columns, table.name))
+        finally:
+            connection.execute('DETACH DATABASE replica')
+    return len(tables)
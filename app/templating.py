@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# app/templating.py
+
+import os
+
+from jinja2 import FileSystemBytecodeCache
+
+from .cache import instance_file
+
+
+def init_app(app):
+    """
+    Add the fragment cache extension, and store the compiled templates
+    in a directory shared by the workers, configured by TEMPLATE_CACHE
+    and TEMPLATE_CACHE_PATH, so a restarted worker loads the bytecode
+    instead of compiling every template again.
+    Must run before the first access to the jinja environment.
+    :param app:
+    :return:
+    """
+    from .fragments import FragmentCacheExtension
+    extensions = list(app.jinja_options.get('extensions', ()))
+    app.jinja_options = dict(app.jinja_options,
+                             extensions=extensions + [FragmentCacheExtension])
+    if not app.config['TEMPLATE_CACHE']:
+        return
+    path = instance_file(app, app.config['TEMPLATE_CACHE_PATH'],
+                         'templates')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    app.jinja_options = dict(app.jinja_options,
+                             bytecode_cache=FileSystemBytecodeCache(path))
+
+
+def compile_templates(app, extensions=('html',)):
+    """
+    Compile every template of the application and of its blueprints
+    into the bytecode cache. Returns the compiled template names.
+    :param app:
+    :param extensions:
+    :return:
+    """
+    env = app.jinja_env
+    names = env.list_templates(extensions=extensions)
+    for name in names:
+        env.get_template(name)
+    return names
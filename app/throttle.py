@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# app/throttle.py
+
+import threading
+import time
+from collections import OrderedDict, deque
+
+from .cache import SQLiteFile, instance_file
+
+
+class MemoryStore(object):
+    """
+    Failed attempts of the process, one bounded deque of timestamps
+    per key, the least recently failing keys are dropped first.
+    """
+    def __init__(self, maxkeys=100000):
+        self.maxkeys = maxkeys
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key, now, limit):
+        with self._lock:
+            attempts = self._keys.pop(key, None)
+            if attempts is None:
+                attempts = deque(maxlen=limit)
+            attempts.append(now)
+            self._keys[key] = attempts
+            while len(self._keys) > self.maxkeys:
+                self._keys.popitem(last=False)
+
+    def count(self, key, since):
+        with self._lock:
+            attempts = self._keys.get(key)
+            if attempts is None:
+                return 0
+            while attempts and attempts[0] <= since:
+                attempts.popleft()
+            if not attempts:
+                del self._keys[key]
+            return len(attempts)
+
+    def reset(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+
+
+class SQLiteStore(SQLiteFile):
+    """
+    Failed attempts shared by all the processes of an host
+    through a SQLite database file.
+    """
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS login_attempts '
+              '(key TEXT NOT NULL, time REAL NOT NULL)',
+              'CREATE INDEX IF NOT EXISTS ix_login_attempts_key_time '
+              'ON login_attempts (key, time)')
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, window=300, timeout=5.0):
+        super(SQLiteStore, self).__init__(path, timeout)
+        self.window = window
+        self._writes = 0
+
+    def add(self, key, now, limit):
+        connection = self._connect()
+        connection.execute('DELETE FROM login_attempts '
+                           'WHERE key = ? AND time <= ?',
+                           (key, now - self.window))
+        connection.execute('INSERT INTO login_attempts (key, time) '
+                           'VALUES (?, ?)', (key, now))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            connection.execute('DELETE FROM login_attempts WHERE time <= ?',
+                               (now - self.window,))
+
+    def count(self, key, since):
+        return self._connect().execute(
+            'SELECT count(*) FROM login_attempts WHERE key = ? AND time > ?',
+            (key, since)).fetchone()[0]
+
+    def reset(self, key):
+        self._connect().execute('DELETE FROM login_attempts WHERE key = ?',
+                                (key,))
+
+
+class LoginThrottle(object):
+    """
+    Sliding window limit of the failed sign in attempts
+    by email and by client address.
+    """
+    def __init__(self, store, email_limit=5, address_limit=20, window=300,
+                 timer=time.time):
+        self.store = store
+        self.email_limit = email_limit
+        self.address_limit = address_limit
+        self.window = window
+        self.rejected = 0
+        self._timer = timer
+
+    @staticmethod
+    def _email_key(email):
+        return 'email:%s' % email.strip().lower()
+
+    def _keys(self, email, address):
+        return ((self._email_key(email), self.email_limit),
+                ('address:%s' % address, self.address_limit))
+
+    def is_limited(self, email, address):
+        """
+        Tell if an email or a client address failed too many times
+        during the window.
+        :param email:
+        :param address:
+        :return:
+        """
+        since = self._timer() - self.window
+        for key, limit in self._keys(email, address):
+            if self.store.count(key, since) >= limit:
+                self.rejected += 1
+                return True
+        return False
+
+    def failed(self, email, address):
+        """
+        Record a failed attempt.
+        :param email:
+        :param address:
+        :return:
+        """
+        now = self._timer()
+        for key, limit in self._keys(email, address):
+            self.store.add(key, now, limit)
+
+    def succeeded(self, email):
+        """
+        Forget the failed attempts of an email after a sign in.
+        :param email:
+        :return:
+        """
+        self.store.reset(self._email_key(email))
+
+
+def init_app(app):
+    """
+    Create the login throttle configured by LOGIN_THROTTLE_BACKEND.
+    :param app:
+    :return:
+    """
+    backend = app.config['LOGIN_THROTTLE_BACKEND']
+    window = app.config['LOGIN_ATTEMPTS_WINDOW']
+    if backend == 'memory':
+        store = MemoryStore(app.config['LOGIN_THROTTLE_KEYS'])
+    elif backend == 'sqlite':
+        store = SQLiteStore(instance_file(app,
+                                          app.config['LOGIN_THROTTLE_PATH'],
+                                          'throttle.sqlite'),
+                            window)
+    else:
+        raise ValueError('Unknown login throttle backend: "%s".' % backend)
+    app.extensions['login_throttle'] = LoginThrottle(
+        store,
+        app.config['LOGIN_MAX_ATTEMPTS_EMAIL'],
+        app.config['LOGIN_MAX_ATTEMPTS_ADDRESS'],
+        window)
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+# benchmarks.py
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from flask import url_for
+
+from app import create_app, db
+from app.models import Group, Role, Tool, User, load_user
+from app.passwords import hash_password
+
+PASSWORD = 'benchmark'
+
+
+def percentile(values, fraction):
+    """
+    Return the nearest rank percentile of sorted values.
+    :param values:
+    :param fraction:
+    :return:
+    """
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1,
+                       int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def settings(path, name):
+    """
+    Return the configuration which keeps the database, the caches,
+    the metrics and the job queue in a temporary directory and lifts
+    the sign in limits. It is passed to create_app, so the extensions
+    are built with it.
+    :param path:
+    :param name:
+    :return:
+    """
+    return {'SQLALCHEMY_DATABASE_URI': 'sqlite:///%s' % os.path.join(
+                path, '%s.sqlite' % name),
+            'SQLALCHEMY_ECHO': False,
+            'CACHE_PATH': os.path.join(path, 'cache.sqlite'),
+            'LOGIN_THROTTLE_PATH': os.path.join(path, 'throttle.sqlite'),
+            'JOBS_PATH': os.path.join(path, 'jobs.sqlite'),
+            'METRICS_PATH': os.path.join(path, 'metrics'),
+            'TEMPLATE_CACHE_PATH': os.path.join(path, 'templates'),
+            'LOGIN_MAX_ATTEMPTS_EMAIL': sys.maxsize,
+            'LOGIN_MAX_ATTEMPTS_ADDRESS': sys.maxsize,
+            'SLOW_REQUEST_THRESHOLD': None}
+
+
+def seed(volumes, batch_size=1000):
+    """
+    Insert the groups, roles, tools and users with executemany INSERTs.
+    The users share one password hash, the first one is an admin.
+    :param volumes:
+    :param batch_size:
+    :return:
+    """
+    for model, count in ((Group, volumes['groups']),
+                         (Role, volumes['roles']),
+                         (Tool, volumes['tools'])):
+        name = model.__tablename__[:-1]
+        rows = [{'name': '%s%d' % (name, i),
+                 'description': 'The %s %d' % (name, i)}
+                for i in range(count)]
+        if rows:
+            db.session.execute(model.__table__.insert(), rows)
+    group_ids = [id for id, in db.session.query(Group.id)]
+    role_ids = [id for id, in db.session.query(Role.id)]
+    password_hash = hash_password(PASSWORD)
+    insert = User.__table__.insert()
+    for start in range(0, volumes['users'], batch_size):
+        rows = []
+        for i in range(start, min(start + batch_size, volumes['users'])):
+            rows.append({'email': 'user%d@bench.test' % i,
+                         'name': 'user%d' % i,
+                         'first_name': 'first%d' % i,
+                         'last_name': 'last%d' % i,
+                         'password_hash': password_hash,
+                         'group_id': random.choice(group_ids)
+                         if group_ids else None,
+                         'role_id': random.choice(role_ids)
+                         if role_ids else None,
+                         'is_admin': i == 0,
+                         'is_valid': True,
+                         'is_blocked': False})
+        db.session.execute(insert, rows)
+    db.session.commit()
+
+
+def measure(func, requests):
+    """
+    Call a function a number of times and return its throughput and
+    latency percentiles. A call fails when it raises or returns False.
+    :param func:
+    :param requests:
+    :return:
+    """
+    latencies = []
+    errors = 0
+    start = time.time()
+    for i in range(requests):
+        call_start = time.time()
+        try:
+            if func(i) is False:
+                errors += 1
+        except Exception:
+            errors += 1
+        latencies.append(time.time() - call_start)
+    seconds = time.time() - start
+    latencies.sort()
+    return {'requests': requests,
+            'errors': errors,
+            'seconds': round(seconds, 4),
+            'throughput': round(requests / seconds, 2) if seconds else 0.0,
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3)
+            if latencies else 0.0,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3)}
+
+
+def benchmarks(app, client):
+    """
+    Return the benchmarks by name, as functions of the iteration number.
+    The URLs are built beforehand, so the requests of the client run in
+    their own contexts as they would under a server.
+    :param app:
+    :param client:
+    :return:
+    """
+    with app.app_context():
+        admin = User.query.filter_by(is_admin=True).first()
+        user_ids = [id for id, in db.session.query(User.id)
+                    .filter(User.is_admin == False)]
+        group_ids = [id for id, in db.session.query(Group.id)] or [None]
+        role_ids = [id for id, in db.session.query(Role.id)] or [None]
+    with app.test_request_context():
+        urls = dict((endpoint, url_for(endpoint))
+                    for endpoint in ('admin.users', 'admin.groups',
+                                     'auth.signin'))
+        edit_urls = dict((id, url_for('admin.edit_user', id=id))
+                         for id in user_ids)
+        assign_urls = dict((id, url_for('admin.assign_user', id=id))
+                           for id in user_ids)
+    with client.session_transaction() as session:
+        session['_user_id'] = str(admin.id)
+        session['_fresh'] = True
+
+    def get(endpoint):
+        def run(i):
+            return client.get(urls[endpoint]).status_code == 200
+        return run
+
+    def signin(i):
+        response = app.test_client().post(
+            urls['auth.signin'],
+            data={'email': 'user%d@bench.test' % (i % len(user_ids) + 1),
+                  'password': PASSWORD})
+        return response.status_code == 302
+
+    def load(i):
+        with app.test_request_context():
+            return load_user(str(random.choice(user_ids))) is not None
+
+    def edit_user(i):
+        id = random.choice(user_ids)
+        with app.app_context():
+            user = db.session.query(User).get(id)
+            data = {'email': user.email,
+                    'name': user.name,
+                    'first_name': user.first_name,
+                    'last_name': 'edited%d' % i,
+                    'group': str(random.choice(group_ids)),
+                    'role': str(random.choice(role_ids)),
+                    'is_valid': 'y'}
+        response = client.post(edit_urls[id], data=data)
+        return response.status_code == 302
+
+    def assign_user(i):
+        response = client.post(assign_urls[random.choice(user_ids)],
+                               data={'group': str(random.choice(group_ids)),
+                                     'role': str(random.choice(role_ids))})
+        return response.status_code == 200
+
+    return [('admin.users', get('admin.users')),
+            ('admin.groups', get('admin.groups')),
+            ('auth.signin', signin),
+            ('load_user', load),
+            ('admin.edit_user', edit_user),
+            ('admin.assign_user', assign_user)]
+
+
+def git_commit():
+    """
+    Return the commit of the working tree, or None outside of git.
+    :return:
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Print the throughput and p99 latency changes against a baseline.
+    :param results:
+    :param baseline:
+    :return:
+    """
+    for name, result in sorted(results['results'].items()):
+        base = baseline['results'].get(name)
+        if not base or not base['throughput'] or not base['p99_ms']:
+            continue
+        print('%-20s throughput %+7.1f%%  p99 %+7.1f%%' % (
+            name,
+            (result['throughput'] / base['throughput'] - 1) * 100,
+            (result['p99_ms'] / base['p99_ms'] - 1) * 100))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the admin and auth paths on seeded data.')
+    parser.add_argument('--config', default='production',
+                        help='configuration name (default: production)')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--roles', type=int, default=10)
+    parser.add_argument('--tools', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='calls per benchmark (default: 200)')
+    parser.add_argument('--only', action='append',
+                        help='run only this benchmark, may be repeated')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare with a results JSON file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+    volumes = {'users': max(args.users, 2), 'groups': args.groups,
+               'roles': args.roles, 'tools': args.tools}
+
+    path = tempfile.mkdtemp()
+    try:
+        config = settings(path, 'benchmarks')
+        config['WTF_CSRF_ENABLED'] = False
+        app = create_app(args.config, config)
+        with app.app_context():
+            db.create_all()
+            start = time.time()
+            seed(volumes)
+            seed_seconds = time.time() - start
+            db.session.remove()
+        client = app.test_client()
+        results = {}
+        for name, func in benchmarks(app, client):
+            if args.only and name not in args.only:
+                continue
+            results[name] = measure(func, args.requests)
+            print('%-20s %8.1f req/s  p50 %8.2f ms  p99 %8.2f ms  '
+                  '%d errors' % (name, results[name]['throughput'],
+                                 results[name]['p50_ms'],
+                                 results[name]['p99_ms'],
+                                 results[name]['errors']))
+    finally:
+        shutil.rmtree(path)
+
+    output = {'commit': git_commit(),
+              'python': platform.python_version(),
+              'config': args.config,
+              'volumes': volumes,
+              'seed_seconds': round(seed_seconds, 3),
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(output, json.load(f))
+    return output
+
+
+if __name__ == '__main__':
+    main()
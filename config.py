@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 # config.py
 
+import os
+import tempfile
+
 
 class Config(object):
     """
@@ -12,6 +15,79 @@ class Config(object):
     WTF_CSRF_HEADERS = ['X-CSRFToken', 'X-CSRF-Token']
     WTF_CSRF_TIME_LIMIT = 3600
     WTF_CSRF_SSL_STRICT = True
+    DATABASE_POOL_SIZE = None
+    DATABASE_MAX_OVERFLOW = None
+    DATABASE_POOL_TIMEOUT = None
+    DATABASE_POOL_RECYCLE = None
+    DATABASE_POOL_PRE_PING = None
+    DATABASE_STATEMENT_TIMEOUT = None
+    DATABASE_READ_BINDS = ()
+    DATABASE_REPLICA_STICKY = 5
+    SQLITE_JOURNAL_MODE = None
+    SQLITE_SYNCHRONOUS = None
+    SQLITE_BUSY_TIMEOUT = 5000
+    SQLITE_MMAP_SIZE = None
+    PAGE_SIZE = 50
+    PAGE_SIZE_MAX = 500
+    STREAM_LISTS = False
+    STREAM_BUFFER = 16
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 300
+    CACHE_BACKEND = 'memory'
+    CACHE_PATH = None
+    CACHE_SIZE = 10000
+    CACHE_DEFAULT_TTL = 300
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256'
+    PASSWORD_HASH_ITERATIONS = 150000
+    PASSWORD_SALT_LENGTH = 16
+    PASSWORD_POOL_WORKERS = 0
+    PASSWORD_POOL_QUEUE = 32
+    PASSWORD_POOL_TIMEOUT = 10
+    PASSWORD_POOL_RETRY_AFTER = 5
+    LOGIN_THROTTLE_BACKEND = 'memory'
+    LOGIN_THROTTLE_PATH = None
+    LOGIN_THROTTLE_KEYS = 100000
+    LOGIN_MAX_ATTEMPTS_EMAIL = 5
+    LOGIN_MAX_ATTEMPTS_ADDRESS = 20
+    LOGIN_ATTEMPTS_WINDOW = 300
+    BULK_BATCH_SIZE = 1000
+    EXPORT_CHUNK_SIZE = 1000
+    USERS_FTS = False
+    API_BATCH_MAX = 1000
+    API_TOKEN_TTL = 3600
+    AUDIT = True
+    AUDIT_QUEUE_SIZE = 10000
+    AUDIT_BATCH_SIZE = 100
+    AUDIT_FLUSH_INTERVAL = 1.0
+    JOBS_PATH = None
+    JOBS_MAX_ATTEMPTS = 3
+    JOBS_BACKOFF = 10.0
+    JOBS_LEASE = 300.0
+    JOBS_POLL = 1.0
+    JOBS_REFRESH = 2
+    JOBS_IMPORTS = False
+    TEMPLATE_CACHE = False
+    TEMPLATE_CACHE_PATH = None
+    FRAGMENT_CACHE = True
+    FRAGMENT_CACHE_TTL = 3600
+    CONDITIONAL_GET = True
+    CONDITIONAL_GET_TTL = 86400
+    STATIC_FINGERPRINT = True
+    STATIC_MAX_AGE = 31536000
+    STATIC_HASH_CACHE_SIZE = 1024
+    COMPRESS_HTML = True
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_LEVEL = 6
+    INSTRUMENTATION = True
+    SLOW_REQUEST_THRESHOLD = 1.0
+    SLOW_REQUEST_STATEMENTS = 50
+    SERVER_TIMING = False
+    METRICS = True
+    METRICS_BACKEND = 'memory'
+    METRICS_PATH = None
+    METRICS_FLUSH_INTERVAL = 1.0
+    METRICS_ALLOWED_ADDRESSES = ('127.0.0.1', '::1')
+    PROXY_FIX_X_FOR = 0
 
 
 class DevelopmentConfig(Config):
@@ -22,6 +98,7 @@ class DevelopmentConfig(Config):
     DEBUG = True
     SQLALCHEMY_ECHO = True
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SERVER_TIMING = True
 
 
 class TestingConfig(Config):
@@ -32,6 +109,8 @@ class TestingConfig(Config):
     DEBUG = True
     SQLALCHEMY_ECHO = True
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+    PASSWORD_HASH_ITERATIONS = 1
+    JOBS_PATH = os.path.join(tempfile.gettempdir(), 'jobs-testing.sqlite')
 
 
 class ProductionConfig(Config):
@@ -41,6 +120,21 @@ class ProductionConfig(Config):
     TESTING = False
     DEBUG = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DATABASE_POOL_SIZE = 5
+    DATABASE_MAX_OVERFLOW = 10
+    DATABASE_POOL_TIMEOUT = 10
+    DATABASE_POOL_RECYCLE = 1800
+    DATABASE_POOL_PRE_PING = True
+    DATABASE_STATEMENT_TIMEOUT = 30000
+    SQLITE_JOURNAL_MODE = 'WAL'
+    SQLITE_SYNCHRONOUS = 'NORMAL'
+    SQLITE_MMAP_SIZE = 268435456
+    TEMPLATES_AUTO_RELOAD = False
+    TEMPLATE_CACHE = True
+    CACHE_BACKEND = 'sqlite'
+    PASSWORD_POOL_WORKERS = 2
+    LOGIN_THROTTLE_BACKEND = 'sqlite'
+    METRICS_BACKEND = 'files'
 
 
 app_config = {'development':  DevelopmentConfig,
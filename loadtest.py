@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+# loadtest.py
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+try:
+    from cookielib import CookieJar
+    from urllib import urlencode
+    from urllib2 import (HTTPCookieProcessor, HTTPError, HTTPRedirectHandler,
+                         URLError, build_opener)
+except ImportError:
+    from http.cookiejar import CookieJar
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlencode
+    from urllib.request import (HTTPCookieProcessor, HTTPRedirectHandler,
+                                build_opener)
+
+from werkzeug.serving import make_server
+
+from app import create_app, db
+from benchmarks import PASSWORD, percentile, seed, settings
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+OPTION = re.compile(r'<option[^>]* value="(\d+)"')
+
+
+def make_app(config, path):
+    """
+    Create the application of run.py with its database, caches and
+    metrics in a temporary directory and without the sign in limits.
+    :param config:
+    :param path:
+    :return:
+    """
+    return create_app(config, settings(path, 'loadtest'))
+
+
+def listen(port):
+    """
+    Open the listening socket shared by the worker processes.
+    :param port:
+    :return:
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(128)
+    return sock
+
+
+def serve(config, path, fd):
+    """
+    Run a worker process of the werkzeug server. Like the workers of
+    a prefork server such as gunicorn, it creates its application once
+    and then accepts the connections of the shared listening socket one
+    at a time, instead of forking for each request.
+    :param config:
+    :param path:
+    :param fd:
+    :return:
+    """
+    app = make_app(config, path)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    make_server('127.0.0.1', 0, app, fd=fd).serve_forever()
+
+
+def wait_for(port, timeout=30):
+    """
+    Wait until the server answers requests, the listening socket
+    accepts connections before the workers have started.
+    :param port:
+    :param timeout:
+    :return:
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            Session('http://127.0.0.1:%d' % port).request('/')
+            return
+        except (URLError, socket.error):
+            time.sleep(0.1)
+    raise RuntimeError('The server did not start on port %d.' % port)
+
+
+class NoRedirect(HTTPRedirectHandler):
+    """
+    Answer redirects as they are, to measure each request on its own.
+    """
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Session(object):
+    """
+    HTTP client keeping the cookies of a browser session.
+    """
+    def __init__(self, base):
+        self.base = base
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()),
+                                   NoRedirect())
+
+    def request(self, path, data=None):
+        """
+        Send a GET, or a POST when data is given, and return
+        the status and the body.
+        :param path:
+        :param data:
+        :return:
+        """
+        if data is not None:
+            data = urlencode(data).encode('ascii')
+        try:
+            response = self.opener.open(self.base + path, data, timeout=30)
+        except HTTPError as error:
+            response = error
+        try:
+            return response.code, response.read().decode('utf-8')
+        finally:
+            response.close()
+
+    def form(self, path):
+        """
+        Load a form page and return the CSRF token and the option
+        values of its select fields.
+        :param path:
+        :return:
+        """
+        status, body = self.request(path)
+        match = CSRF_TOKEN.search(body)
+        if status != 200 or match is None:
+            raise ValueError('No form at %s.' % path)
+        return match.group(1), OPTION.findall(body)
+
+    def signin(self, email):
+        token, options = self.form('/signin')
+        status, body = self.request('/signin', {'csrf_token': token,
+                                                'email': email,
+                                                'password': PASSWORD})
+        return status == 302
+
+
+def signin(session, users):
+    """
+    Sign in a random user, in a new session.
+    :param session:
+    :param users:
+    :return:
+    """
+    return Session(session.base).signin(
+        'user%d@bench.test' % random.randint(1, users - 1))
+
+
+def browse(session, users):
+    """
+    Load one of the admin lists.
+    :param session:
+    :param users:
+    :return:
+    """
+    path = random.choice(('/admin/users', '/admin/groups', '/admin/roles',
+                          '/admin/tools'))
+    return session.request(path)[0] == 200
+
+
+def submit(session, users):
+    """
+    Load the edit form of a random user and submit it.
+    :param session:
+    :param users:
+    :return:
+    """
+    i = random.randint(1, users - 1)
+    path = '/admin/users/edit/user-%d' % (i + 1)
+    token, options = session.form(path)
+    data = {'csrf_token': token,
+            'email': 'user%d@bench.test' % i,
+            'name': 'user%d' % i,
+            'first_name': 'first%d' % i,
+            'last_name': 'last%d' % random.randint(0, 1000),
+            'is_valid': 'y'}
+    if options:
+        data['group'] = data['role'] = random.choice(options)
+    return session.request(path, data)[0] == 302
+
+
+SCENARIOS = {'signin': signin, 'browse': browse, 'submit': submit}
+
+
+def run_level(base, scenario, concurrency, duration, users):
+    """
+    Run a scenario with concurrent sessions for a number of seconds.
+    The admin sessions of the browse and submit scenarios are signed in
+    before the clock starts.
+    :param base:
+    :param scenario:
+    :param concurrency:
+    :param duration:
+    :param users:
+    :return:
+    """
+    func = SCENARIOS[scenario]
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    sessions = [Session(base) for _ in range(concurrency)]
+    if scenario != 'signin':
+        for session in sessions:
+            if not session.signin('user0@bench.test'):
+                raise RuntimeError('The admin could not sign in.')
+
+    def work(session):
+        while time.time() < deadline:
+            start = time.time()
+            try:
+                ok = func(session, users)
+            except (URLError, socket.error, ValueError):
+                ok = False
+            latency = time.time() - start
+            with lock:
+                latencies.append(latency)
+                if not ok:
+                    errors[0] += 1
+
+    start = time.time()
+    deadline = start + duration
+    threads = [threading.Thread(target=work, args=(session,))
+               for session in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+    latencies.sort()
+    count = len(latencies)
+    return {'scenario': scenario,
+            'concurrency': concurrency,
+            'requests': count,
+            'errors': errors[0],
+            'error_rate': round(float(errors[0]) / count, 4) if count else 1.0,
+            'throughput': round(count / seconds, 2),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load test the application under a WSGI server.')
+    parser.add_argument('--config', default='production',
+                        help='configuration name (default: production)')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--processes', type=int, default=4,
+                        help='persistent server worker processes '
+                             '(default: 4)')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--roles', type=int, default=5)
+    parser.add_argument('--tools', type=int, default=20)
+    parser.add_argument('--scenario', action='append',
+                        choices=sorted(SCENARIOS),
+                        help='scenario to run, may be repeated '
+                             '(default: all)')
+    parser.add_argument('--concurrency', default='1,4,16',
+                        help='comma separated session counts '
+                             '(default: 1,4,16)')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds per scenario and level (default: 10)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+    volumes = {'users': max(args.users, 2), 'groups': args.groups,
+               'roles': args.roles, 'tools': args.tools}
+
+    path = tempfile.mkdtemp()
+    sock = None
+    workers = []
+    try:
+        app = make_app(args.config, path)
+        with app.app_context():
+            db.create_all()
+            seed(volumes)
+            db.session.remove()
+            db.engine.dispose()
+        sock = listen(args.port)
+        for i in range(args.processes):
+            worker = multiprocessing.Process(
+                target=serve, args=(args.config, path, sock.fileno()))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        wait_for(args.port)
+        base = 'http://127.0.0.1:%d' % args.port
+        results = []
+        for scenario in args.scenario or sorted(SCENARIOS):
+            for concurrency in [int(level) for level in
+                                args.concurrency.split(',')]:
+                result = run_level(base, scenario, concurrency,
+                                   args.duration, volumes['users'])
+                results.append(result)
+                print('%-8s x%-4d %8.1f req/s  p50 %8.2f ms  p95 %8.2f ms  '
+                      'p99 %8.2f ms  errors %5.1f%%' % (
+                          scenario, concurrency, result['throughput'],
+                          result['p50_ms'], result['p95_ms'],
+                          result['p99_ms'], result['error_rate'] * 100))
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        if sock is not None:
+            sock.close()
+        shutil.rmtree(path)
+
+    output = {'config': args.config,
+              'processes': args.processes,
+              'volumes': volumes,
+              'duration': args.duration,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    return output
+
+
+if __name__ == '__main__':
+    main()
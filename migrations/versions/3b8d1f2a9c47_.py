@@ -0,0 +1,71 @@
+"""add users search indexes
+
+Revision ID: 3b8d1f2a9c47
+Revises: cf6e07f93b5f
+Create Date: 2026-10-17 10:12:41.208314
+
+"""
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8d1f2a9c47'
+down_revision = 'cf6e07f93b5f'
+branch_labels = None
+depends_on = None
+
+# The full text index as it was at this revision, not imported from the app.
+fts_schema = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+    "name, first_name, last_name, email, "
+    "content='users', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users "
+    "BEGIN "
+    "INSERT INTO users_fts (rowid, name, first_name, last_name, email) "
+    "VALUES (new.id, new.name, new.first_name, new.last_name, new.email); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users "
+    "BEGIN "
+    "INSERT INTO users_fts (users_fts, rowid, name, first_name, last_name, "
+    "email) VALUES ('delete', old.id, old.name, old.first_name, "
+    "old.last_name, old.email); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_update "
+    "AFTER UPDATE OF email, name, first_name, last_name ON users "
+    "BEGIN "
+    "INSERT INTO users_fts (users_fts, rowid, name, first_name, last_name, "
+    "email) VALUES ('delete', old.id, old.name, old.first_name, "
+    "old.last_name, old.email); "
+    "INSERT INTO users_fts (rowid, name, first_name, last_name, email) "
+    "VALUES (new.id, new.name, new.first_name, new.last_name, new.email); "
+    "END",
+    "INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+fts_drop = ('DROP TRIGGER IF EXISTS users_fts_update',
+            'DROP TRIGGER IF EXISTS users_fts_delete',
+            'DROP TRIGGER IF EXISTS users_fts_insert',
+            'DROP TABLE IF EXISTS users_fts')
+
+
+def use_fts():
+    return (op.get_bind().dialect.name == 'sqlite' and
+            current_app.config.get('USERS_FTS', False))
+
+
+def upgrade():
+    op.create_index('ix_users_group_id_id', 'users', ['group_id', 'id'], unique=False)
+    op.create_index('ix_users_role_id_id', 'users', ['role_id', 'id'], unique=False)
+    op.create_index('ix_users_flags_id', 'users', ['is_admin', 'is_valid', 'is_blocked', 'id'], unique=False)
+    if use_fts():
+        for statement in fts_schema:
+            op.execute(statement)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        for statement in fts_drop:
+            op.execute(statement)
+    op.drop_index('ix_users_flags_id', table_name='users')
+    op.drop_index('ix_users_role_id_id', table_name='users')
+    op.drop_index('ix_users_group_id_id', table_name='users')
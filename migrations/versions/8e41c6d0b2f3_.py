@@ -0,0 +1,39 @@
+"""add audit events
+
+Revision ID: 8e41c6d0b2f3
+Revises: 3b8d1f2a9c47
+Create Date: 2026-10-17 14:36:05.118240
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e41c6d0b2f3'
+down_revision = '3b8d1f2a9c47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('audit_events',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('action', sa.String(length=20), nullable=True),
+    sa.Column('target', sa.String(length=20), nullable=True),
+    sa.Column('target_id', sa.Integer(), nullable=True),
+    sa.Column('details', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_audit_events_created_at'), 'audit_events', ['created_at'], unique=False)
+    op.create_index(op.f('ix_audit_events_user_id'), 'audit_events', ['user_id'], unique=False)
+    op.create_index('ix_audit_events_target', 'audit_events', ['target', 'target_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_audit_events_target', table_name='audit_events')
+    op.drop_index(op.f('ix_audit_events_user_id'), table_name='audit_events')
+    op.drop_index(op.f('ix_audit_events_created_at'), table_name='audit_events')
+    op.drop_table('audit_events')
@@ -0,0 +1,26 @@
+"""add users token generation
+
+Revision ID: d4f7a2c9e615
+Revises: 8e41c6d0b2f3
+Create Date: 2026-10-17 21:08:33.640127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4f7a2c9e615'
+down_revision = '8e41c6d0b2f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.add_column(sa.Column('token_generation', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('token_generation')
@@ -1,14 +1,41 @@
 # -*- coding: utf-8 -*-
 # tests.py
 
+import gzip
+import io
+import json
+import logging
 import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
 
-from flask import abort, url_for
+from flask import abort, g, url_for
 from flask_testing import TestCase
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.security import generate_password_hash
 
-from app import create_app, db
-from app.models import User, Group, Role, Tool
+from app import cache, create_app, db
+from app.audit import AuditWriter
+from app.admin.choices import group_choices
+from app.admin.search import install_fts, uninstall_fts
+from app.admin.tasks import save_upload
+from app.assets import static_hash
+from app.cache import LRUCache, SQLiteBackend
+from app.commands import replicas_cli, static_cli, templates_cli
+from app.fragments import invalidate_fragments
+from app.jobs import JobStore, Worker
+from app.metrics import Metrics, render
+from app.models import (AuditEvent, User, Group, Role, Tool, invalidate_user,
+                        load_user)
+from app.passwords import HashingPool, PoolBusy
+from app.throttle import LoginThrottle, MemoryStore, SQLiteStore
 
 
 basedir = os.path.abspath(os.path.dirname(__file__)) + str('/instance')
@@ -69,11 +96,25 @@ class TestBase(TestCase):
         db.session.add(test_user_admin_valid_blocked)
         db.session.commit()
 
+    def signin(self, email):
+        """
+        Sign in an user by writing its id into the session.
+        :param email:
+        :return:
+        """
+        user = User.query.filter_by(email=email).first()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+            session['_fresh'] = True
+        return user
+
     def tearDown(self):
         """
         Will be called after every test.
         :return:
         """
+        if 'audit' in self.app.extensions:
+            self.app.extensions['audit'].close()
         db.session.remove()
         db.drop_all()
 
@@ -225,6 +266,1922 @@ class TestView(TestBase):
         self.assertRedirects(response, redirect_url)
 
 
+class TestPagination(TestBase):
+    """
+    Keyset pagination testcase.
+    """
+    def setUp(self):
+        super(TestPagination, self).setUp()
+        for i in range(5):
+            db.session.add(Tool(name='tool%d' % i,
+                                description='The tool %d' % i))
+        db.session.commit()
+        self.signin('test3@test.test')
+
+    def test_first_page(self):
+        """
+        Test that the first page is limited to the page size
+        and links to the next page.
+        :return:
+        """
+        response = self.client.get(url_for('admin.tools', size=2))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('tool1', response.data)
+        self.assertNotIn('tool2', response.data)
+        self.assertIn('after=2', response.data)
+        self.assertNotIn('before=', response.data)
+
+    def test_next_and_previous_page(self):
+        """
+        Test that the cursors move forward and backward.
+        :return:
+        """
+        response = self.client.get(url_for('admin.tools', size=2, after=2))
+        self.assertIn('tool2', response.data)
+        self.assertIn('tool3', response.data)
+        self.assertNotIn('tool1', response.data)
+        self.assertIn('before=3', response.data)
+        self.assertIn('after=4', response.data)
+        response = self.client.get(url_for('admin.tools', size=2, before=3))
+        self.assertIn('tool0', response.data)
+        self.assertIn('tool1', response.data)
+        self.assertNotIn('tool2', response.data)
+        self.assertNotIn('before=', response.data)
+
+    def test_streamed_page(self):
+        """
+        Test that a streamed page renders the same rows and cursors.
+        :return:
+        """
+        response = self.client.get(url_for('admin.tools', size=2, stream=1))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertIn('tool1', response.data)
+        self.assertNotIn('tool2', response.data)
+        self.assertIn('after=2', response.data)
+
+
+class TestQueryCount(TestBase):
+    """
+    SQL statements count testcase.
+    """
+    def add_users(self, start, count):
+        """
+        Add users, each one in its own group and role.
+        :param start:
+        :param count:
+        :return:
+        """
+        for i in range(start, start + count):
+            group = Group(name='group%d' % i, description='The group %d' % i)
+            role = Role(name='role%d' % i, description='The role %d' % i)
+            db.session.add(User(email='user%d@test.test' % i,
+                                name='user%d' % i,
+                                first_name='user%d' % i,
+                                last_name='user%d' % i,
+                                group=group,
+                                role=role))
+        db.session.commit()
+        db.session.expunge_all()
+
+    def count_statements(self, url):
+        """
+        Count the SQL statements emitted while requesting an url.
+        :param url:
+        :return:
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(response.status_code, 200)
+        return len(statements)
+
+    def test_users_list_query_count(self):
+        """
+        Test that listing users does not query each group and role.
+        :return:
+        """
+        self.signin('test3@test.test')
+        self.add_users(0, 3)
+        self.client.get(url_for('home.admin'))
+        few = self.count_statements(url_for('admin.users'))
+        self.add_users(3, 6)
+        many = self.count_statements(url_for('admin.users'))
+        self.assertEqual(few, many)
+
+    def test_groups_list_query_count(self):
+        """
+        Test that listing groups counts their users in one query, and
+        that a cached list is not queried again.
+        :return:
+        """
+        self.signin('test3@test.test')
+        self.add_users(0, 3)
+        self.client.get(url_for('home.admin'))
+        few = self.count_statements(url_for('admin.groups'))
+        self.add_users(3, 6)
+        invalidate_fragments('groups')
+        many = self.count_statements(url_for('admin.groups'))
+        self.assertEqual(few, many)
+        self.assertEqual(self.count_statements(url_for('admin.groups')),
+                         many - 2)
+
+    def test_edit_user_query_count(self):
+        """
+        Test that the edit user page loads the group and role with the user.
+        :return:
+        """
+        self.signin('test3@test.test')
+        self.add_users(0, 1)
+        self.client.get(url_for('home.admin'))
+        id = User.query.filter_by(name='user0').first().id
+        db.session.expunge_all()
+        self.assertEqual(
+            self.count_statements(url_for('admin.edit_user', id=id)), 1)
+
+
+class TestUserCache(TestBase):
+    """
+    Session user loader cache testcase.
+    """
+    def test_lru_cache(self):
+        """
+        Test the eviction and expiration of the cache entries.
+        :return:
+        """
+        now = [0]
+        cache = LRUCache(maxsize=2, ttl=10, timer=lambda: now[0])
+        cache.set(1, 'one')
+        cache.set(2, 'two')
+        self.assertEqual(cache.get(1), 'one')
+        cache.set(3, 'three')
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(3), 'three')
+        now[0] = 10
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_load_user_is_cached(self):
+        """
+        Test that the user loader queries the database once.
+        :return:
+        """
+        user = User.query.filter_by(email='test1@test.test').first()
+        self.assertEqual(load_user(user.id).name, 'test1')
+        self.assertEqual(load_user(str(user.id)).name, 'test1')
+        stats = self.app.extensions['user_cache'].stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_edit_user_invalidates_cache(self):
+        """
+        Test that demoting the signed in user takes effect
+        on the next request.
+        :return:
+        """
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        group = Group(name='Tester Group', description='The Tester Group')
+        role = Role(name='Test Role', description='The Test Role')
+        db.session.add_all([group, role])
+        db.session.commit()
+        user = self.signin('test3@test.test')
+        response = self.client.get(url_for('home.admin'))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(url_for('admin.edit_user', id=user.id),
+                                    data={'email': 'test3@test.test',
+                                          'name': 'test3',
+                                          'first_name': 'tester3',
+                                          'last_name': 'tester3',
+                                          'group': str(group.id),
+                                          'role': str(role.id)})
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get(url_for('home.admin'))
+        self.assertEqual(response.status_code, 403)
+
+
+class TestCache(TestBase):
+    """
+    Shared cache testcase.
+    """
+    def test_bump_invalidates_namespace(self):
+        """
+        Test that bumping a namespace generation hides its entries
+        but not the entries of other namespaces.
+        :return:
+        """
+        cache.set('groups', 'list', ['one'])
+        cache.set('roles', 'list', ['two'])
+        self.assertEqual(cache.get('groups', 'list'), ['one'])
+        cache.bump('groups')
+        self.assertIsNone(cache.get('groups', 'list'))
+        self.assertEqual(cache.get('roles', 'list'), ['two'])
+
+    def test_sqlite_backend_is_shared(self):
+        """
+        Test that two SQLite backends on the same file,
+        as in two workers, see each other writes.
+        :return:
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'cache.sqlite')
+            first, second = SQLiteBackend(path), SQLiteBackend(path)
+            first.set('key', {'value': 1})
+            self.assertEqual(second.get('key'), {'value': 1})
+            self.assertEqual(second.generation('users'), 0)
+            first.bump('users')
+            self.assertEqual(second.generation('users'), 1)
+            self.assertEqual(second.bump('users'), 2)
+            self.assertEqual(first.generations(('users', 'user:1')), [2, 0])
+            second.set('expired', 1, ttl=-1)
+            self.assertIsNone(first.get('expired'))
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestPassword(TestBase):
+    """
+    Password hashing testcase.
+    """
+    def test_password_uses_configured_method(self):
+        """
+        Test that passwords are hashed with the configured parameters.
+        :return:
+        """
+        user = User.query.filter_by(email='test1@test.test').first()
+        self.assertTrue(user.password_hash.startswith('pbkdf2:sha256:1$'))
+        self.assertFalse(user.needs_rehash())
+        self.assertTrue(user.verify_password('test1'))
+
+    def test_signin_rehashes_outdated_password(self):
+        """
+        Test that signing in upgrades an hash made with other parameters.
+        :return:
+        """
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        user = User.query.filter_by(email='test1@test.test').first()
+        user.password_hash = generate_password_hash('test1',
+                                                    method='pbkdf2:sha1:2')
+        db.session.commit()
+        self.assertTrue(user.needs_rehash())
+        response = self.client.post(url_for('auth.signin'),
+                                    data={'email': 'test1@test.test',
+                                          'password': 'test1'})
+        self.assertEqual(response.status_code, 302)
+        user = User.query.filter_by(email='test1@test.test').first()
+        self.assertFalse(user.needs_rehash())
+        self.assertTrue(user.verify_password('test1'))
+
+
+class TestHashingPool(TestBase):
+    """
+    Hashing pool testcase.
+    """
+    def fill(self, pool):
+        """
+        Keep the single worker of a pool busy and fill its queue.
+        :param pool:
+        :return:
+        """
+        release = threading.Event()
+        running = threading.Event()
+
+        def block():
+            running.set()
+            release.wait()
+        for func in (block, release.wait):
+            thread = threading.Thread(target=pool.call, args=(func,))
+            thread.daemon = True
+            thread.start()
+            running.wait(5)
+        while pool.depth < 1:
+            running.wait(0.01)
+        return release
+
+    def test_pool_runs_calls(self):
+        """
+        Test that the pool returns results and raises errors of the calls.
+        :return:
+        """
+        pool = HashingPool(workers=2, queue_size=4)
+        self.assertEqual(pool.call(sum, [1, 2]), 3)
+        self.assertRaises(ZeroDivisionError, pool.call, divmod, 1, 0)
+
+    def test_pool_maps_batches(self):
+        """
+        Test that a batch larger than the queue waits for room in it.
+        :return:
+        """
+        pool = HashingPool(workers=2, queue_size=2)
+        self.assertEqual(pool.map(abs, range(-20, 0)), list(range(20, 0, -1)))
+        self.assertRaises(TypeError, pool.map, abs, ['x'])
+
+    def test_batches_leave_room_for_calls(self):
+        """
+        Test that the calls are not rejected while a batch runs.
+        :return:
+        """
+        pool = HashingPool(workers=2, queue_size=4)
+
+        def slow(value):
+            time.sleep(0.005)
+            return value
+        thread = threading.Thread(target=pool.map, args=(slow, range(100)))
+        thread.start()
+        try:
+            for i in range(20):
+                self.assertEqual(pool.call(sum, [i]), i)
+                self.assertLessEqual(pool.depth, 2)
+        finally:
+            thread.join()
+        self.assertEqual(pool.rejected, 0)
+
+    def test_full_pool_rejects_calls(self):
+        """
+        Test that a call is rejected when the queue is full.
+        :return:
+        """
+        pool = HashingPool(workers=1, queue_size=1)
+        release = self.fill(pool)
+        try:
+            self.assertRaises(PoolBusy, pool.call, sum, [1])
+            self.assertEqual(pool.rejected, 1)
+        finally:
+            release.set()
+
+    def test_timed_out_calls_are_skipped(self):
+        """
+        Test that a call which timed out is not run by the pool later.
+        :return:
+        """
+        pool = HashingPool(workers=1, queue_size=2, timeout=0.05)
+        release = self.fill(pool)
+        calls = []
+        try:
+            self.assertRaises(PoolBusy, pool.call, calls.append, 1)
+        finally:
+            release.set()
+        while pool.depth:
+            time.sleep(0.01)
+        self.assertEqual(pool.call(sum, [1]), 1)
+        self.assertEqual(calls, [])
+
+    def test_signin_on_full_pool(self):
+        """
+        Test that signin answers 503 with Retry-After when the pool is full.
+        :return:
+        """
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        pool = HashingPool(workers=1, queue_size=1)
+        self.app.extensions['hashing_pool'] = pool
+        release = self.fill(pool)
+        try:
+            response = self.client.post(url_for('auth.signin'),
+                                        data={'email': 'test1@test.test',
+                                              'password': 'test1'})
+        finally:
+            release.set()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+
+
+class TestLoginThrottle(TestBase):
+    """
+    Login throttle testcase.
+    """
+    def check_window(self, store):
+        """
+        Test that attempts older than the window are forgotten.
+        :param store:
+        :return:
+        """
+        now = [0]
+        throttle = LoginThrottle(store, email_limit=2, address_limit=3,
+                                 window=10, timer=lambda: now[0])
+        throttle.failed('a@test.test', '1.1.1.1')
+        now[0] = 5
+        throttle.failed('A@test.test', '1.1.1.1')
+        self.assertTrue(throttle.is_limited('a@test.test', '2.2.2.2'))
+        self.assertFalse(throttle.is_limited('b@test.test', '1.1.1.1'))
+        throttle.failed('b@test.test', '1.1.1.1')
+        self.assertTrue(throttle.is_limited('c@test.test', '1.1.1.1'))
+        now[0] = 10
+        self.assertFalse(throttle.is_limited('a@test.test', '2.2.2.2'))
+        throttle.succeeded('b@test.test')
+        self.assertFalse(throttle.is_limited('b@test.test', '3.3.3.3'))
+
+    def test_memory_store(self):
+        """
+        Test the sliding window with the process store.
+        :return:
+        """
+        self.check_window(MemoryStore())
+
+    def test_sqlite_store(self):
+        """
+        Test the sliding window with the shared SQLite store.
+        :return:
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            self.check_window(SQLiteStore(os.path.join(directory,
+                                                       'throttle.sqlite')))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_signin_is_throttled(self):
+        """
+        Test that signin is rejected before looking up the user
+        once an email failed too many times.
+        :return:
+        """
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        data = {'email': 'test1@test.test', 'password': 'wrong'}
+        for _ in range(5):
+            response = self.client.post(url_for('auth.signin'), data=data)
+            self.assertEqual(response.status_code, 200)
+        data['password'] = 'test1'
+        response = self.client.post(url_for('auth.signin'), data=data)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '300')
+
+    def test_blocked_user_can_not_signin(self):
+        """
+        Test that a blocked user is not signed in.
+        :return:
+        """
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        response = self.client.post(url_for('auth.signin'),
+                                    data={'email': 'test4@test.test',
+                                          'password': 'test4'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('This account is blocked.', response.data)
+        response = self.client.post(url_for('auth.signin'),
+                                    data={'email': 'test4@test.test',
+                                          'password': 'wrong'})
+        self.assertNotIn('This account is blocked.', response.data)
+        self.assertIn('Invalid email or password.', response.data)
+
+
+class TestBulk(TestBase):
+    """
+    Bulk import and export testcase.
+    """
+    def setUp(self):
+        super(TestBulk, self).setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        db.session.add(Group(name='Tester Group',
+                             description='The Tester Group'))
+        db.session.add(Role(name='Test Role', description='The Test Role'))
+        db.session.commit()
+        self.signin('test3@test.test')
+
+    def upload(self, content, filename):
+        """
+        Post a file to the import view.
+        :param content:
+        :param filename:
+        :return:
+        """
+        return self.client.post(url_for('admin.import_users'),
+                                data={'file': (io.BytesIO(content), filename)},
+                                content_type='multipart/form-data')
+
+    def test_import_csv(self):
+        """
+        Test that a CSV file adds users with their group, role and password.
+        :return:
+        """
+        response = self.upload(b'email,name,password,group,role,is_valid\n'
+                               b'a@test.test,a,secret,Tester Group,Test Role,1\n'
+                               b'b@test.test,b,,,,false\n', 'users.csv')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(User.query.count(), 6)
+        user = User.query.filter_by(name='a').first()
+        self.assertEqual(user.group.name, 'Tester Group')
+        self.assertEqual(user.role.name, 'Test Role')
+        self.assertTrue(user.is_valid)
+        self.assertTrue(user.verify_password('secret'))
+        self.assertIsNone(User.query.filter_by(name='b').first().group)
+
+    def test_import_json_unknown_group(self):
+        """
+        Test that an unknown group rolls back the whole import.
+        :return:
+        """
+        users = [{'email': 'a@test.test', 'name': 'a'},
+                 {'email': 'b@test.test', 'name': 'b', 'group': 'Nope'}]
+        self.upload(json.dumps(users).encode('utf-8'), 'users.json')
+        self.assertEqual(User.query.count(), 4)
+
+    def test_import_json_integer_flags(self):
+        """
+        Test that flags written as 0 or 1 are read, and other values
+        refused.
+        :return:
+        """
+        users = [{'email': 'a@test.test', 'name': 'a', 'is_valid': 1,
+                  'is_blocked': 0}]
+        self.upload(json.dumps(users).encode('utf-8'), 'users.json')
+        self.assertTrue(User.query.filter_by(name='a').first().is_valid)
+        users = [{'email': 'b@test.test', 'name': 'b', 'is_valid': 2}]
+        response = self.upload(json.dumps(users).encode('utf-8'),
+                               'users.json')
+        self.assertEqual(response.status_code, 302)
+        self.assertIsNone(User.query.filter_by(name='b').first())
+
+    def test_export(self):
+        """
+        Test that the exports list all users in chunks.
+        :return:
+        """
+        self.app.config['EXPORT_CHUNK_SIZE'] = 3
+        response = self.client.get(url_for('admin.export_users',
+                                           format='csv'))
+        self.assertTrue(response.is_streamed)
+        lines = response.data.splitlines()
+        self.assertEqual(lines[0], 'id,email,name,first_name,last_name,'
+                                   'group,role,is_admin,is_valid,is_blocked')
+        self.assertEqual(len(lines), 5)
+        response = self.client.get(url_for('admin.export_users',
+                                           format='json'))
+        users = json.loads(response.data)
+        self.assertEqual([user['name'] for user in users],
+                         ['test1', 'test2', 'test3', 'test4'])
+
+
+class TestBatch(TestBase):
+    """
+    Batch users operations testcase.
+    """
+    def setUp(self):
+        super(TestBatch, self).setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.signin('test3@test.test')
+
+    def batch(self, **data):
+        """
+        Post a JSON batch operation.
+        :param data:
+        :return:
+        """
+        return self.client.post(url_for('admin.batch_users'),
+                                data=json.dumps(data),
+                                content_type='application/json')
+
+    def test_block_by_ids(self):
+        """
+        Test that blocking users by ids updates them and their cache.
+        :return:
+        """
+        ids = [user.id for user in User.query.filter(
+            User.name.in_(['test1', 'test2']))]
+        self.assertFalse(load_user(ids[0]).is_blocked)
+        response = self.batch(action='block', ids=ids)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['count'], 2)
+        self.assertTrue(load_user(ids[0]).is_blocked)
+        self.assertEqual(User.query.filter_by(is_blocked=True).count(), 3)
+
+    def test_delete_by_filter_spares_admins(self):
+        """
+        Test that deleting by filter does not delete admins.
+        :return:
+        """
+        response = self.batch(action='delete', filter={'is_blocked': '0'})
+        self.assertEqual(json.loads(response.data)['count'], 1)
+        self.assertEqual(User.query.count(), 3)
+
+    def test_assign(self):
+        """
+        Test that assigning sets the group and role of non admins only.
+        :return:
+        """
+        group = Group(name='Tester Group', description='The Tester Group')
+        role = Role(name='Test Role', description='The Test Role')
+        db.session.add_all([group, role])
+        db.session.commit()
+        response = self.batch(action='assign', filter={'is_valid': False},
+                              group_id=group.id, role_id=role.id)
+        self.assertEqual(json.loads(response.data)['count'], 1)
+        self.assertEqual(group.users.count(), 1)
+
+    def test_invalid_batch(self):
+        """
+        Test that unknown actions and empty selections are refused.
+        :return:
+        """
+        self.assertEqual(self.batch(action='drop', ids=[1]).status_code, 400)
+        self.assertEqual(self.batch(action='block').status_code, 400)
+        self.assertEqual(self.batch(action='block',
+                                    filter={'group': 'x'}).status_code, 400)
+        self.assertEqual(self.batch(action='block',
+                                    filter={'is_valid': 2}).status_code, 400)
+
+
+class TestSearch(TestBase):
+    """
+    Users search testcase.
+    """
+    def setUp(self):
+        super(TestSearch, self).setUp()
+        self.signin('test3@test.test')
+
+    def search(self, **args):
+        """
+        Return the names of the users found by a search.
+        :param args:
+        :return:
+        """
+        response = self.client.get(url_for('admin.search_users', **args))
+        self.assertEqual(response.status_code, 200)
+        return [name for name in ('test1', 'test2', 'test3', 'test4')
+                if '<td>%s</td>' % name in response.data]
+
+    def test_prefix(self):
+        """
+        Test that users are found by name or email prefix.
+        :return:
+        """
+        self.assertEqual(self.search(q='test'),
+                         ['test1', 'test2', 'test3', 'test4'])
+        self.assertEqual(self.search(q='test2@'), ['test2'])
+        self.assertEqual(self.search(q='tester'), [])
+
+    def test_filters(self):
+        """
+        Test that the flags filter the results and are kept by the pager.
+        :return:
+        """
+        self.assertEqual(self.search(is_admin='1', is_blocked='0'),
+                         ['test2', 'test3'])
+        response = self.client.get(url_for('admin.search_users', q='test',
+                                           is_admin='1', size=1))
+        self.assertIn('is_admin=1', response.data)
+        self.assertIn('q=test', response.data)
+        self.assertEqual(self.client.get(url_for('admin.search_users',
+                                                 group='x')).status_code, 400)
+
+    def test_full_text(self):
+        """
+        Test the full text search kept in sync by the triggers.
+        :return:
+        """
+        install_fts(db.engine)
+        self.app.config['USERS_FTS'] = True
+        try:
+            self.assertEqual(self.search(q='tester3'), ['test3'])
+            user = User.query.filter_by(name='test1').first()
+            user.last_name = 'Smithson'
+            db.session.commit()
+            self.assertEqual(self.search(q='smith'), ['test1'])
+            self.assertEqual(self.search(q='tester1'), ['test1'])
+        finally:
+            uninstall_fts(db.engine)
+
+    def test_flags_skip_full_text(self):
+        """
+        Test that the flags updates leave the full text index alone.
+        :return:
+        """
+        install_fts(db.engine)
+        try:
+            with db.engine.connect() as connection:
+                before = connection.execute(
+                    db.text('SELECT total_changes()')).scalar()
+                connection.execute(db.text(
+                    'UPDATE users SET is_blocked = 1 WHERE id = 1'))
+                after = connection.execute(
+                    db.text('SELECT total_changes()')).scalar()
+            self.assertEqual(after - before, 1)
+        finally:
+            uninstall_fts(db.engine)
+
+
+class TestChoices(TestBase):
+    """
+    Cached group and role choices testcase.
+    """
+    def setUp(self):
+        super(TestChoices, self).setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        db.session.add(Group(name='Tester Group',
+                             description='The Tester Group'))
+        db.session.add(Role(name='Test Role', description='The Test Role'))
+        db.session.commit()
+        self.signin('test3@test.test')
+
+    def test_choices_are_cached(self):
+        """
+        Test that the assign page does not query the groups and roles
+        once their choices are cached.
+        :return:
+        """
+        id = User.query.filter_by(name='test1').first().id
+        self.client.get(url_for('admin.assign_user', id=id))
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.get(url_for('admin.assign_user', id=id))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertIn('Tester Group', response.data)
+        self.assertFalse([statement for statement in statements
+                          if 'FROM groups' in statement or
+                          'FROM roles' in statement])
+
+    def test_add_group_invalidates_choices(self):
+        """
+        Test that adding a group adds it to the choices.
+        :return:
+        """
+        self.assertEqual([label for id, label in group_choices.choices()],
+                         ['Tester Group'])
+        self.client.post(url_for('admin.add_group'),
+                         data={'name': 'Another Group',
+                               'description': 'Another Group'})
+        self.assertEqual([label for id, label in group_choices.choices()],
+                         ['Another Group', 'Tester Group'])
+
+    def test_assign_user(self):
+        """
+        Test that posting choice ids assigns the group and the role.
+        :return:
+        """
+        user = User.query.filter_by(name='test1').first()
+        group = Group.query.first()
+        role = Role.query.first()
+        response = self.client.post(url_for('admin.assign_user', id=user.id),
+                                    data={'group': str(group.id),
+                                          'role': str(role.id)})
+        self.assertIn('Successfully assigned &#34;test1&#34; to '
+                      '&#34;Tester Group&#34;', response.data)
+        self.assertEqual(load_user(user.id).group_id, group.id)
+
+
+class TestTemplates(TestBase):
+    """
+    Template bytecode cache testcase.
+    """
+    def setUp(self):
+        super(TestTemplates, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.app.jinja_env.bytecode_cache = FileSystemBytecodeCache(self.path)
+
+    def tearDown(self):
+        self.app.jinja_env.bytecode_cache = None
+        shutil.rmtree(self.path)
+        super(TestTemplates, self).tearDown()
+
+    def test_compile_command(self):
+        """
+        Test that the compile command writes the bytecode of every template.
+        :return:
+        """
+        result = self.app.test_cli_runner().invoke(templates_cli,
+                                                   ['compile'])
+        names = self.app.jinja_env.list_templates(extensions=('html',))
+        self.assertIn('base.html', names)
+        self.assertIn('Compiled %d templates.' % len(names), result.output)
+        self.assertEqual(len(os.listdir(self.path)), len(names))
+
+    def test_compile_command_disabled(self):
+        """
+        Test that the compile command fails without a bytecode cache.
+        :return:
+        """
+        self.app.jinja_env.bytecode_cache = None
+        result = self.app.test_cli_runner().invoke(templates_cli,
+                                                   ['compile'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('TEMPLATE_CACHE is disabled.', result.output)
+
+
+class TestFragments(TestBase):
+    """
+    Template fragment cache testcase.
+    """
+    def render(self, source, **context):
+        with self.app.test_request_context('/'):
+            return self.app.jinja_env.from_string(source).render(**context)
+
+    def test_fragment_is_cached(self):
+        """
+        Test that a fragment is rendered once per key until invalidated.
+        :return:
+        """
+        calls = []
+
+        def count(value):
+            calls.append(value)
+            return value
+        source = "{% cache 'test', key %}{{ count(key) }}{% endcache %}"
+        self.assertEqual(self.render(source, key=1, count=count), '1')
+        self.assertEqual(self.render(source, key=1, count=count), '1')
+        self.assertEqual(self.render(source, key=2, count=count), '2')
+        self.assertEqual(calls, [1, 2])
+        invalidate_fragments('test')
+        self.assertEqual(self.render(source, key=1, count=count), '1')
+        self.assertEqual(calls, [1, 2, 1])
+
+    def test_fragment_cache_disabled(self):
+        """
+        Test that fragments are rendered every time when disabled.
+        :return:
+        """
+        self.app.config['FRAGMENT_CACHE'] = False
+        calls = []
+        source = "{% cache 'test' %}{{ calls.append(1) or 'x' }}{% endcache %}"
+        self.render(source, calls=calls)
+        self.render(source, calls=calls)
+        self.assertEqual(len(calls), 2)
+
+    def test_nav_is_not_shared_by_users(self):
+        """
+        Test that the cached admin nav does not include the user name.
+        :return:
+        """
+        self.signin('test3@test.test')
+        self.assertIn('Hello, test3!', self.client.get(url_for('home.admin')).data)
+        self.signin('test2@test.test')
+        response = self.client.get(url_for('home.admin'))
+        self.assertIn('Hello, test2!', response.data)
+        self.assertIn('<li class="active"><a href="/admin/home">Admin</a></li>',
+                      response.data)
+
+    def test_add_group_invalidates_list(self):
+        """
+        Test that the cached groups list shows a new group.
+        :return:
+        """
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.signin('test3@test.test')
+        self.assertNotIn('Tester Group',
+                         self.client.get(url_for('admin.groups')).data)
+        self.client.post(url_for('admin.add_group'),
+                         data={'name': 'Tester Group',
+                               'description': 'The Tester Group'})
+        self.assertIn('Tester Group',
+                      self.client.get(url_for('admin.groups')).data)
+
+
+class TestConditional(TestBase):
+    """
+    Conditional GET testcase.
+    """
+    def setUp(self):
+        super(TestConditional, self).setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.signin('test3@test.test')
+
+    def test_not_modified(self):
+        """
+        Test that an unchanged list answers 304 without querying its rows.
+        :return:
+        """
+        response = self.client.get(url_for('admin.groups'))
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.get(url_for('admin.groups'),
+                                       headers={'If-None-Match': etag})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(statements), 1)
+        self.assertIn('max(groups.id)', statements[0])
+
+    def test_if_modified_since(self):
+        """
+        Test that an unchanged list answers 304 to If-Modified-Since.
+        :return:
+        """
+        response = self.client.get(url_for('admin.roles'))
+        response = self.client.get(
+            url_for('admin.roles'),
+            headers={'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_write_changes_etag(self):
+        """
+        Test that adding or editing a group changes the ETag.
+        :return:
+        """
+        etag = self.client.get(url_for('admin.groups')).headers['ETag']
+        self.client.post(url_for('admin.add_group'),
+                         data={'name': 'Tester Group',
+                               'description': 'The Tester Group'})
+        response = self.client.get(url_for('admin.groups'),
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Tester Group', response.data)
+        etag = self.client.get(url_for('admin.groups')).headers['ETag']
+        group = Group.query.first()
+        self.client.post(url_for('admin.edit_group', id=group.id),
+                         data={'name': 'Edited Group',
+                               'description': 'The Tester Group'})
+        self.client.get(url_for('admin.groups'))
+        response = self.client.get(url_for('admin.groups'),
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_flashes_are_not_cached(self):
+        """
+        Test that a page showing flashed messages has no ETag.
+        :return:
+        """
+        self.client.post(url_for('admin.add_group'),
+                         data={'name': 'Tester Group',
+                               'description': 'The Tester Group'})
+        response = self.client.get(url_for('admin.groups'))
+        self.assertIn('Successfully added a new group', response.data)
+        self.assertNotIn('ETag', response.headers)
+
+    def test_forbidden_before_not_modified(self):
+        """
+        Test that a non admin is refused an admin page it claims to have.
+        :return:
+        """
+        self.signin('test1@test.test')
+        for endpoint in ('home.admin', 'admin.groups', 'admin.roles',
+                         'admin.tools'):
+            response = self.client.get(
+                url_for(endpoint),
+                headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+            self.assertEqual(response.status_code, 403)
+
+    def test_etag_is_per_user(self):
+        """
+        Test that the ETag of an user does not match for another user.
+        :return:
+        """
+        etag = self.client.get(url_for('home.admin')).headers['ETag']
+        self.signin('test2@test.test')
+        response = self.client.get(url_for('home.admin'),
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+
+class TestAssets(TestBase):
+    """
+    Static files and compression testcase.
+    """
+    def setUp(self):
+        super(TestAssets, self).setUp()
+        self.static_folder = self.app.static_folder
+        self.app.static_folder = tempfile.mkdtemp()
+        with open(os.path.join(self.app.static_folder, 'styles.css'),
+                  'wb') as f:
+            f.write(b'body { margin: 0; }\n' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.app.static_folder)
+        self.app.static_folder = self.static_folder
+        super(TestAssets, self).tearDown()
+
+    def test_fingerprint(self):
+        """
+        Test that static URLs carry the content hash of the file
+        and are cached as immutable.
+        :return:
+        """
+        url = url_for('static', filename='styles.css')
+        self.assertRegexpMatches(url, r'/static/styles.css\?v=[0-9a-f]{12}$')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertEqual(response.cache_control.max_age,
+                         self.app.config['STATIC_MAX_AGE'])
+        response.close()
+
+    def test_paths_outside_static_folder(self):
+        """
+        Test that the files outside of the static folder are neither
+        hashed nor served.
+        :return:
+        """
+        name = os.path.basename(self.app.static_folder)
+        with open(os.path.join(self.app.static_folder, '..',
+                               name + '.secret'), 'wb') as f:
+            f.write(b'secret')
+        try:
+            self.assertIsNone(static_hash(self.app, '../%s.secret' % name))
+            response = self.client.get('/static/..%%2f%s.secret?v=1' % name)
+            self.assertEqual(response.status_code, 404)
+        finally:
+            os.remove(os.path.join(self.app.static_folder, '..',
+                                   name + '.secret'))
+        response = self.client.get('/static/styles.css?v=0')
+        self.assertFalse(response.cache_control.immutable)
+        response.close()
+        self.assertEqual(url_for('static', filename='missing.css'),
+                         '/static/missing.css')
+
+    def test_precompressed(self):
+        """
+        Test that the compress command writes the gzip variants which
+        are sent to the clients accepting them.
+        :return:
+        """
+        result = self.app.test_cli_runner().invoke(static_cli, ['compress'])
+        self.assertIn('Compressed', result.output)
+        response = self.client.get('/static/styles.css',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(response.data))
+                         .read(), b'body { margin: 0; }\n' * 100)
+        response.close()
+        response = self.client.get('/static/styles.css')
+        self.assertNotIn('Content-Encoding', response.headers)
+        response.close()
+
+    def test_compress_html(self):
+        """
+        Test that HTML responses are compressed above the threshold.
+        :return:
+        """
+        self.app.config['COMPRESS_MIN_SIZE'] = 0
+        response = self.client.get(url_for('home.welcome'),
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+        self.assertIn(b'Welcome',
+                      gzip.GzipFile(fileobj=io.BytesIO(response.data)).read())
+        self.app.config['COMPRESS_MIN_SIZE'] = 1 << 20
+        response = self.client.get(url_for('home.welcome'),
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+
+class TestInstrument(TestBase):
+    """
+    Request instrumentation testcase.
+    """
+    def test_endpoint_stats(self):
+        """
+        Test that the timings of the requests are totalled per endpoint.
+        :return:
+        """
+        self.signin('test3@test.test')
+        self.client.get(url_for('admin.users'))
+        self.client.get(url_for('admin.users'))
+        stats = self.app.extensions['request_stats'].stats()['admin.users']
+        self.assertEqual(stats['count'], 2)
+        self.assertGreater(stats['sql_count'], 0)
+        self.assertGreater(stats['sql_time'], 0)
+        self.assertGreater(stats['template_time'], 0)
+        self.assertGreaterEqual(stats['wall_time'], stats['max_wall_time'])
+
+    def test_server_timing(self):
+        """
+        Test the Server-Timing header.
+        :return:
+        """
+        response = self.client.get(url_for('home.welcome'))
+        self.assertNotIn('Server-Timing', response.headers)
+        self.app.config['SERVER_TIMING'] = True
+        response = self.client.get(url_for('home.welcome'))
+        self.assertRegexpMatches(response.headers['Server-Timing'],
+                                 r'^app;dur=[0-9.]+, sql;dur=[0-9.]+;'
+                                 r'desc="\d+ statements", template;dur=[0-9.]+$')
+
+    def test_slow_request_log(self):
+        """
+        Test that slow requests are logged with their statements.
+        :return:
+        """
+        records = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+        handler = Handler()
+        self.app.logger.addHandler(handler)
+        try:
+            self.signin('test3@test.test')
+            self.client.get(url_for('admin.users'))
+            self.assertEqual(records, [])
+            self.app.config['SLOW_REQUEST_THRESHOLD'] = 0
+            self.client.get(url_for('admin.users'))
+        finally:
+            self.app.logger.removeHandler(handler)
+        self.assertEqual(len(records), 1)
+        self.assertIn('Slow request GET /admin/users (admin.users)',
+                      records[0])
+        self.assertIn('FROM users', records[0])
+
+
+class TestMetrics(TestBase):
+    """
+    Metrics endpoint testcase.
+    """
+    def test_request_metrics(self):
+        """
+        Test the request counters and histograms.
+        :return:
+        """
+        self.client.get(url_for('home.welcome'))
+        self.client.get('/missing')
+        data = self.client.get('/metrics').data
+        self.assertIn('# TYPE http_requests_total counter', data)
+        self.assertIn('http_requests_total{endpoint="home.welcome",'
+                      'blueprint="home",method="GET",status="200"} 1', data)
+        self.assertIn('http_requests_total{endpoint="none",blueprint="",'
+                      'method="GET",status="404"} 1', data)
+        self.assertIn('http_request_duration_seconds_bucket{endpoint='
+                      '"home.welcome",blueprint="home",le="+Inf"} 1', data)
+        self.assertIn('http_request_duration_seconds_count{endpoint='
+                      '"home.welcome",blueprint="home"} 1', data)
+        self.assertIn('db_pool_checkout_seconds_count', data)
+
+    def test_login_metrics(self):
+        """
+        Test the sign in counters.
+        :return:
+        """
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.client.post(url_for('auth.signin'),
+                         data={'email': 'test1@test.test',
+                               'password': 'wrong'})
+        self.client.post(url_for('auth.signin'),
+                         data={'email': 'test1@test.test',
+                               'password': 'test1'})
+        data = self.client.get('/metrics').data
+        self.assertIn('login_attempts_total{result="failure"} 1', data)
+        self.assertIn('login_attempts_total{result="success"} 1', data)
+
+    def test_forbidden_address(self):
+        """
+        Test that the metrics are only served to the allowed addresses.
+        :return:
+        """
+        response = self.client.get('/metrics', environ_base={
+            'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_files_merge(self):
+        """
+        Test that the metrics of the processes sharing a directory
+        are summed.
+        :return:
+        """
+        path = tempfile.mkdtemp()
+        try:
+            other = Metrics(path)
+            other.registry.inc('login_attempts_total', [('result', 'success')])
+            other.registry.observe('db_pool_checkout_seconds', (), 0.5)
+            with open(os.path.join(path, 'metrics-1.json'), 'w') as f:
+                json.dump(other.registry.snapshot(), f)
+            metrics = Metrics(path)
+            metrics.registry.inc('login_attempts_total',
+                                 [('result', 'success')], 2)
+            metrics.registry.observe('db_pool_checkout_seconds', (), 20)
+            counters, gauges, histograms = metrics.collect()
+        finally:
+            shutil.rmtree(path)
+        self.assertEqual(
+            counters[('login_attempts_total', (('result', 'success'),))], 3)
+        self.assertEqual(histograms[('db_pool_checkout_seconds', ())][-1], 2)
+        text = render(counters, gauges, histograms)
+        self.assertIn('db_pool_checkout_seconds_bucket{le="0.5"} 1', text)
+        self.assertIn('db_pool_checkout_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn('db_pool_checkout_seconds_sum 20.5', text)
+
+    def test_files_of_dead_processes(self):
+        """
+        Test that the file of a dead process is folded into the aggregate
+        file without its gauges, and that an exiting process retires its
+        own file.
+        :return:
+        """
+        path = tempfile.mkdtemp()
+        try:
+            process = subprocess.Popen(['true'])
+            process.wait()
+            dead = Metrics(path)
+            dead.registry.inc('login_attempts_total', [('result', 'success')])
+            dead.registry.set('audit_queue_depth', (), 5)
+            dead.flush(force=True)
+            os.rename(dead._name, os.path.join(
+                path, 'metrics-%d-0000.json' % process.pid))
+            metrics = Metrics(path)
+            metrics.registry.inc('login_attempts_total',
+                                 [('result', 'success')])
+            for i in range(2):
+                counters, gauges, histograms = metrics.collect()
+                self.assertEqual(counters[('login_attempts_total',
+                                           (('result', 'success'),))], 2)
+                self.assertNotIn(('audit_queue_depth', ()), gauges)
+            metrics.close()
+            self.assertEqual(sorted(os.listdir(path)),
+                             ['aggregate.json', 'metrics.lock'])
+            counters = Metrics(path).collect()[0]
+            self.assertEqual(counters[('login_attempts_total',
+                                       (('result', 'success'),))], 2)
+        finally:
+            shutil.rmtree(path)
+
+    def test_concurrent_flushes(self):
+        """
+        Test that the threads flushing at the same time leave a single
+        file behind.
+        :return:
+        """
+        path = tempfile.mkdtemp()
+        errors = []
+
+        def flush():
+            try:
+                for i in range(50):
+                    metrics.registry.inc('login_attempts_total',
+                                         [('result', 'success')])
+                    metrics.flush(force=i % 2 == 0)
+            except Exception as error:
+                errors.append(error)
+
+        try:
+            metrics = Metrics(path, flush_interval=0)
+            threads = [threading.Thread(target=flush) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(os.listdir(path),
+                             [os.path.basename(metrics._name)])
+        finally:
+            shutil.rmtree(path)
+
+
+class TestDatabase(TestBase):
+    """
+    Engine and connection pool configuration testcase.
+    """
+    def create_engine(self, uri):
+        url = make_url(uri)
+        options = db.apply_pool_defaults(self.app, {})
+        url, options = db.apply_driver_hacks(self.app, url, options)
+        return db.create_engine(url, options)
+
+    def test_sqlite_pool(self):
+        """
+        Test the pool settings and the PRAGMAs of a SQLite file.
+        :return:
+        """
+        path = tempfile.mkdtemp()
+        self.app.config.update(DATABASE_POOL_SIZE=2,
+                               DATABASE_MAX_OVERFLOW=1,
+                               DATABASE_POOL_TIMEOUT=5,
+                               DATABASE_POOL_PRE_PING=True,
+                               SQLITE_JOURNAL_MODE='WAL',
+                               SQLITE_SYNCHRONOUS='NORMAL',
+                               SQLITE_MMAP_SIZE=1 << 20)
+        engine = self.create_engine('sqlite:///%s' %
+                                    os.path.join(path, 'pool.sqlite'))
+        try:
+            self.assertIsInstance(engine.pool, QueuePool)
+            self.assertEqual(engine.pool.size(), 2)
+            with engine.connect() as connection:
+                pragma = lambda name: connection.execute(
+                    'PRAGMA %s' % name).scalar()
+                self.assertEqual(pragma('journal_mode'), 'wal')
+                self.assertEqual(pragma('synchronous'), 1)
+                self.assertEqual(pragma('busy_timeout'), 5000)
+                self.assertEqual(pragma('mmap_size'), 1 << 20)
+            self.assertEqual(engine.pool.checkouts, 1)
+        finally:
+            engine.dispose()
+            shutil.rmtree(path)
+
+    def test_queue_options_dropped(self):
+        """
+        Test that the queue settings are ignored by the SQLite files
+        which are not pooled.
+        :return:
+        """
+        self.app.config.update(DATABASE_MAX_OVERFLOW=1,
+                               DATABASE_POOL_TIMEOUT=5)
+        engine = self.create_engine('sqlite://')
+        self.assertEqual(engine.execute('SELECT 1').scalar(), 1)
+
+    def test_pool_stats(self):
+        """
+        Test the statistics of the pool of the application.
+        :return:
+        """
+        User.query.all()
+        stats = db.pool_stats()
+        self.assertEqual(stats['pool'], 'TimedNullPool')
+        self.assertGreater(stats['checkouts'], 0)
+        self.assertGreaterEqual(stats['checkout_wait'],
+                                stats['checkout_wait_max'])
+
+
+class TestReplicas(TestBase):
+    """
+    Read replica routing testcase.
+    """
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.app.config.update(
+            SQLALCHEMY_BINDS={'replica': 'sqlite:///%s' % os.path.join(
+                self.path, 'replica.sqlite')},
+            DATABASE_READ_BINDS=('replica',),
+            WTF_CSRF_ENABLED=False)
+        super(TestReplicas, self).setUp()
+        result = self.app.test_cli_runner().invoke(replicas_cli, ['sync'])
+        self.assertIn('Synced 5 tables to "replica".', result.output)
+        self.replica = db.get_engine(bind='replica')
+        self.replica.execute(
+            "INSERT INTO users (email, name, is_admin, is_valid, is_blocked) "
+            "VALUES ('replica@test.test', 'replica_only', 0, 0, 0)")
+
+    def tearDown(self):
+        self.replica.dispose()
+        super(TestReplicas, self).tearDown()
+        shutil.rmtree(self.path)
+
+    def test_sync(self):
+        """
+        Test that the replica has the rows of the primary.
+        :return:
+        """
+        self.assertEqual(self.replica.execute(
+            'SELECT count(*) FROM users').scalar(), User.query.count() + 1)
+
+    def test_lists_read_replica(self):
+        """
+        Test that the admin lists read from the replica.
+        :return:
+        """
+        self.signin('test3@test.test')
+        self.assertIn('replica_only',
+                      self.client.get(url_for('admin.users')).data)
+
+    def test_read_your_writes(self):
+        """
+        Test that the lists read from the primary after a write
+        and that writes go to the primary.
+        :return:
+        """
+        self.signin('test3@test.test')
+        self.client.post(url_for('admin.add_group'),
+                         data={'name': 'Tester Group',
+                               'description': 'The Tester Group'})
+        db.session.expunge_all()
+        self.assertEqual(Group.query.count(), 1)
+        self.assertEqual(self.replica.execute(
+            'SELECT count(*) FROM groups').scalar(), 0)
+        self.assertNotIn('replica_only',
+                         self.client.get(url_for('admin.users')).data)
+        with self.client.session_transaction() as session:
+            session['_primary_until'] = 0
+        self.assertIn('replica_only',
+                      self.client.get(url_for('admin.users')).data)
+
+    def test_user_loaded_from_primary(self):
+        """
+        Test that the session user is loaded from the primary.
+        :return:
+        """
+        user = User.query.filter_by(email='test3@test.test').first()
+        self.replica.execute("UPDATE users SET name = 'stale' "
+                             "WHERE id = %d" % user.id)
+        with self.app.test_request_context():
+            g.db_read_bind = 'replica'
+            try:
+                self.assertEqual(load_user(user.id).name, 'test3')
+            finally:
+                g.pop('db_read_bind')
+
+    def test_replica_pages_not_cached(self):
+        """
+        Test that the pages and fragments read from a replica are not
+        cached, and that only the GET requests read from a replica.
+        :return:
+        """
+        self.signin('test3@test.test')
+        self.replica.execute("INSERT INTO groups (name, description) "
+                             "VALUES ('replica_group', 'Replica')")
+        response = self.client.get(url_for('admin.groups'))
+        self.assertIn('replica_group', response.data)
+        self.assertNotIn('ETag', response.headers)
+        self.assertNotIn('replica_group',
+                         self.client.post(url_for('admin.groups')).data)
+        with self.client.session_transaction() as session:
+            session['_primary_until'] = time.time() + 60
+        response = self.client.get(url_for('admin.groups'))
+        self.assertNotIn('replica_group', response.data)
+        self.assertIn('ETag', response.headers)
+
+
+class TestApi(TestBase):
+    """
+    JSON API testcase.
+    """
+    def setUp(self):
+        super(TestApi, self).setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        for i in range(3):
+            db.session.add(Group(name='group%d' % i,
+                                 description='The group %d' % i))
+        db.session.commit()
+
+    def batch(self, name, **data):
+        """
+        Post a JSON batch of a resource.
+        :param name:
+        :param data:
+        :return:
+        """
+        return self.client.post('/api/v1/%s/batch' % name,
+                                data=json.dumps(data),
+                                content_type='application/json')
+
+    def test_access(self):
+        """
+        Test that the API answers JSON errors to anonymous users and
+        non-admins.
+        :return:
+        """
+        response = self.client.get('/api/v1/groups')
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('error', json.loads(response.data))
+        self.signin('test1@test.test')
+        self.assertEqual(self.client.get('/api/v1/groups').status_code, 403)
+
+    def test_sparse_fields_and_cursors(self):
+        """
+        Test that only the requested fields are returned, one page at
+        a time.
+        :return:
+        """
+        self.signin('test3@test.test')
+        response = self.client.get('/api/v1/groups?fields=name&size=2')
+        data = json.loads(response.data)
+        self.assertEqual(data['data'], [{'name': 'group0'},
+                                        {'name': 'group1'}])
+        self.assertIsNotNone(data['next_cursor'])
+        data = json.loads(self.client.get(
+            '/api/v1/groups?size=2&after=%d' % data['next_cursor']).data)
+        self.assertEqual([item['name'] for item in data['data']], ['group2'])
+        self.assertIsNone(data['next_cursor'])
+        response = self.client.get('/api/v1/users?fields=password_hash')
+        self.assertEqual(response.status_code, 400)
+
+    def test_show(self):
+        """
+        Test that one row is returned, or a JSON 404.
+        :return:
+        """
+        self.signin('test3@test.test')
+        user = User.query.filter_by(email='test1@test.test').first()
+        data = json.loads(self.client.get('/api/v1/users/%d' % user.id).data)
+        self.assertEqual(data['data']['email'], 'test1@test.test')
+        self.assertNotIn('password_hash', data['data'])
+        response = self.client.get('/api/v1/tools/1000')
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('error', json.loads(response.data))
+
+    def test_batch(self):
+        """
+        Test that creates, updates and deletes are applied together.
+        :return:
+        """
+        self.signin('test3@test.test')
+        ids = [id for id, in db.session.query(Group.id).order_by(Group.id)]
+        user = User.query.filter_by(email='test1@test.test').first()
+        user.group_id = ids[2]
+        db.session.commit()
+        response = self.batch('groups',
+                              create=[{'name': 'group3'}],
+                              update=[{'id': ids[0], 'description': 'First'}],
+                              delete=[ids[2]])
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['updated'], 1)
+        self.assertEqual(data['deleted'], 1)
+        self.assertEqual(len(data['created']), 1)
+        db.session.expire_all()
+        self.assertEqual(Group.query.get(data['created'][0]).name, 'group3')
+        self.assertEqual(Group.query.get(ids[0]).description, 'First')
+        self.assertIsNone(User.query.get(user.id).group_id)
+
+    def test_batch_users(self):
+        """
+        Test that created users get a password hash and admins are not
+        deleted.
+        :return:
+        """
+        self.signin('test3@test.test')
+        response = self.batch('users', create=[{'email': 'api@test.test',
+                                                'name': 'api',
+                                                'password': 'secret'}])
+        self.assertEqual(response.status_code, 200)
+        user = User.query.filter_by(email='api@test.test').first()
+        self.assertTrue(user.verify_password('secret'))
+        admin = User.query.filter_by(email='test2@test.test').first()
+        response = self.batch('users', delete=[admin.id])
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(User.query.count(), 5)
+
+    def test_batch_is_atomic(self):
+        """
+        Test that a failing operation rolls back the whole batch.
+        :return:
+        """
+        self.signin('test3@test.test')
+        response = self.batch('groups', create=[{'name': 'group3'},
+                                                {'name': 'group0'}])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Group.query.count(), 3)
+        response = self.batch('groups', create=[{'name': 'group4'}],
+                              delete=[1000])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(Group.query.count(), 3)
+        response = self.batch('groups', update=[{'id': 1, 'users': []}])
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_field_types(self):
+        """
+        Test that the values of the wrong JSON type are refused.
+        :return:
+        """
+        self.signin('test3@test.test')
+        user = User.query.filter_by(email='test1@test.test').first()
+        for data in ({'update': [{'id': user.id, 'is_admin': 'false'}]},
+                     {'update': [{'id': user.id, 'is_valid': 1}]},
+                     {'update': [{'id': user.id, 'name': 1}]},
+                     {'update': [{'id': user.id, 'group_id': '1'}]},
+                     {'update': [{'id': user.id, 'group_id': True}]},
+                     {'update': [{'id': True, 'name': 'true'}]},
+                     {'delete': [True]},
+                     {'create': [{'email': 'api@test.test', 'name': 'api'}]},
+                     {'create': [{'email': 'api@test.test', 'name': 'api',
+                                  'password': 1234}]}):
+            response = self.batch('users', **data)
+            self.assertEqual(response.status_code, 400, data)
+            self.assertIn('error', json.loads(response.data))
+        response = self.batch('users', update=[{'id': user.id,
+                                                'group_id': None,
+                                                'is_valid': True}])
+        self.assertEqual(response.status_code, 200)
+
+
+class TestTokens(TestBase):
+    """
+    API bearer tokens testcase.
+    """
+    def token(self, email, password):
+        """
+        Exchange an email and a password for a token.
+        :param email:
+        :param password:
+        :return:
+        """
+        response = self.client.post('/api/v1/tokens',
+                                    data=json.dumps({'email': email,
+                                                     'password': password}),
+                                    content_type='application/json')
+        return response.status_code, json.loads(response.data).get('token')
+
+    def get(self, token, path='/api/v1/groups'):
+        return self.client.get(path, headers={
+            'Authorization': 'Bearer %s' % token})
+
+    def test_issue(self):
+        """
+        Test that tokens are only issued for a valid password of an
+        user who is not blocked.
+        :return:
+        """
+        self.assertEqual(self.token('test3@test.test', 'wrong')[0], 401)
+        self.assertEqual(self.token('test4@test.test', 'wrong')[0], 401)
+        self.assertEqual(self.token('test4@test.test', 'test4')[0], 403)
+        self.assertEqual(self.token('test3@test.test', 1234)[0], 400)
+        self.assertEqual(self.token(['test3@test.test'], 'test3')[0], 400)
+        status, token = self.token('test3@test.test', 'test3')
+        self.assertEqual(status, 200)
+        self.assertEqual(self.get(token).status_code, 200)
+        self.assertEqual(self.get(token + 'x').status_code, 401)
+
+    def test_no_user_lookup(self):
+        """
+        Test that an unchanged user is read from the token, and loaded
+        again once it has been edited.
+        :return:
+        """
+        token = self.token('test3@test.test', 'test3')[1]
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self.assertEqual(self.get(token).status_code, 200)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertFalse([statement for statement in statements
+                          if 'FROM users' in statement])
+        user = User.query.filter_by(email='test3@test.test').first()
+        user.is_blocked = True
+        db.session.commit()
+        invalidate_user(user.id)
+        self.assertEqual(self.get(token).status_code, 401)
+
+    def test_revoke(self):
+        """
+        Test that revoked tokens are refused.
+        :return:
+        """
+        token = self.token('test3@test.test', 'test3')[1]
+        response = self.client.post('/api/v1/tokens/revoke', headers={
+            'Authorization': 'Bearer %s' % token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get(token).status_code, 401)
+        self.app.extensions['cache'].clear()
+        self.assertEqual(self.get(token).status_code, 401)
+        token = self.token('test3@test.test', 'test3')[1]
+        self.assertEqual(self.get(token).status_code, 200)
+
+    def test_cache_lost(self):
+        """
+        Test that the tokens are verified against the database once the
+        cache has forgotten them.
+        :return:
+        """
+        token = self.token('test3@test.test', 'test3')[1]
+        self.app.extensions['cache'].clear()
+        self.assertEqual(self.get(token).status_code, 200)
+        user = User.query.filter_by(email='test3@test.test').first()
+        user.is_blocked = True
+        db.session.commit()
+        self.app.extensions['cache'].clear()
+        self.assertEqual(self.get(token).status_code, 401)
+
+    def test_csrf(self):
+        """
+        Test that token requests are exempt from CSRF, unlike the
+        requests signed in by the session.
+        :return:
+        """
+        self.app.config['WTF_CSRF_ENABLED'] = True
+        token = self.token('test3@test.test', 'test3')[1]
+        data = json.dumps({'create': [{'name': 'Token Group'}]})
+        response = self.client.post('/api/v1/groups/batch', data=data,
+                                    content_type='application/json',
+                                    headers={'Authorization':
+                                             'Bearer %s' % token})
+        self.assertEqual(response.status_code, 200)
+        self.signin('test3@test.test')
+        response = self.client.post('/api/v1/groups/batch', data=data,
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class TestAudit(TestBase):
+    """
+    Audit log testcase.
+    """
+    def setUp(self):
+        super(TestAudit, self).setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.writer = self.app.extensions['audit']
+
+    def test_admin_writes_are_audited(self):
+        """
+        Test that the admin writes are written by the writer thread.
+        :return:
+        """
+        admin = self.signin('test3@test.test')
+        self.client.post(url_for('admin.add_group'),
+                         data={'name': 'Audited', 'description': 'Audited'})
+        group = Group.query.filter_by(name='Audited').first()
+        self.client.post(url_for('admin.delete_group', id=group.id))
+        self.assertTrue(self.writer.flush())
+        events = AuditEvent.query.order_by(AuditEvent.id).all()
+        self.assertEqual([(event.action, event.target, event.target_id,
+                           event.user_id) for event in events],
+                         [('add', 'group', group.id, admin.id),
+                          ('delete', 'group', group.id, admin.id)])
+        self.assertEqual(json.loads(events[0].details), {'name': 'Audited'})
+        self.assertEqual(self.writer.written, 2)
+
+    def test_changes_are_audited(self):
+        """
+        Test that the user edits record their changes and the API
+        batches their ids.
+        :return:
+        """
+        self.signin('test3@test.test')
+        group = Group(name='Audited', description='Audited')
+        role = Role(name='Audited', description='Audited')
+        db.session.add_all([group, role])
+        db.session.commit()
+        user = User.query.filter_by(email='test1@test.test').first()
+        self.client.post(url_for('admin.edit_user', id=user.id),
+                         data={'email': 'test1@test.test', 'name': 'test1',
+                               'first_name': 'tester1',
+                               'last_name': 'edited', 'is_admin': 'y',
+                               'group': str(group.id),
+                               'role': str(role.id)})
+        self.client.post('/api/v1/users/batch',
+                         data=json.dumps({'update': [{'id': user.id,
+                                                      'is_valid': True}]}),
+                         content_type='application/json')
+        self.assertTrue(self.writer.flush())
+        edit, batch = AuditEvent.query.order_by(AuditEvent.id).all()
+        self.assertEqual(json.loads(edit.details)['changes'],
+                         {'last_name': ['tester1', 'edited'],
+                          'is_admin': [False, True]})
+        self.assertEqual(json.loads(batch.details),
+                         {'created': [], 'updated': [user.id], 'deleted': []})
+
+    def test_batches(self):
+        """
+        Test that events are inserted in batches, on size or on time.
+        :return:
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            if statement.startswith('INSERT INTO audit_events'):
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            writer = AuditWriter(self.app, batch_size=5, interval=0.05)
+            for i in range(12):
+                writer.record({'action': 'edit', 'target': 'tool',
+                               'target_id': i})
+            for _ in range(100):
+                if writer.written == 12:
+                    break
+                time.sleep(0.01)
+            writer.close()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(AuditEvent.query.count(), 12)
+        self.assertEqual(len(statements), 3)
+
+    def test_full_queue_drops(self):
+        """
+        Test that events are dropped and counted on a full queue.
+        :return:
+        """
+        writer = AuditWriter(self.app, queue_size=2, interval=60)
+        writer._pid = os.getpid()
+        for i in range(3):
+            writer.record({'action': 'edit', 'target': 'tool'})
+        self.assertEqual(writer.depth, 2)
+        self.assertEqual(writer.dropped, 1)
+        self.app.extensions['audit'] = writer
+        data = self.client.get('/metrics').data
+        self.assertIn('# TYPE audit_events_dropped_total counter', data)
+        self.assertIn('audit_events_dropped_total 1', data)
+
+
+class TestJobs(TestBase):
+    """
+    Background jobs testcase.
+    """
+    def setUp(self):
+        super(TestJobs, self).setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.path = tempfile.mkdtemp()
+        self.now = [1000.0]
+        self.store = JobStore(os.path.join(self.path, 'jobs.sqlite'),
+                              max_attempts=2, backoff=10, lease=30,
+                              timer=lambda: self.now[0])
+        self.app.extensions['jobs'] = self.store
+        self.worker = Worker(self.app, self.store)
+
+    def tearDown(self):
+        super(TestJobs, self).tearDown()
+        shutil.rmtree(self.path)
+
+    def test_priority_and_idempotency(self):
+        """
+        Test that jobs run by priority, and that an idempotency key
+        queues a job once.
+        :return:
+        """
+        low = self.store.enqueue('warm_caches')
+        high = self.store.enqueue('warm_caches', priority=5, key='warm')
+        self.assertEqual(self.store.enqueue('warm_caches', key='warm'), high)
+        self.assertEqual(self.store.claim('test')['id'], high)
+        self.assertEqual(self.store.claim('test')['id'], low)
+        self.assertIsNone(self.store.claim('test'))
+        self.assertRaises(ValueError, self.store.enqueue, 'unknown')
+
+    def test_run_and_progress(self):
+        """
+        Test that a worker runs a job and records its progress and result.
+        :return:
+        """
+        id = self.store.enqueue('warm_caches')
+        self.assertTrue(self.worker.run_once())
+        job = self.store.get(id)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['progress'], 1)
+        self.assertEqual(job['result'], {'count': 4})
+        self.assertEqual(job['message'], 'Loaded 4 of 4 users.')
+        self.assertFalse(self.worker.run_once())
+
+    def test_retries_with_backoff(self):
+        """
+        Test that a failed job is retried after a backoff, then failed.
+        :return:
+        """
+        path = save_upload([{'email': 'a@test.test', 'name': 'a',
+                             'password': 'secret', 'group': 'missing'}])
+        id = self.store.enqueue('import_users', {'path': path})
+        self.assertTrue(self.worker.run_once())
+        job = self.store.get(id)
+        self.assertEqual(job['status'], 'queued')
+        self.assertIn('BulkError', job['error'])
+        self.assertTrue(os.path.isfile(path))
+        self.assertFalse(self.worker.run_once())
+        self.now[0] += 10
+        self.assertTrue(self.worker.run_once())
+        job = self.store.get(id)
+        self.assertEqual(job['status'], 'failed')
+        self.assertIsNone(job['args'])
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(User.query.count(), 4)
+
+    def test_expired_lease(self):
+        """
+        Test that the job of a dead worker is claimed again.
+        :return:
+        """
+        id = self.store.enqueue('warm_caches')
+        self.store.claim('dead')
+        self.assertIsNone(self.store.claim('test'))
+        self.now[0] += 30
+        self.assertEqual(self.store.claim('test')['id'], id)
+        self.now[0] += 30
+        self.assertIsNone(self.store.claim('test'))
+        row = self.store.get(id)
+        self.assertEqual(row['status'], 'failed')
+        self.assertEqual(row['attempts'], 2)
+
+    def test_admin_pages(self):
+        """
+        Test that the admin pages queue jobs and answer their progress.
+        :return:
+        """
+        self.signin('test3@test.test')
+        self.app.config['JOBS_IMPORTS'] = True
+        response = self.client.post(url_for('admin.import_users'), data={
+            'file': (io.BytesIO(b'email,name\nq@test.test,queued\n'),
+                     'users.csv')})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(User.query.count(), 4)
+        self.client.post(url_for('admin.jobs'), data={'name': 'export_users'})
+        response = self.client.post(url_for('admin.jobs'),
+                                    data={'name': 'export_users',
+                                          'format': '../users'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url_for('admin.jobs'))
+        self.assertIn(b'http-equiv="refresh"', response.data)
+        while self.worker.run_once():
+            pass
+        self.assertEqual(User.query.count(), 5)
+        self.assertIsNone(self.store.get(1)['args'])
+        data = json.loads(self.client.get(url_for('admin.job', id=2)).data)
+        self.assertEqual((data['name'], data['status']), ('export_users',
+                                                          'done'))
+        response = self.client.get(url_for('admin.download_job', id=2))
+        self.assertIn(b'q@test.test', response.data)
+        response.close()
+        response = self.client.get(url_for('admin.jobs'))
+        self.assertNotIn(b'http-equiv="refresh"', response.data)
+
+
 class TestError(TestBase):
     """
     Error testcase.